@@ -4,49 +4,175 @@ Subreg.cz API simulator suitable for Python lexicon module.
 
 from __future__ import (absolute_import, print_function)
 
+import time
+
+# Start of the start-up profile (see --profile-startup)
+STARTED = time.perf_counter()
+
 import configargparse
+import importlib
 import logging
 import ssl
-from importlib.metadata import version as _package_version
-
-__version__ = _package_version("subregsim")
+import threading
 
 from .api import Api
-from . import dns
-from .subreg import ApiHttpServer
+from . import zonefile
+from .subreg import ApiHttpServer, create_application
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+def package_version():
+    from importlib.metadata import version
+    return version("subregsim")
+
+def __getattr__(name):
+    # Reading the package metadata takes a while, so the version is looked
+    # up only when asked for
+    if name == "__version__":
+        return package_version()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+class VersionAction(configargparse.Action):
+    def __init__(self, option_strings, dest=configargparse.SUPPRESS, default=configargparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super().__init__(option_strings, dest, nargs=0, default=default, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser.exit(message="{} {}\n".format(parser.prog, package_version()))
+
+class StartupProfile(object):
+    """Durations of the start-up phases, logged by --profile-startup."""
+
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        log.info("Started in {:.1f} ms: {}".format(
+            (self.last - self.start) * 1000,
+            ", ".join("{} {:.1f} ms".format(phase, duration * 1000) for phase, duration in self.phases)))
+
 def parse_command_line():
     parser = configargparse.ArgumentParser(prog="subregsim", description="Subreg.cz API simulator suitable for Python lexicon module.")
     optional_group = parser.add_argument_group("optional arguments")
     optional_group.add_argument("-c", "--config", metavar="FILE", is_config_file=True, help="configuration file for all options (can be specified only on command-line)")
-    optional_group.add_argument("--version", action="version", version="%(prog)s " + __version__)
+    optional_group.add_argument("--version", action=VersionAction)
     optional_group.add_argument("--domain", dest="domains", action="append", env_var="SUBREGSIM_DOMAIN", default=["example.com"], help="simulated domain name (defaults to example.com); may be repeated on the command-line, or given as a list (e.g. [example.com, example.net]) in the config file or SUBREGSIM_DOMAIN env var")
+    optional_group.add_argument("--domain-file", dest="domain_file", metavar="FILE", default=None, env_var="SUBREGSIM_DOMAIN_FILE", help="file with additional simulated domain names, one per line, optionally followed by the expiration date (YYYY-MM-DD) for Domains_List; lines starting with # are ignored")
     optional_group.add_argument("--username", env_var="SUBREGSIM_USERNAME", default="username", help="expected login user name by the server (defaults to username)")
     optional_group.add_argument("--password", env_var="SUBREGSIM_PASSWORD", default="password", help="expected login password by the server (defaults to password)")
+    optional_group.add_argument("--session-ttl", dest="session_ttl", type=int, default=0, metavar="SECONDS", env_var="SUBREGSIM_SESSION_TTL", help="expire sessions unused for the given number of seconds (defaults to 0, sessions do not expire)")
+    optional_group.add_argument("--max-sessions", dest="max_sessions", type=int, default=10000, metavar="COUNT", env_var="SUBREGSIM_MAX_SESSIONS", help="maximum number of concurrent sessions, the least recently used session is dropped first (defaults to 10000, 0 means unlimited)")
+    optional_group.add_argument("--max-user-sessions", dest="max_user_sessions", type=int, default=0, metavar="COUNT", env_var="SUBREGSIM_MAX_USER_SESSIONS", help="maximum number of concurrent sessions of one user, the oldest session is dropped first (defaults to 0, unlimited)")
+    optional_group.add_argument("--profile-startup", dest="profile_startup", action="store_true", default=False, env_var="SUBREGSIM_PROFILE_STARTUP", help="logs how long the start-up phases (imports, arguments, records, servers) took once the servers listen")
+
+    storage_group = parser.add_argument_group("optional storage arguments")
+    storage_group.add_argument("--storage-dir", dest="storage_dir", metavar="DIRECTORY", default=None, env_var="SUBREGSIM_STORAGE_DIR", help="keeps the simulated records in the given directory, so that they survive restarts (by default records are kept in memory only)")
+    storage_group.add_argument("--storage-fsync", dest="storage_fsync", choices=["always", "batch", "never"], default="batch", env_var="SUBREGSIM_STORAGE_FSYNC", help="when to sync changes to disk: always after every change, batch at most once per second, never leaves it to the operating system (defaults to batch)")
+    storage_group.add_argument("--snapshot-interval", dest="snapshot_interval", type=int, default=10000, metavar="COUNT", env_var="SUBREGSIM_SNAPSHOT_INTERVAL", help="number of changes after which the storage journal is compacted to a snapshot (defaults to 10000, 0 takes a snapshot only on exit)")
+
+    zone_group = parser.add_argument_group("optional zone data arguments")
+    zone_group.add_argument("--zone-file", dest="zone_files", action="append", metavar="FILE", default=[], env_var="SUBREGSIM_ZONE_FILE", help="imports records from the RFC 1035 zone file (or JSON file with .json or .jsonl extension) at start; may be repeated")
+    zone_group.add_argument("--seed-dir", dest="seed_dir", metavar="DIRECTORY", default=None, env_var="SUBREGSIM_SEED_DIR", help="imports records from all zone files (.zone, .db) and JSON files (.json, .jsonl) in the directory at start")
+    zone_group.add_argument("--export-file", dest="export_file", metavar="FILE", default=None, env_var="SUBREGSIM_EXPORT_FILE", help="exports all records to the zone file on exit (- for standard output)")
 
     web_group = parser.add_argument_group("optional server arguments")
     web_group.add_argument("--host", default="localhost", env_var="SUBREGSIM_HOST", help="server listening host name or IP address (defaults to localhost)")
     web_group.add_argument("--port", type=int, default=None, env_var="SUBREGSIM_PORT", help="server listening port (defaults to 80, or 443 with --ssl)")
     web_group.add_argument("--url", default=None, env_var="SUBREGSIM_URL", help="API root URL for WSDL generation (defaults to a URL built from --host and --port, with http:// or https:// chosen by --ssl)")
+    web_group.add_argument("--engine", dest="engine", choices=["threaded", "asyncio"], default="threaded", env_var="SUBREGSIM_ENGINE", help="server engine: threaded serves every connection by a thread, asyncio serves the API and DNS server on a single event loop (defaults to threaded)")
+    web_group.add_argument("--fast-soap", dest="fast_soap", action="store_true", default=False, env_var="SUBREGSIM_FAST_SOAP", help="answers the known SOAP operations directly, bypassing the Spyne protocol pipeline (unrecognized requests are still handled by Spyne)")
+    web_group.add_argument("--stream-responses", dest="stream_responses", action="store_true", default=False, env_var="SUBREGSIM_STREAM_RESPONSES", help="answers just Get_DNS_Zone (streamed, not built in memory) and Domains_List (cached) directly, bypassing the Spyne protocol pipeline (implied by --fast-soap)")
+    web_group.add_argument("--keep-alive-timeout", dest="keep_alive_timeout", type=float, default=15, metavar="SECONDS", env_var="SUBREGSIM_KEEP_ALIVE_TIMEOUT", help="idle timeout of persistent HTTP connections (defaults to 15 seconds, 0 disables persistent connections)")
+    web_group.add_argument("--keep-alive-max-requests", dest="keep_alive_max_requests", type=int, default=1000, metavar="COUNT", env_var="SUBREGSIM_KEEP_ALIVE_MAX_REQUESTS", help="maximum number of requests served over one persistent HTTP connection (defaults to 1000, 0 means unlimited)")
+    web_group.add_argument("--metrics", dest="metrics", action="store_true", default=False, env_var="SUBREGSIM_METRICS", help="measures the requests, DNS queries and lock contention and reports them with the records and sessions in Prometheus format at /metrics")
+    web_group.add_argument("--change-feed-size", dest="change_feed_size", type=int, default=10000, metavar="COUNT", env_var="SUBREGSIM_CHANGE_FEED_SIZE", help="number of record changes kept for watchers of the change feed at /changes (defaults to 10000, 0 disables the change feed)")
+    web_group.add_argument("--processes", dest="processes", type=int, default=1, metavar="COUNT", env_var="SUBREGSIM_PROCESSES", help="number of server processes sharing the listening port and the simulated records (defaults to 1); applies to the threaded engine only")
+    web_group.add_argument("--workers", dest="workers", type=int, default=0, metavar="COUNT", env_var="SUBREGSIM_WORKERS", help="number of worker threads serving connections (defaults to 0, a new thread for every connection); note that a persistent connection occupies its worker until it is closed")
+    web_group.add_argument("--queue-size", dest="queue_size", type=int, default=64, metavar="COUNT", env_var="SUBREGSIM_QUEUE_SIZE", help="maximum number of accepted connections waiting for a worker (defaults to 64)")
+    web_group.add_argument("--queue-full", dest="queue_full", choices=["block", "reject"], default="block", env_var="SUBREGSIM_QUEUE_FULL", help="what to do with new connections when the queue is full: block stops accepting until a worker is free, reject answers with 503 Service Unavailable or closes HTTPS connections (defaults to block)")
+
+    admin_group = parser.add_argument_group("optional admin arguments")
+    admin_group.add_argument("--admin-host", dest="admin_host", default="localhost", env_var="SUBREGSIM_ADMIN_HOST", help="admin server listening host name or IP address (defaults to localhost)")
+    admin_group.add_argument("--admin-port", dest="admin_port", type=int, default=None, metavar="PORT", env_var="SUBREGSIM_ADMIN_PORT", help="enables the admin server adding and removing simulated domains and replacing their records at runtime on the given port (disabled by default)")
 
     ssl_group = parser.add_argument_group("optional SSL arguments")
     ssl_group.add_argument("--ssl", dest="ssl", action="store_true", default=False, env_var="SUBREGSIM_SSL", help="enables SSL on server listening port")
     ssl_group.add_argument("--ssl-certificate", dest="ssl_certificate", metavar="PEM-FILE", default=None, env_var="SUBREGSIM_SSL_CERTIFICATE", help="specifies server certificate")
     ssl_group.add_argument("--ssl-private-key", dest="ssl_private_key", metavar="PEM-FILE", default=None, env_var="SUBREGSIM_SSL_PRIVATE_KEY", help="specifies server privatey key (not necessary if private key is part of certificate file)")
+    ssl_group.add_argument("--ssl-ecdsa-certificate", dest="ssl_ecdsa_certificate", metavar="PEM-FILE", default=None, env_var="SUBREGSIM_SSL_ECDSA_CERTIFICATE", help="specifies an additional ECDSA server certificate, preferred by clients supporting it over the --ssl-certificate one")
+    ssl_group.add_argument("--ssl-ecdsa-private-key", dest="ssl_ecdsa_private_key", metavar="PEM-FILE", default=None, env_var="SUBREGSIM_SSL_ECDSA_PRIVATE_KEY", help="specifies ECDSA server private key (not necessary if private key is part of certificate file)")
+    ssl_group.add_argument("--ssl-ciphers", dest="ssl_ciphers", metavar="CIPHERS", default=None, env_var="SUBREGSIM_SSL_CIPHERS", help="OpenSSL cipher list of TLS 1.2 connections (e.g. ECDHE+AESGCM, defaults to the Python defaults)")
+    ssl_group.add_argument("--ssl-ecdh-curve", dest="ssl_ecdh_curve", metavar="CURVE", default=None, env_var="SUBREGSIM_SSL_ECDH_CURVE", help="elliptic curve of the ECDH key exchange (e.g. prime256v1, defaults to the OpenSSL defaults)")
+    ssl_group.add_argument("--ssl-session-tickets", dest="ssl_session_tickets", type=int, default=2, metavar="COUNT", env_var="SUBREGSIM_SSL_SESSION_TICKETS", help="number of TLS 1.3 session tickets sent after a full handshake, letting clients resume the session on reconnection (defaults to 2, 0 disables session resumption)")
+    ssl_group.add_argument("--ssl-ticket-key-lifetime", dest="ssl_ticket_key_lifetime", type=int, default=None, metavar="SECONDS", env_var="SUBREGSIM_SSL_TICKET_KEY_LIFETIME", help="rotates the session ticket keys (and reads the certificates again) after the given number of seconds, clients resuming with older tickets make a full handshake (defaults to 3600, 0 never rotates); not supported with --processes, which never rotates")
+    ssl_group.add_argument("--ssl-stats-interval", dest="ssl_stats_interval", type=int, default=0, metavar="SECONDS", env_var="SUBREGSIM_SSL_STATS_INTERVAL", help="logs the TLS handshake counts and the share of resumed sessions every given number of seconds (defaults to 0, logged on key rotation and exit only)")
 
     dns_group = parser.add_argument_group("optional DNS server arguments")
     dns_group.add_argument("--dns", dest="dns", action="store_true", default=False, env_var="SUBREGSIM_DNS", help="enables DNS server")
     dns_group.add_argument("--dns-host", dest="dns_host", default="localhost", env_var="SUBREGSIM_DNS_HOST", help="DNS server listening host name or IP address (defaults to localhost)")
     dns_group.add_argument("--dns-port", dest="dns_port", type=int, default=53, metavar="PORT", env_var="SUBREGSIM_DNS_PORT", help="DNS server listening port (defaults to 53)")
+    dns_group.add_argument("--dns-journal-size", dest="dns_journal_size", type=int, default=1000, metavar="COUNT", env_var="SUBREGSIM_DNS_JOURNAL_SIZE", help="number of changes of every zone kept for incremental zone transfers (IXFR) by secondary servers (defaults to 1000, 0 always transfers whole zones)")
+    dns_group.add_argument("--dns-notify", dest="dns_notify", action="append", metavar="HOST[:PORT]", default=[], env_var="SUBREGSIM_DNS_NOTIFY", help="secondary DNS server notified (DNS NOTIFY) when a zone changes, IPv6 addresses with a port as [ADDRESS]:PORT; may be repeated")
 
     parsed = parser.parse_args()
 
     if parsed.ssl and ('ssl_certificate' not in parsed or not parsed.ssl_certificate):
         parser.error("--ssl requires --ssl-certificate")
 
+    if parsed.ssl_ecdsa_private_key and not parsed.ssl_ecdsa_certificate:
+        parser.error("--ssl-ecdsa-private-key requires --ssl-ecdsa-certificate")
+
+    if parsed.ssl_session_tickets < 0:
+        parser.error("--ssl-session-tickets must not be negative")
+
+    if parsed.ssl_ticket_key_lifetime is None:
+        # The server processes could not share rotated keys
+        parsed.ssl_ticket_key_lifetime = 3600 if parsed.processes <= 1 else 0
+    elif parsed.ssl_ticket_key_lifetime < 0:
+        parser.error("--ssl-ticket-key-lifetime must not be negative")
+    elif parsed.ssl_ticket_key_lifetime and parsed.processes > 1:
+        parser.error("--ssl-ticket-key-lifetime is not supported with --processes, the processes could not share the rotated keys")
+
+    if parsed.ssl_stats_interval < 0:
+        parser.error("--ssl-stats-interval must not be negative")
+
+    if parsed.snapshot_interval < 0:
+        parser.error("--snapshot-interval must not be negative")
+
+    if parsed.processes < 1:
+        parser.error("--processes must be at least 1")
+
+    if parsed.processes > 1 and parsed.engine != "threaded":
+        parser.error("--processes requires the threaded engine")
+
+    if parsed.workers < 0:
+        parser.error("--workers must not be negative")
+
+    if parsed.queue_size < 1:
+        parser.error("--queue-size must be at least 1")
+
+    if parsed.change_feed_size < 0:
+        parser.error("--change-feed-size must not be negative")
+
+    if parsed.dns_journal_size < 0:
+        parser.error("--dns-journal-size must not be negative")
+
+    try:
+        parsed.dns_notify = [parse_dns_target(target) for target in parsed.dns_notify]
+    except ValueError:
+        parser.error("--dns-notify expects HOST, HOST:PORT or [ADDRESS]:PORT")
+
+    if parsed.dns_notify and not parsed.dns:
+        parser.error("--dns-notify requires --dns")
+
     if parsed.port is None:
         parsed.port = 443 if parsed.ssl else 80
 
@@ -56,32 +182,211 @@ def parse_command_line():
 
     return parsed
 
+def parse_dns_target(target):
+    """Returns (host, port) of HOST, HOST:PORT, IPv6 address or [IPv6 address]:PORT."""
+    if target.startswith("["):
+        host, separator, port = target[1:].partition("]")
+        if not separator or not host or (port and not port.startswith(":")):
+            raise ValueError("invalid target {}".format(target))
+        return (host, int(port[1:]) if port else 53)
+    if target.count(":") != 1:
+        return (target, 53)
+    host, _, port = target.partition(":")
+    return (host, int(port))
+
+def read_domain_file(path):
+    domains = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            domains.append(tuple(fields[:2]) if len(fields) > 1 else fields[0])
+    return domains
+
+def create_server_tls(arguments):
+    if not arguments.ssl:
+        return None
+
+    from .tls import ServerTls, create_context
+
+    def create_ssl_context():
+        return create_context(arguments.ssl_certificate, arguments.ssl_private_key,
+                              arguments.ssl_ecdsa_certificate, arguments.ssl_ecdsa_private_key,
+                              arguments.ssl_ciphers, arguments.ssl_ecdh_curve, arguments.ssl_session_tickets)
+
+    return ServerTls(create_ssl_context, arguments.ssl_ticket_key_lifetime, arguments.ssl_stats_interval)
+
+def create_http_server(arguments, api, reuse_port=False, metrics=None, change_feed=None, tls=None):
+    return ApiHttpServer((arguments.host, arguments.port), arguments.url, api, arguments.ssl, arguments.fast_soap,
+                         arguments.keep_alive_timeout, arguments.keep_alive_max_requests,
+                         arguments.workers, arguments.queue_size, arguments.queue_full, reuse_port, metrics, change_feed, tls,
+                         arguments.stream_responses)
+
+def start_admin_server(arguments, api):
+    if arguments.admin_port is None:
+        return None
+
+    from .admin import AdminHttpServer
+    log.info("Starting admin server to listen on {}:{}...".format(arguments.admin_host, arguments.admin_port))
+    admin_httpd = AdminHttpServer((arguments.admin_host, arguments.admin_port), api)
+    admin_httpd.start_thread()
+    return admin_httpd
+
+def preload_spyne():
+    # Spyne is imported on first use by the SOAP application, importing it
+    # in the background while the clients start keeps it off their first
+    # requests. The import lock makes requests wait for the import to finish.
+    thread = threading.Thread(target=importlib.import_module, args=("subregsim.service",), name="SpyneImport", daemon=True)
+    thread.start()
+
+def servers_started(arguments, profile):
+    profile.mark("servers")
+    if arguments.profile_startup:
+        profile.report()
+
+def run_asyncio(arguments, api, metrics=None, change_feed=None, profile=None, tls=None):
+    import asyncio
+    from . import aio
+    from . import dns
+
+    app = create_application(arguments.url, api, arguments.fast_soap, metrics, change_feed, arguments.stream_responses)
+    http_server = aio.AsyncHttpServer(app, arguments.host, arguments.port, tls,
+                                      arguments.keep_alive_timeout, arguments.keep_alive_max_requests)
+    log.info("Starting HTTP{} server to listen on {}:{}...".format("S" if arguments.ssl else "", arguments.host, arguments.port))
+
+    dns_server = None
+    if arguments.dns:
+        log.info("Starting DNS server to listen on {}:{}...".format(arguments.dns_host, arguments.dns_port))
+        responder = dns.DnsResponder(dns.ApiDnsResolver(api), metrics, arguments.dns_journal_size)
+        dns_server = aio.AsyncDnsServer(responder, arguments.dns_host, arguments.dns_port)
+
+    dns_notifier = start_dns_notifier(arguments, api)
+    admin_httpd = start_admin_server(arguments, api)
+
+    def started():
+        if profile is not None:
+            servers_started(arguments, profile)
+        preload_spyne()
+
+    try:
+        asyncio.run(aio.serve(http_server, dns_server, started))
+    except KeyboardInterrupt:
+        log.info("Terminating...")
+    finally:
+        if change_feed is not None:
+            change_feed.close()
+        if admin_httpd is not None:
+            admin_httpd.stop()
+        if dns_notifier is not None:
+            dns_notifier.stop()
+        close_api(arguments, api)
+
+def start_dns_notifier(arguments, api):
+    if not arguments.dns_notify:
+        return None
+
+    from . import dns
+    dns_notifier = dns.DnsNotifier(api, arguments.dns_notify)
+    dns_notifier.start_thread()
+    return dns_notifier
+
+def close_api(arguments, api):
+    if arguments.export_file:
+        zonefile.export(api, arguments.export_file)
+    api.close()
+
 def main():
+    profile = StartupProfile(STARTED)
+    profile.mark("imports")
 
     arguments = parse_command_line()
+    profile.mark("arguments")
 
-    api = Api(arguments.username, arguments.password, arguments.domains)
+    storage = None
+    if arguments.storage_dir:
+        from .storage import JournalStorage
+        storage = JournalStorage(arguments.storage_dir, arguments.storage_fsync, arguments.snapshot_interval)
+
+    metrics = None
+    if arguments.metrics:
+        from .metrics import Metrics
+        # Slot 0 is used by the process holding the Api, server processes
+        # use their own slots
+        metrics = Metrics(arguments.processes + 1 if arguments.processes > 1 else 1)
+
+    domains = list(arguments.domains)
+    if arguments.domain_file:
+        domains.extend(read_domain_file(arguments.domain_file))
+
+    api = Api(arguments.username, arguments.password, domains,
+              session_ttl=arguments.session_ttl,
+              max_sessions=arguments.max_sessions,
+              max_user_sessions=arguments.max_user_sessions,
+              storage=storage,
+              metrics=metrics)
+    profile.mark("records")
+
+    seed_paths = list(arguments.zone_files)
+    if arguments.seed_dir:
+        seed_paths.extend(zonefile.seed_paths(arguments.seed_dir))
+    if seed_paths:
+        zonefile.seed(api, seed_paths)
+        profile.mark("seeding")
+
+    change_feed = None
+    if arguments.change_feed_size:
+        from .changes import ChangeFeed
+        # Created after seeding, imported records are not changes to watch
+        change_feed = ChangeFeed(api, arguments.change_feed_size)
+
+    # Created before the server processes are forked, so that they share
+    # the session ticket keys
+    tls = create_server_tls(arguments)
+
+    if arguments.engine == "asyncio":
+        run_asyncio(arguments, api, metrics, change_feed, profile, tls)
+        return
 
     if arguments.ssl:
         log.info("Starting HTTPS server to listen on {}:{}...".format(arguments.host, arguments.port))
-
-        httpd = ApiHttpServer((arguments.host, arguments.port), arguments.url, api, arguments.ssl)
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        ssl_context.load_cert_chain(arguments.ssl_certificate, arguments.ssl_private_key)
-        httpd.socket = ssl_context.wrap_socket(httpd.socket, server_side=True)
     else:
         log.info("Starting HTTP server to listen on {}:{}...".format(arguments.host, arguments.port))
-        httpd = ApiHttpServer((arguments.host, arguments.port), arguments.url, api, arguments.ssl)
+
+    if arguments.processes > 1:
+        from .prefork import ApiPreforkServer
+        # Imported once for all server processes, forking while another
+        # thread imports is not safe
+        from . import service
+        profile.mark("spyne")
+
+        def create_process_server(shared_api, index, shared_change_feed):
+            if metrics is not None:
+                metrics.select_slot(index)
+            return create_http_server(arguments, shared_api, reuse_port=True, metrics=metrics, change_feed=shared_change_feed, tls=tls)
+
+        httpd = ApiPreforkServer(api, arguments.processes, create_process_server, change_feed)
+    else:
+        httpd = create_http_server(arguments, api, metrics=metrics, change_feed=change_feed, tls=tls)
 
     if arguments.dns:
+        from . import dns
         log.info("Starting DNS server to listen on {}:{}...".format(arguments.dns_host, arguments.dns_port))
-        api_resolver = dns.ApiDnsResolver(api)
-        dns_udp = dns.ApiDns(api_resolver, arguments.dns_host, arguments.dns_port, False)
-        dns_tcp = dns.ApiDns(api_resolver, arguments.dns_host, arguments.dns_port, True)
+        responder = dns.DnsResponder(dns.ApiDnsResolver(api), metrics, arguments.dns_journal_size)
+        dns_udp = dns.ApiDns(responder, arguments.dns_host, arguments.dns_port, False)
+        dns_tcp = dns.ApiDns(responder, arguments.dns_host, arguments.dns_port, True)
 
         dns_udp.start_thread()
         dns_tcp.start_thread()
 
+    # Started after the server processes are forked
+    dns_notifier = start_dns_notifier(arguments, api)
+    admin_httpd = start_admin_server(arguments, api)
+
+    servers_started(arguments, profile)
+    if arguments.processes <= 1:
+        preload_spyne()
+
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
@@ -89,6 +394,9 @@ def main():
     except Exception as e:
         log.exception(f"Error running HTTP{'S' if arguments.ssl else ''} server", e)
     finally:
+        if change_feed is not None:
+            change_feed.close()
+
         try:
             httpd.server_close()
         except:
@@ -101,6 +409,14 @@ def main():
             dns_udp.thread.join()
             dns_tcp.thread.join()
 
+        if admin_httpd is not None:
+            admin_httpd.stop()
+
+        if dns_notifier is not None:
+            dns_notifier.stop()
+
+        close_api(arguments, api)
+
 def run():
     try:
         main()
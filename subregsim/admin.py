@@ -0,0 +1,188 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+import datetime
+import io
+import json
+import logging
+import re
+import threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from . import zonefile
+
+log = logging.getLogger(__name__)
+
+# Types of the record fields, content may also be null
+RECORD_FIELDS = {"name": str, "type": str, "content": str, "prio": int, "ttl": int}
+
+class AdminError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def check_record(record):
+    if not isinstance(record, dict) or not isinstance(record.get("name"), str) or not record["name"]:
+        raise AdminError("400 Bad Request", "List of records with names expected")
+    for key, expected in RECORD_FIELDS.items():
+        value = record.get(key)
+        if value is None and key not in ("name", "type"):
+            continue
+        # bool is an int too
+        if not isinstance(value, expected) or isinstance(value, bool):
+            raise AdminError("400 Bad Request", "Invalid record {} field {}: {} expected".format(
+                record["name"], key, expected.__name__))
+
+class AdminApplication(object):
+    """
+    WSGI application managing the simulated domains at runtime with JSON
+    requests and responses:
+
+    GET    /domains                 list of domains
+    POST   /domains                 adds the domain {"name": ..., "expire": ...}
+    DELETE /domains/NAME            removes the domain with all its records
+    GET    /domains/NAME/records    list of the domain records
+    PUT    /domains/NAME/records    replaces all records of the domain by the
+                                    JSON list of records, or by the records of
+                                    the zone file (Content-Type text/dns)
+    DELETE /domains/NAME/records    removes all records of the domain
+    GET    /domains/NAME/zone       zone file of the domain (text/dns)
+    """
+
+    ROUTES = (
+        (re.compile(r"^/domains/?$"), "domains"),
+        (re.compile(r"^/domains/(?P<domain>[^/]+)/?$"), "domain"),
+        (re.compile(r"^/domains/(?P<domain>[^/]+)/records/?$"), "records"),
+        (re.compile(r"^/domains/(?P<domain>[^/]+)/zone/?$"), "zone"),
+        )
+
+    def __init__(self, api):
+        self.api = api
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"].upper()
+        path = environ.get("PATH_INFO", "")
+        try:
+            for pattern, resource in self.ROUTES:
+                match = pattern.match(path)
+                if match is not None:
+                    handler = getattr(self, "{}_{}".format(method.lower(), resource), None)
+                    if handler is None:
+                        raise AdminError("405 Method Not Allowed", "Method {} not allowed".format(method))
+                    status, result = handler(environ, **match.groupdict())
+                    break
+            else:
+                raise AdminError("404 Not Found", "Unknown resource {}".format(path))
+        except AdminError as e:
+            status, result = e.status, {"status": "error", "error": str(e)}
+
+        if isinstance(result, str):
+            body = result.encode("utf-8")
+            content_type = "text/dns; charset=utf-8"
+        else:
+            body = json.dumps(result).encode("utf-8")
+            content_type = "application/json"
+        start_response(status, [
+            ("Content-Type", content_type),
+            ("Content-Length", str(len(body))),
+            ])
+        return [body]
+
+    def read_body(self, environ):
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or "0")
+        except ValueError:
+            raise AdminError("400 Bad Request", "Invalid Content-Length")
+        try:
+            return environ["wsgi.input"].read(length).decode("utf-8")
+        except UnicodeDecodeError:
+            raise AdminError("400 Bad Request", "Request body is not UTF-8")
+
+    def read_json(self, environ):
+        try:
+            return json.loads(self.read_body(environ))
+        except ValueError as e:
+            raise AdminError("400 Bad Request", "Invalid JSON: {}".format(e))
+
+    def check_domain(self, domain):
+        if domain not in self.api.domains:
+            raise AdminError("404 Not Found", "Domain {} is not simulated".format(domain))
+
+    def get_domains(self, environ):
+        return "200 OK", {"status": "ok", "domains": list(self.api.domains.values())}
+
+    def post_domains(self, environ):
+        request = self.read_json(environ)
+        if not isinstance(request, dict) or not isinstance(request.get("name"), str) or not request["name"]:
+            raise AdminError("400 Bad Request", "Domain name expected")
+
+        name = request["name"].rstrip(".")
+        if "expire" in request:
+            try:
+                datetime.datetime.strptime(request["expire"], "%Y-%m-%d")
+            except (TypeError, ValueError):
+                raise AdminError("400 Bad Request", "Expiration date YYYY-MM-DD expected")
+            added = self.api.add_domain(name, request["expire"])
+        else:
+            added = self.api.add_domain(name)
+        if not added:
+            raise AdminError("409 Conflict", "Domain {} is simulated already".format(name))
+        return "201 Created", {"status": "ok"}
+
+    def delete_domain(self, environ, domain):
+        if not self.api.remove_domain(domain):
+            raise AdminError("404 Not Found", "Domain {} is not simulated".format(domain))
+        return "200 OK", {"status": "ok"}
+
+    def get_records(self, environ, domain):
+        records = self.api.domain_records(domain)
+        if records is None:
+            raise AdminError("404 Not Found", "Domain {} is not simulated".format(domain))
+        return "200 OK", {"status": "ok", "records": [rr.as_dict() for rr in records]}
+
+    def put_records(self, environ, domain):
+        self.check_domain(domain)
+        if environ.get("CONTENT_TYPE", "").split(";")[0].strip().lower() == "text/dns":
+            try:
+                records = list(zonefile.iter_zone_file(io.StringIO(self.read_body(environ)), domain))
+            except (ValueError, IndexError) as e:
+                raise AdminError("400 Bad Request", "Invalid zone file: {}".format(e))
+        else:
+            records = self.read_json(environ)
+            if not isinstance(records, list):
+                raise AdminError("400 Bad Request", "List of records expected")
+            for record in records:
+                check_record(record)
+
+        count = self.api.reset_domain(domain, records)
+        if count is None:
+            raise AdminError("404 Not Found", "Domain {} is not simulated".format(domain))
+        return "200 OK", {"status": "ok", "records": count}
+
+    def get_zone(self, environ, domain):
+        self.check_domain(domain)
+        return "200 OK", "".join(line + "\n" for line in self.api.zone_lines([domain]))
+
+    def delete_records(self, environ, domain):
+        if self.api.reset_domain(domain) is None:
+            raise AdminError("404 Not Found", "Domain {} is not simulated".format(domain))
+        return "200 OK", {"status": "ok"}
+
+class AdminHttpServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, api):
+        WSGIServer.__init__(self, server_address, WSGIRequestHandler)
+        self.set_app(AdminApplication(api))
+        self.thread = None
+
+    def start_thread(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="admin", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
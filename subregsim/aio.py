@@ -0,0 +1,450 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+import asyncio
+import concurrent.futures
+import io
+import logging
+import struct
+import sys
+import urllib.parse
+from email.utils import formatdate
+
+from .subreg import MAX_BODY_SIZE
+
+log = logging.getLogger(__name__)
+
+SERVER_SOFTWARE = "subregsim-asyncio"
+
+class HttpError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+class AsyncHttpServer(object):
+    """
+    HTTP/1.1 server running a WSGI application for connections served on the
+    event loop. Connections are plain coroutines, so idle persistent
+    connections cost no thread. The application is called in one of
+    app_threads threads, as it may block the loop: it waits for the Api
+    locks, syncs the storage journal and loads Spyne on first use. Responses
+    with a true blocking attribute (waiting for changes) are iterated in
+    threads of their own, so that waiting watchers never hold up the other
+    requests; other responses are iterated on the loop. Blocking responses
+    beyond blocking_threads are answered with 503 Service Unavailable.
+    """
+
+    def __init__(self, app, host, port, tls=None, keep_alive_timeout=15, keep_alive_max_requests=1000,
+                 app_threads=64, blocking_threads=256):
+        self.app = app
+        self.host = host
+        self.port = port
+        # tls.ServerTls of the connections, None for plain HTTP
+        self.tls = tls
+        self.keep_alive_timeout = keep_alive_timeout
+        self.keep_alive_max_requests = keep_alive_max_requests
+        self.server = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(app_threads, thread_name_prefix="app")
+        self.blocking_threads = blocking_threads
+        self.blocking_executor = concurrent.futures.ThreadPoolExecutor(blocking_threads, thread_name_prefix="blocking")
+        self.blocking_responses = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+
+    async def read_request(self, reader):
+        timeout = self.keep_alive_timeout or None
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        except asyncio.LimitOverrunError:
+            raise HttpError("431 Request Header Fields Too Large")
+
+        request_line, _, header_block = head[:-4].decode("iso-8859-1").partition("\r\n")
+        try:
+            method, target, version = request_line.split()
+        except ValueError:
+            raise HttpError("400 Bad Request")
+        if not version.startswith("HTTP/1."):
+            raise HttpError("505 HTTP Version Not Supported")
+
+        headers = []
+        for line in header_block.split("\r\n"):
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise HttpError("400 Bad Request")
+            headers.append((name.strip(), value.strip()))
+
+        header_map = {}
+        for name, value in headers:
+            key = name.lower()
+            header_map[key] = header_map[key] + "," + value if key in header_map else value
+
+        if "chunked" in header_map.get("transfer-encoding", "").lower():
+            try:
+                body = await asyncio.wait_for(self.read_chunked_body(reader), timeout)
+            except ValueError:
+                # Lines longer than the stream limit
+                raise HttpError("400 Bad Request")
+        else:
+            try:
+                length = int(header_map.get("content-length", "0"))
+            except ValueError:
+                raise HttpError("400 Bad Request")
+            if length < 0:
+                raise HttpError("400 Bad Request")
+            if length > MAX_BODY_SIZE:
+                raise HttpError("413 Request Entity Too Large")
+            if header_map.get("expect", "").lower() == "100-continue" and version == "HTTP/1.1":
+                return method, target, version, headers, header_map, None, length
+            body = await self.read_body(reader, length)
+
+        return method, target, version, headers, header_map, body, len(body)
+
+    async def read_body(self, reader, length):
+        if not length:
+            return b""
+        return await asyncio.wait_for(reader.readexactly(length), self.keep_alive_timeout or None)
+
+    async def read_chunked_body(self, reader):
+        chunks = []
+        body_size = 0
+        while True:
+            size_line = await reader.readline()
+            if not size_line:
+                raise asyncio.IncompleteReadError(b"", None)
+            try:
+                size = int(size_line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise HttpError("400 Bad Request")
+            if size < 0:
+                raise HttpError("400 Bad Request")
+            if size == 0:
+                break
+            body_size += size
+            if body_size > MAX_BODY_SIZE:
+                raise HttpError("413 Request Entity Too Large")
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        return b"".join(chunks)
+
+    def get_environ(self, writer, method, target, version, headers, body):
+        path, _, query = target.partition("?")
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote(path, "iso-8859-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "SERVER_SOFTWARE": SERVER_SOFTWARE,
+            "REMOTE_ADDR": peer[0],
+            "CONTENT_TYPE": "text/plain",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "https" if self.tls else "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": False,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            }
+        if self.tls:
+            environ["HTTPS"] = "yes"
+
+        for name, value in headers:
+            key = name.replace("-", "_").upper()
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = value
+                continue
+            if key == "TRANSFER_ENCODING":
+                continue
+            key = "HTTP_" + key
+            environ[key] = environ[key] + "," + value if key in environ else value
+
+        environ["CONTENT_LENGTH"] = str(len(body))
+        return environ
+
+    async def send_response(self, writer, environ, keep_alive):
+        """
+        Runs the application and sends its response. Returns the size of the
+        body and whether the connection can be kept open.
+        """
+        version = environ["SERVER_PROTOCOL"]
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info is not None and response.get("headers_sent"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"] = status
+            response["headers"] = list(response_headers)
+            return lambda data: written.append(data)
+
+        written = []
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.executor, self.app, environ, start_response)
+        blocking = getattr(result, "blocking", False)
+        if blocking and self.blocking_responses >= self.blocking_threads:
+            # Nothing is sent by the response before it is iterated
+            result.close()
+            log.warning("Too many waiting responses, rejecting request from {}".format(environ["REMOTE_ADDR"]))
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\n\r\n")
+            await writer.drain()
+            return 0, keep_alive
+        if blocking:
+            self.blocking_responses += 1
+        try:
+            iterator = iter(result)
+
+            # Buffer the start of the body, so that short responses get
+            # Content-Length and longer ones can be streamed (blocking ones
+            # right after their first block)
+            chunks = []
+            finished = False
+            while len(chunks) < (1 if blocking else 2):
+                data = (await loop.run_in_executor(self.blocking_executor, next, iterator, None)) if blocking else next(iterator, None)
+                if data is None:
+                    finished = True
+                    break
+                if data:
+                    chunks.append(data)
+
+            headers = response["headers"]
+            names = {name.lower() for name, _ in headers}
+            chunked = False
+            if "content-length" not in names:
+                if finished:
+                    headers.append(("Content-Length", str(sum(len(data) for data in written + chunks))))
+                elif keep_alive and version == "HTTP/1.1":
+                    headers.append(("Transfer-Encoding", "chunked"))
+                    chunked = True
+                else:
+                    keep_alive = False
+
+            if not keep_alive:
+                headers.append(("Connection", "close"))
+            elif version != "HTTP/1.1":
+                headers.append(("Connection", "keep-alive"))
+
+            head = ["HTTP/1.1 {}\r\n".format(response["status"])]
+            if "date" not in names:
+                head.append("Date: {}\r\n".format(formatdate(usegmt=True)))
+            if "server" not in names:
+                head.append("Server: {}\r\n".format(SERVER_SOFTWARE))
+            head.extend("{}: {}\r\n".format(name, value) for name, value in headers)
+            head.append("\r\n")
+            writer.write("".join(head).encode("iso-8859-1"))
+            response["headers_sent"] = True
+
+            size = 0
+            while True:
+                pending = written + chunks
+                del written[:]
+                for data in pending:
+                    size += len(data)
+                    writer.write(b"%X\r\n%s\r\n" % (len(data), data) if chunked else data)
+                await writer.drain()
+                if finished and not written:
+                    break
+                data = (await loop.run_in_executor(self.blocking_executor, next, iterator, None)) if blocking else next(iterator, None)
+                finished = data is None
+                chunks = [data] if data else []
+
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        finally:
+            if blocking:
+                self.blocking_responses -= 1
+            if hasattr(result, "close"):
+                result.close()
+
+        return size, keep_alive
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info("peername") or ("",)
+        requests_handled = 0
+        try:
+            if self.tls:
+                # Connections are upgraded one by one, so that they get the
+                # current context of the rotated ones
+                try:
+                    await writer.start_tls(self.tls.current_context(), ssl_handshake_timeout=self.keep_alive_timeout or None)
+                except (asyncio.TimeoutError, OSError):
+                    return
+                self.tls.handshake_done(writer.get_extra_info("ssl_object"))
+
+            while True:
+                try:
+                    method, target, version, headers, header_map, body, length = await self.read_request(reader)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except HttpError as e:
+                    writer.write("HTTP/1.1 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".format(e.status).encode("iso-8859-1"))
+                    await writer.drain()
+                    break
+
+                if body is None:
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                    await writer.drain()
+                    try:
+                        body = await self.read_body(reader, length)
+                    except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                        break
+
+                requests_handled += 1
+                connection = header_map.get("connection", "").lower()
+                if version == "HTTP/1.1":
+                    keep_alive = "close" not in connection
+                else:
+                    keep_alive = "keep-alive" in connection
+                keep_alive = (keep_alive
+                              and self.keep_alive_timeout > 0
+                              and (not self.keep_alive_max_requests or requests_handled < self.keep_alive_max_requests))
+
+                environ = self.get_environ(writer, method, target, version, headers, body)
+                try:
+                    size, keep_alive = await self.send_response(writer, environ, keep_alive)
+                except ConnectionError:
+                    raise
+                except Exception:
+                    log.exception("HTTP{} request handling from {} failed".format("S" if self.tls else "", peer[0]))
+                    break
+
+                log.info('{} - - "{} {} {}" {}'.format(peer[0], method, target, version, size))
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self.executor.shutdown(wait=False)
+        self.blocking_executor.shutdown(wait=False)
+        if self.tls:
+            self.tls.report()
+
+class DnsDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, responder, executor):
+        self.responder = responder
+        self.executor = executor
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        packet = self.responder.respond_cached(data, 512)
+        if packet is not None:
+            self.transport.sendto(packet, addr)
+            return
+
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self.responder.respond, data, 512)
+        future.add_done_callback(lambda future: self.send_reply(future, addr))
+
+    def send_reply(self, future, addr):
+        if future.cancelled():
+            return
+        try:
+            packet = future.result()
+        except Exception:
+            log.exception("DNS request handling from {} failed".format(addr[0]))
+            return
+        if packet is not None and not self.transport.is_closing():
+            self.transport.sendto(packet, addr)
+
+class AsyncDnsServer(object):
+    """
+    DNS server answering both UDP and TCP queries by the dns.DnsResponder.
+    Cached answers are sent from the event loop, other requests (including
+    zone transfers) are answered by threads, as they wait for the Api locks.
+    """
+
+    def __init__(self, responder, host, port, threads=16):
+        self.responder = responder
+        self.host = host
+        self.port = port
+        self.udp_transport = None
+        self.tcp_server = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix="dns")
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.udp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: DnsDatagramProtocol(self.responder, self.executor), local_addr=(self.host, self.port))
+        self.tcp_server = await asyncio.start_server(self.handle_tcp, self.host, self.port)
+
+    async def handle_tcp(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    length = struct.unpack("!H", await reader.readexactly(2))[0]
+                    data = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                packet = self.responder.respond_cached(data)
+                if packet is not None:
+                    writer.write(struct.pack("!H", len(packet)) + packet)
+                    await writer.drain()
+                    continue
+
+                replied = False
+                packets = self.responder.respond_stream(data)
+                try:
+                    while True:
+                        packet = await loop.run_in_executor(self.executor, next, packets, None)
+                        if packet is None:
+                            break
+                        writer.write(struct.pack("!H", len(packet)) + packet)
+                        await writer.drain()
+                        replied = True
+                finally:
+                    try:
+                        packets.close()
+                    except ValueError:
+                        # Cancelled while a thread runs it, it ends there
+                        pass
+                if not replied:
+                    break
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+        self.executor.shutdown(wait=False)
+
+async def serve(http_server, dns_server=None, started=None):
+    """
+    Runs the HTTP server and the optional DNS server until cancelled, calling
+    started() once they listen.
+    """
+    await http_server.start()
+    try:
+        if dns_server is not None:
+            await dns_server.start()
+        if started is not None:
+            started()
+        await http_server.server.serve_forever()
+    finally:
+        http_server.close()
+        if dns_server is not None:
+            dns_server.close()
@@ -3,151 +3,735 @@ Subreg.cz API simulator suitable for Python lexicon module.
 '''
 
 from __future__ import (absolute_import, print_function)
+import collections
 import logging
 import random
 import string
+import sys
 import threading
+import time
 
 log = logging.getLogger(__name__)
 
+# Responses without variable data, shared by all calls so that they can be
+# pre-rendered by the transport (they must never be modified)
+ERROR_INCORRECT_LOGIN = {
+    "response": {
+        "status": "error",
+        "error": {
+            "errormsg": "Incorrect login or password",
+            "errorcode": {
+                "major": 500,
+                "minor": 104
+                }
+            }
+        }
+    }
+
+ERROR_NOT_LOGGED = {
+    "response": {
+        "status": "error",
+        "error": {
+            "errormsg": "You are not logged",
+            "errorcode": {
+                "major": 500,
+                "minor": 101
+                }
+            }
+        }
+    }
+
+ERROR_INVALID_DOMAIN = {
+    "response": {
+        "status": "error",
+        "error": {
+            "errormsg": "Invalid domain",
+            "errorcode": {
+                "major": 524,
+                "minor": 1009
+                }
+            }
+        }
+    }
+
+ERROR_UNKNOWN_RECORD_TYPE = {
+    "response": {
+        "status": "error",
+        "error": {
+            "errormsg": "Unknown record type",
+            "errorcode": {
+                "major": 524,
+                "minor": 1007
+                }
+            }
+        }
+    }
+
+ERROR_INVALID_RECORD_NAME = {
+    "response": {
+        "status": "error",
+        "error": {
+            "errormsg": "Invalid domain name in record",
+            "errorcode": {
+                "major": 524,
+                "minor": 1006
+                }
+            }
+        }
+    }
+
+ERROR_CNAME_CONFLICT = {
+    "response": {
+        "status": "error",
+        "error": {
+            "errormsg": "Cannot create CNAME, where another record already exists",
+            "errorcode": {
+                "major": 524,
+                "minor": 1008
+                }
+            }
+        }
+    }
+
+ERROR_RECORD_CONFLICT = {
+    "response": {
+        "status": "error",
+        "error": {
+            "errormsg": "Cannot create record, where CNAME already exists",
+            "errorcode": {
+                "major": 524,
+                "minor": 1008
+                }
+            }
+        }
+    }
+
+ERROR_MISSING_RECORD_ID = {
+    "response": {
+        "status": "error",
+        "error": {
+            "errormsg": "Missing or empty value for record ID",
+            "errorcode": {
+                "major": 524,
+                "minor": 1002
+                }
+            }
+        }
+    }
+
+ERROR_RECORD_NOT_FOUND = {
+    "response": {
+        "status": "error",
+        "error": {
+            "errormsg": "Record does not exist",
+            "errorcode": {
+                "major": 524,
+                "minor": 1003
+                }
+            }
+        }
+    }
+
+RESPONSE_OK = {
+    "response": {
+        "status": "ok"
+        }
+    }
+
+STATIC_RESPONSES = (
+    ERROR_INCORRECT_LOGIN,
+    ERROR_NOT_LOGGED,
+    ERROR_INVALID_DOMAIN,
+    ERROR_UNKNOWN_RECORD_TYPE,
+    ERROR_INVALID_RECORD_NAME,
+    ERROR_CNAME_CONFLICT,
+    ERROR_RECORD_CONFLICT,
+    ERROR_MISSING_RECORD_ID,
+    ERROR_RECORD_NOT_FOUND,
+    RESPONSE_OK,
+    )
+
+DEFAULT_DOMAIN_EXPIRE = "2023-10-20"
+
+RECORD_TYPES = ("A", "AAAA", "CNAME", "MX", "TXT", "SPF", "SRV", "NS", "TLSA", "CAA", "SSHFP")
+# Types whose content is quoted text in zone files
+TEXT_TYPES = ("TXT", "SPF")
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+class Record(object):
+    """
+    Simulated DNS record. Records are kept as compact objects with interned
+    name and type strings, as the simulator may hold millions of them. Stored
+    records are never changed, a modified copy replaces them instead, so they
+    can be handed out without copying.
+    """
+
+    __slots__ = ("id", "name", "type", "content", "prio", "ttl")
+
+    def __init__(self, id, name, type, content=None, prio=0, ttl=600):
+        self.id = id
+        self.name = _intern(name)
+        self.type = _intern(type)
+        self.content = content
+        self.prio = prio
+        self.ttl = ttl
+
+    @classmethod
+    def from_dict(cls, record, id=None):
+        """Creates the record from the API record dict, unknown fields are ignored."""
+        return cls(record["id"] if id is None else id, record["name"], record["type"],
+                   record.get("content"), record.get("prio", 0), record.get("ttl", 600))
+
+    def replace(self, changes):
+        """Returns a copy of the record with fields changed by the API record dict."""
+        fields = self.as_dict()
+        fields.update((key, value) for key, value in changes.items() if key in self.__slots__)
+        return Record(**fields)
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
 class Api(object):
-    def __init__(self, username, password, domains):
+    def __init__(self, username, password, domains, session_ttl=0, max_sessions=10000, max_user_sessions=0, storage=None, metrics=None):
+        """
+        The domains are given as domain names, or (domain name, expire date)
+        pairs. The optional metrics.Metrics measure the lock contention.
+        """
         self.next_id = 1
         self.username = username
         self.password = password
-        self.domains = domains
+        # Simulated domains in the order of Domains_List, each with its
+        # Domains_List entry
+        self.domains = {}
+        # Records of each domain keyed by record id, in insertion order
         self.db = {}
-        for domain in self.domains:
-            self.db[domain] = []
-        self.ssid = None
+        # Records indexed by domain, lower-cased owner name, type and record
+        # id for DNS lookups, kept up to date by every mutation
+        self.index = {}
+        self.zone_names = {}
+        # Locks of the records of each domain. Locks (and empty record
+        # buckets) of removed domains are kept, so that requests which checked
+        # the domain just before its removal do not fail.
+        self.domain_locks = {}
+        for domain in domains:
+            domain, expire = (domain, DEFAULT_DOMAIN_EXPIRE) if isinstance(domain, str) else domain
+            self.domain_locks[domain] = threading.Lock()
+            self.db[domain] = {}
+            self.index[domain] = {}
+            self.zone_names[self.index_name(domain)] = domain
+            self.domains[domain] = self.domain_entry(domain, expire)
+        # Serializes changes of the set of domains (and storage snapshots),
+        # taken before any domain lock
+        self.domains_lock = threading.Lock()
+        # Domains_List response, built on first use
+        self.domains_list_response = None
+        # Logged-in sessions as ssid -> (login, expiry) in least recently used
+        # order, the expiry is None when sessions do not expire
+        self.sessions = collections.OrderedDict()
+        self.user_sessions = {}
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+        self.max_user_sessions = max_user_sessions
+        self.session_lock = threading.Lock()
         self.sn = 1
-        self.db_lock = threading.Lock()
+        # Guards only the global next_id and sn counters (and the order of
+        # the journal), records of each domain are guarded by the domain
+        # lock. When both are needed, the domain lock is always taken first.
+        self.db_lock = threading.Lock() if metrics is None else metrics.timed_lock("db", threading.Lock())
+        # Optional persistence of the records (see storage.Storage)
+        self.storage = storage
+        # Stored records of domains which are not simulated now, kept for
+        # later snapshots
+        self.stored_records = {}
+        # Callables notified of every change with the journal entry (see
+        # _journal, modify and delete entries carry the "previous" record),
+        # or with {"op": "add_domain"/"remove_domain", "domain": ...} when
+        # the set of domains changes
+        self.listeners = []
+        if self.storage is not None:
+            self._restore(self.storage.load())
+
+    @staticmethod
+    def domain_entry(domain, expire):
+        return {
+            "name": domain,
+            "expire": expire,
+            "autorenew": 0
+            }
 
     def toZone(self):
-        zone = []
-        zone.append("$ORIGIN .")
-        zone.append("$TTL 1800")
-
+        return "\n".join(self.zone_lines())
+
+    def zone_lines(self, domains=None):
+        """
+        Yields the zone file of the domains (all by default) line by line.
+        Only the list of records of one domain is copied at a time, so large
+        zones can be streamed out. Records without data, which the API
+        accepts, are commented out, as they are not valid in a zone file.
+        """
+        yield "$ORIGIN ."
+        yield "$TTL 1800"
+
+        for domain in list(self.domains) if domains is None else domains:
+            try:
+                with self.domain_locks[domain]:
+                    sn = self.sn
+                    records = list(self.db[domain].values())
+            except KeyError:
+                # Removed meanwhile
+                continue
+
+            yield self.zone_soa(domain, sn)
+            for rr in records:
+                if rr.content or rr.type in TEXT_TYPES:
+                    yield self.zone_record(rr)
+                else:
+                    yield "; " + self.zone_record(rr)
+
+    @staticmethod
+    def zone_soa(domain, sn):
+        return "{} IN SOA ns.example.com admin.example.com ( {} 86400 900 1209600 1800 )".format(
+            domain,
+            sn,
+            )
+
+    @staticmethod
+    def zone_record(rr):
+        name = rr.name
+        type = rr.type
+        content = rr.content if rr.content is not None else ""
+        prio = rr.prio
+        ttl = rr.ttl if rr.ttl != 1800 else ""
+
+        if type != "MX":
+            prio = ""
+
+        if type in TEXT_TYPES:
+            content = '"{}"'.format(content.replace("\\", "\\\\").replace('"', r'\"'))
+
+        return "{} {} IN {} {} {}".format(name, ttl, type, prio, content)
+
+    @staticmethod
+    def index_name(name):
+        return name.rstrip(".").lower()
+
+    def _index_add(self, domain, rr):
+        self._index_insert(self.index[domain], rr)
+
+    @classmethod
+    def _index_insert(cls, index, rr):
+        # Owner names are mostly lower-case already, interning lets the index
+        # share the name string with the records
+        types = index.setdefault(sys.intern(cls.index_name(rr.name)), {})
+        types.setdefault(rr.type, {})[rr.id] = rr
+
+    def _index_remove(self, domain, rr):
+        name = self.index_name(rr.name)
+        types = self.index[domain][name]
+        records = types[rr.type]
+        del records[rr.id]
+        if not records:
+            del types[rr.type]
+        if not types:
+            del self.index[domain][name]
+
+    def find_domain(self, name):
+        """Returns the simulated domain the given DNS name belongs to, or None."""
+        labels = self.index_name(name).split(".")
+        for i in range(len(labels)):
+            domain = self.zone_names.get(".".join(labels[i:]))
+            if domain is not None:
+                return domain
+        return None
+
+    def domain_records(self, domain):
+        """Returns the list of records of the domain, or None if the domain is not simulated."""
+        try:
+            lock = self.domain_locks[domain]
+        except KeyError:
+            return None
+        with lock:
+            # Checked under the lock, removal empties the records under it
+            if domain not in self.domains:
+                return None
+            return list(self.db[domain].values())
+
+    def lookup(self, domain, name, type):
+        """
+        Returns the domain records with the given owner name and type. CNAME
+        records are always included, type ANY matches all records.
+        """
+        with self.domain_locks[domain]:
+            types = self.index[domain].get(self.index_name(name))
+            if not types:
+                return []
+            if type == "ANY":
+                return [rr for records in types.values() for rr in records.values()]
+            found = list(types.get(type, {}).values())
+            if type != "CNAME":
+                found.extend(types.get("CNAME", {}).values())
+            return found
+
+    def has_name(self, domain, name):
+        with self.domain_locks[domain]:
+            return self.index_name(name) in self.index[domain]
+
+    def _allocate_id(self):
         with self.db_lock:
-            for domain in self.domains:
-                zone.append("{} IN SOA ns.example.com admin.example.com ( {} 86400 900 1209600 1800 )".format(
-                    domain,
-                    self.sn,
-                    ))
-
-                for rr in self.db[domain]:
-                    name = rr["name"]
-                    type = rr["type"]
-                    content = rr["content"] if "content" in rr else ""
-                    prio = rr["prio"]
-                    ttl = rr["ttl"] if rr["ttl"] != 1800 else ""
-
-                    if type != "MX":
-                        prio = ""
-
-                    if type == "TXT":
-                        content = '"{}"'.format(content.replace('"', r'\"'))
+            record_id = self.next_id
+            self.next_id += 1
+            return record_id
 
-                    zone.append("{} {} IN {} {} {}".format(
-                        name, ttl, type, prio, content))
+    def _increment_serial(self):
+        with self.db_lock:
+            self.sn += 1
+            return self.sn
+
+    def _restore(self, state):
+        if state is None:
+            return
+
+        self.sn = state["sn"]
+        self.next_id = state["next_id"]
+        for domain, records in state["db"].items():
+            if domain not in self.domains:
+                if not records:
+                    continue
+                log.warning("Ignoring {} stored records of domain {}, which is not simulated".format(len(records), domain))
+                self.stored_records[domain] = records
+                continue
+            for record in records:
+                rr = Record.from_dict(record)
+                self.db[domain][rr.id] = rr
+                self._index_add(domain, rr)
+
+    def import_records(self, records, skip_domains=()):
+        """
+        Adds the records directly, bypassing sessions and the SOAP layer, as
+        used to seed the zones at start. The domain of every record is found
+        by its name. Records of unknown domains or types and conflicting
+        CNAME records are skipped. Returns the number of added records.
+        """
+        count = 0
+        skipped = collections.Counter()
+        sn = None
+        for record in records:
+            domain = self.find_domain(record["name"])
+            if domain is None:
+                skipped["unknown domain"] += 1
+                continue
+            if domain in skip_domains:
+                skipped["already seeded domain"] += 1
+                continue
+            if record.get("type") not in RECORD_TYPES:
+                skipped["unknown type"] += 1
+                continue
+
+            with self.domain_locks[domain]:
+                existing_types = self.index[domain].get(self.index_name(record["name"]), {})
+                if existing_types and (record["type"] == "CNAME" or "CNAME" in existing_types):
+                    skipped["CNAME conflict"] += 1
+                    continue
+
+                if sn is None:
+                    sn = self._increment_serial()
+
+                new_record = Record.from_dict(record, self._allocate_id())
+                self.db[domain][new_record.id] = new_record
+                self._index_add(domain, new_record)
+                self._journal({"op": "add", "domain": domain, "record": new_record, "sn": sn})
+            count += 1
+
+        for reason, skipped_count in skipped.items():
+            log.warning("Skipped {} imported records: {}".format(skipped_count, reason))
+
+        if self.storage is not None:
+            self.storage.sync()
+        self._snapshot_if_due()
+        return count
+
+    def _commit(self, entry):
+        # Takes the serial of the change and journals it at once, so that the
+        # journal (and listeners) see the changes of all domains in the order
+        # of their serials
+        with self.db_lock:
+            self.sn += 1
+            entry["sn"] = self.sn
+            self._journal(entry)
+
+        # The change is synced to disk outside of the global lock (with the
+        # domain lock still held), so that changes of other domains are
+        # journaled meanwhile, and synced together
+        if self.storage is not None:
+            self.storage.sync()
+
+    def _journal(self, entry):
+        # Called with the domain lock held, so the journal (and listeners)
+        # keep the order of changes within the domain
+        if self.storage is not None:
+            self.storage.append(entry)
+        self._notify(entry)
+
+    def _notify(self, change):
+        for listener in self.listeners:
+            try:
+                listener(change)
+            except Exception:
+                log.exception("Change listener failed")
+
+    def _snapshot_if_due(self):
+        if self.storage is not None and self.storage.snapshot_due():
+            try:
+                self.snapshot()
+            except Exception:
+                log.exception("Unable to write the storage snapshot")
+
+    def snapshot(self):
+        """Writes all records to the storage, so that its journal can be compacted."""
+        if self.storage is None:
+            return
+
+        # All domains are locked only while the journal is switched and the
+        # records are copied, the snapshot itself is written unlocked
+        with self.domains_lock:
+            domains = list(self.domains)
+            for domain in domains:
+                self.domain_locks[domain].acquire()
+            try:
+                token = self.storage.rotate()
+                if token is None:
+                    return
+                with self.db_lock:
+                    state = {
+                        "sn": self.sn,
+                        "next_id": self.next_id,
+                        "db": dict(self.stored_records)
+                        }
+                for domain in domains:
+                    state["db"][domain] = list(self.db[domain].values())
+            finally:
+                for domain in reversed(domains):
+                    self.domain_locks[domain].release()
+
+        self.storage.write_snapshot(token, state)
+
+    def _domains_changed(self):
+        # The response is rebuilt from the shared domain entries on next use
+        self.domains_list_response = None
+
+    def add_domain(self, domain, expire=DEFAULT_DOMAIN_EXPIRE):
+        """
+        Starts simulating the domain. Records of the domain kept by the
+        storage are loaded. Returns False if the domain is simulated already.
+        """
+        with self.domains_lock:
+            if domain in self.domains:
+                return False
+
+            with self.domain_locks.setdefault(domain, threading.Lock()):
+                self.db[domain] = {}
+                self.index[domain] = {}
+                for record in self.stored_records.pop(domain, ()):
+                    rr = Record.from_dict(record)
+                    self.db[domain][rr.id] = rr
+                    self._index_add(domain, rr)
+                self.zone_names[self.index_name(domain)] = domain
+                self.domains[domain] = self.domain_entry(domain, expire)
+            self._domains_changed()
+            self._notify({"op": "add_domain", "domain": domain})
+
+        log.info("Domain {} added".format(domain))
+        return True
+
+    def remove_domain(self, domain):
+        """
+        Stops simulating the domain and drops its records. Returns False if
+        the domain is not simulated.
+        """
+        with self.domains_lock:
+            if domain not in self.domains:
+                return False
+
+            del self.domains[domain]
+            del self.zone_names[self.index_name(domain)]
+            self._domains_changed()
+            self._notify({"op": "remove_domain", "domain": domain})
+            with self.domain_locks[domain]:
+                self.db[domain] = {}
+                self.index[domain] = {}
+                self._commit({"op": "reset", "domain": domain, "records": []})
+
+        log.info("Domain {} removed".format(domain))
+        self._snapshot_if_due()
+        return True
+
+    def reset_domain(self, domain, records=()):
+        """
+        Atomically replaces all records of the domain by the given API record
+        dicts (no records empty the zone). Records of other domains or unknown
+        types and conflicting CNAME records are skipped. Returns the number of
+        records in the zone, or None if the domain is not simulated.
+        """
+        if domain not in self.domains:
+            return None
+
+        # The new zone is built aside, so the domain is locked just for the
+        # swap
+        db = {}
+        index = {}
+        skipped = collections.Counter()
+        for record in records:
+            if self.find_domain(record["name"]) != domain:
+                skipped["other domain"] += 1
+                continue
+            if record.get("type") not in RECORD_TYPES:
+                skipped["unknown type"] += 1
+                continue
+            existing_types = index.get(self.index_name(record["name"]), {})
+            if existing_types and (record["type"] == "CNAME" or "CNAME" in existing_types):
+                skipped["CNAME conflict"] += 1
+                continue
+
+            rr = Record.from_dict(record, self._allocate_id())
+            db[rr.id] = rr
+            self._index_insert(index, rr)
+
+        for reason, skipped_count in skipped.items():
+            log.warning("Skipped {} records of domain {}: {}".format(skipped_count, domain, reason))
+
+        with self.domain_locks[domain]:
+            if domain not in self.domains:
+                return None
+            self.db[domain] = db
+            self.index[domain] = index
+            self._commit({"op": "reset", "domain": domain, "records": list(db.values())})
+
+        log.info("Domain {} reset to {} records".format(domain, len(db)))
+        self._snapshot_if_due()
+        return len(db)
+
+    def statistics(self):
+        """Returns the numbers of sessions, threads and records by domain, without locking the Api."""
+        return {
+            "sessions": len(self.sessions),
+            "threads": threading.active_count(),
+            "serial": self.sn,
+            "records": {domain: len(self.db[domain]) for domain in list(self.domains)},
+            }
 
-        return "\n".join(zone)
+    def close(self):
+        if self.storage is not None:
+            self.snapshot()
+            self.storage.close()
+
+    def _is_logged(self, ssid):
+        if ssid not in self.sessions:
+            return False
+
+        now = time.monotonic()
+        with self.session_lock:
+            session = self.sessions.get(ssid)
+            if session is None:
+                return False
+
+            login, expiry = session
+            if expiry is not None and expiry <= now:
+                self._drop_session(ssid)
+                return False
+
+            # Refresh the session as recently used and extend its lifetime
+            self.sessions.move_to_end(ssid)
+            if expiry is not None:
+                self.sessions[ssid] = (login, now + self.session_ttl)
+        return True
+
+    def _drop_session(self, ssid):
+        login, _ = self.sessions.pop(ssid, (None, None))
+        user_sessions = self.user_sessions.get(login)
+        if user_sessions is not None:
+            user_sessions.pop(ssid, None)
+            if not user_sessions:
+                del self.user_sessions[login]
+
+    def _add_session(self, login, ssid):
+        expiry = time.monotonic() + self.session_ttl if self.session_ttl else None
+        with self.session_lock:
+            if self.max_user_sessions:
+                user_sessions = self.user_sessions.get(login, ())
+                while len(user_sessions) >= self.max_user_sessions:
+                    self._drop_session(next(iter(user_sessions)))
+
+            if self.max_sessions:
+                while len(self.sessions) >= self.max_sessions:
+                    self._drop_session(next(iter(self.sessions)))
+
+            self.sessions[ssid] = (login, expiry)
+            self.user_sessions.setdefault(login, collections.OrderedDict())[ssid] = None
 
     def login(self, login, password):
         log.info("Login: {}/{}".format(login, password))
 
-        self.ssid = None
-
         if login != self.username or password != self.password:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Incorrect login or password",
-                        "errorcode": {
-                            "major": 500,
-                            "minor": 104
-                            }
-                        }
-                    }
-                }
+            return ERROR_INCORRECT_LOGIN
 
-        self.ssid = "".join(random.SystemRandom().choice(string.digits + string.ascii_lowercase) for _ in range(32))
+        ssid = "".join(random.SystemRandom().choice(string.digits + string.ascii_lowercase) for _ in range(32))
+        self._add_session(login, ssid)
 
         return {
             "response": {
                 "status": "ok",
                 "data": {
-                    "ssid": self.ssid
+                    "ssid": ssid
                     }
                 }
             }
 
     def domains_list(self, ssid):
-        if ssid != self.ssid:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "You are not logged",
-                        "errorcode": {
-                            "major": 500,
-                            "minor": 101
+        if not self._is_logged(ssid):
+            return ERROR_NOT_LOGGED
+
+        # The response is shared by all calls (and must not be modified), so
+        # that the transport can cache its rendering
+        response = self.domains_list_response
+        if response is None:
+            # Built under the lock of the domain changes, which drop it, so
+            # that a response built before a change is never stored after it
+            with self.domains_lock:
+                response = self.domains_list_response
+                if response is None:
+                    response = {
+                        "response": {
+                            "status": "ok",
+                            "data": {
+                                "count": len(self.domains),
+                                "domains": list(self.domains.values())
+                                }
                             }
                         }
-                    }
-                }
-
-        return {
-            "response": {
-                "status": "ok",
-                "data": {
-                    "count": len(self.domains),
-                    "domains": [{
-                        "name": domain,
-                        "expire": "2023-10-20",
-                        "autorenew": 0
-                        } for domain in self.domains]
-                    }
-                }
-            }
+                    self.domains_list_response = response
+        return response
 
     def get_dns_zone(self, ssid, domain):
-        if ssid != self.ssid:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "You are not logged",
-                        "errorcode": {
-                            "major": 500,
-                            "minor": 101
-                            }
-                        }
-                    }
-                }
+        if not self._is_logged(ssid):
+            return ERROR_NOT_LOGGED
 
         if domain not in self.domains:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Invalid domain",
-                        "errorcode": {
-                            "major": 524,
-                            "minor": 1009
-                            }
-                        }
-                    }
-                }
+            return ERROR_INVALID_DOMAIN
 
-        if len(self.db[domain]) > 0:
+        # Records are never changed in place, so the copied list is a
+        # consistent snapshot of the zone even while it is being serialized
+        with self.domain_locks[domain]:
+            records = list(self.db[domain].values())
+
+        if len(records) > 0:
             return {
                 "response": {
                     "status": "ok",
                     "data": {
                         "domain": domain,
-                        "records": self.db[domain]
+                        "records": records
                         }
                     }
                 }
@@ -162,258 +746,107 @@ class Api(object):
                 }
 
     def add_dns_record(self, ssid, domain, record):
-        if ssid != self.ssid:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "You are not logged",
-                        "errorcode": {
-                            "major": 500,
-                            "minor": 101
-                            }
-                        }
-                    }
-                }
+        if not self._is_logged(ssid):
+            return ERROR_NOT_LOGGED
 
         if domain not in self.domains:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Invalid domain",
-                        "errorcode": {
-                            "major": 524,
-                            "minor": 1009
-                            }
-                        }
-                    }
-                }
+            return ERROR_INVALID_DOMAIN
 
-        if record.get("type", None) not in ["A", "AAAA", "CNAME", "MX", "TXT", "SPF", "SRV", "NS", "TLSA", "CAA", "SSHFP"]:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Unknown record type",
-                        "errorcode": {
-                            "major": 524,
-                            "minor": 1007
-                            }
-                        }
-                    }
-                }
+        if record.get("type", None) not in RECORD_TYPES:
+            return ERROR_UNKNOWN_RECORD_TYPE
 
         if "name" not in record:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Invalid domain name in record",
-                        "errorcode": {
-                            "major": 524,
-                            "minor": 1006
-                            }
-                        }
-                    }
-                }
+            return ERROR_INVALID_RECORD_NAME
 
-        with self.db_lock:
-            if record["type"] == "CNAME" and any(found["name"] == record["name"] and
-                                                 found["type"] == record["type"] and
-                                                 found["content"] == record["content"] for found in self.db[domain]):
-                return {
-                    "response": {
-                        "status": "error",
-                        "error": {
-                            "errormsg": "Cannot create CNAME, where another record already exists",
-                            "errorcode": {
-                                "major": 524,
-                                "minor": 1008
-                                }
-                            }
-                        }
-                    }
+        with self.domain_locks[domain]:
+            # The domain may have been removed while waiting for the lock
+            if domain not in self.domains:
+                return ERROR_INVALID_DOMAIN
 
-            new_record = dict(record)
+            # A CNAME cannot coexist with any other record of the same name
+            existing_types = self.index[domain].get(self.index_name(record["name"]), {})
+            if record["type"] == "CNAME" and existing_types:
+                return ERROR_CNAME_CONFLICT
 
-            new_record["id"] = self.next_id
-            self.next_id += 1
+            if record["type"] != "CNAME" and "CNAME" in existing_types:
+                return ERROR_RECORD_CONFLICT
 
-            if 'ttl' not in new_record:
-                new_record['ttl'] = 600
-            if 'prio' not in new_record:
-                new_record['prio'] = 0
-
-            self.db[domain].append(new_record)
-            self.sn += 1
+            new_record = Record.from_dict(record, self._allocate_id())
+            self.db[domain][new_record.id] = new_record
+            self._index_add(domain, new_record)
+            self._commit({"op": "add", "domain": domain, "record": new_record})
 
-        return {
-            "response": {
-                "status": "ok"
-                }
-            }
+        self._snapshot_if_due()
+        return RESPONSE_OK
 
     def modify_dns_record(self, ssid, domain, record):
-        if ssid != self.ssid:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "You are not logged",
-                        "errorcode": {
-                            "major": 500,
-                            "minor": 101
-                            }
-                        }
-                    }
-                }
+        if not self._is_logged(ssid):
+            return ERROR_NOT_LOGGED
 
         if domain not in self.domains:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Invalid domain",
-                        "errorcode": {
-                            "major": 524,
-                            "minor": 1009
-                            }
-                        }
-                    }
-                }
+            return ERROR_INVALID_DOMAIN
 
         if "id" not in record:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Missing or empty value for record ID",
-                        "errorcode": {
-                            "major": 524,
-                            "minor": 1002
-                            }
-                        }
-                    }
-                }
+            return ERROR_MISSING_RECORD_ID
 
-        if "type" in record and record["type"] not in ["A", "AAAA", "CNAME", "MX", "TXT", "SPF", "SRV", "NS", "TLSA", "CAA", "SSHFP"]:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Unknown record type",
-                        "errorcode": {
-                            "major": 524,
-                            "minor": 1007
-                            }
-                        }
-                    }
-                }
+        if "type" in record and record["type"] not in RECORD_TYPES:
+            return ERROR_UNKNOWN_RECORD_TYPE
 
-        with self.db_lock:
-            found_items = [item for item in self.db[domain] if item["id"] == record["id"]]
-            if len(found_items) == 0:
-                return {
-                    "response": {
-                        "status": "error",
-                        "error": {
-                            "errormsg": "Record does not exist",
-                            "errorcode": {
-                                "major": 524,
-                                "minor": 1003
-                                }
-                            }
-                        }
-                    }
+        with self.domain_locks[domain]:
+            if domain not in self.domains:
+                return ERROR_INVALID_DOMAIN
 
-            found_items[0].update(record)
-            self.sn += 1
+            found = self.db[domain].get(record["id"])
+            if found is None:
+                return ERROR_RECORD_NOT_FOUND
 
-        return {
-            "response": {
-                "status": "ok"
-                }
-            }
+            # Records are replaced instead of being changed in place, so that
+            # the records given out by get_dns_zone() stay consistent
+            modified = found.replace(record)
+
+            # A CNAME cannot coexist with any other record of the same name,
+            # the modified record itself does not count
+            existing_types = [
+                type for type, records in self.index[domain].get(self.index_name(modified.name), {}).items()
+                if len(records) > 1 or found.id not in records
+                ]
+            if modified.type == "CNAME" and existing_types:
+                return ERROR_CNAME_CONFLICT
+
+            if modified.type != "CNAME" and "CNAME" in existing_types:
+                return ERROR_RECORD_CONFLICT
+
+            self._index_remove(domain, found)
+            self.db[domain][modified.id] = modified
+            self._index_add(domain, modified)
+            self._commit({"op": "modify", "domain": domain, "record": modified, "previous": found})
+
+        self._snapshot_if_due()
+        return RESPONSE_OK
 
     def delete_dns_record(self, ssid, domain, record):
-        if ssid != self.ssid:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "You are not logged",
-                        "errorcode": {
-                            "major": 500,
-                            "minor": 101
-                            }
-                        }
-                    }
-                }
+        if not self._is_logged(ssid):
+            return ERROR_NOT_LOGGED
 
         if domain not in self.domains:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Invalid domain",
-                        "errorcode": {
-                            "major": 524,
-                            "minor": 1009
-                            }
-                        }
-                    }
-                }
+            return ERROR_INVALID_DOMAIN
 
         if "id" not in record:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Missing or empty value for record ID",
-                        "errorcode": {
-                            "major": 524,
-                            "minor": 1002
-                            }
-                        }
-                    }
-                }
+            return ERROR_MISSING_RECORD_ID
 
-        if "type" in record and record["type"] not in ["A", "AAAA", "CNAME", "MX", "TXT", "SPF", "SRV", "NS", "TLSA", "CAA", "SSHFP"]:
-            return {
-                "response": {
-                    "status": "error",
-                    "error": {
-                        "errormsg": "Unknown record type",
-                        "errorcode": {
-                            "major": 524,
-                            "minor": 1007
-                            }
-                        }
-                    }
-                }
+        if "type" in record and record["type"] not in RECORD_TYPES:
+            return ERROR_UNKNOWN_RECORD_TYPE
 
-        with self.db_lock:
-            before_length = len(self.db[domain])
-            self.db[domain] = [item for item in self.db[domain] if item["id"] != record["id"]]
-            if before_length == len(self.db[domain]):
-                return {
-                    "response": {
-                        "status": "error",
-                        "error": {
-                            "errormsg": "Record does not exist",
-                            "errorcode": {
-                                "major": 524,
-                                "minor": 1003
-                                }
-                            }
-                        }
-                    }
+        with self.domain_locks[domain]:
+            if domain not in self.domains:
+                return ERROR_INVALID_DOMAIN
 
-            self.sn += 1
+            found = self.db[domain].pop(record["id"], None)
+            if found is None:
+                return ERROR_RECORD_NOT_FOUND
 
-        return {
-            "response": {
-                "status": "ok"
-                }
-            }
+            self._index_remove(domain, found)
+            self._commit({"op": "delete", "domain": domain, "id": found.id, "previous": found})
+
+        self._snapshot_if_due()
+        return RESPONSE_OK
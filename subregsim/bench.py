@@ -0,0 +1,369 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+import configargparse
+import http.client
+import json
+import logging
+import os
+import platform
+import resource
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+from importlib.metadata import version as _package_version
+from xml.sax.saxutils import escape
+
+import dnslib
+from lxml import etree
+
+__version__ = _package_version("subregsim")
+
+log = logging.getLogger(__name__)
+
+SOAP_ENVELOPE = ('<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:typ="http://subreg.cz/types">'
+                 '<soapenv:Body>{}</soapenv:Body></soapenv:Envelope>')
+TYPES_NS = "{http://subreg.cz/types}"
+
+# Operations of one workload iteration, in the order lexicon calls them
+OPERATIONS = ("Login", "Domains_List", "Add_DNS_Record", "DNS_Query", "Get_DNS_Zone", "Delete_DNS_Record")
+
+class BenchmarkError(Exception):
+    pass
+
+def parse_command_line():
+    parser = configargparse.ArgumentParser(prog="subregsim-bench", description="Load generator measuring the Subreg.cz API simulator with lexicon-like workloads.")
+    parser.add_argument("--version", action="version", version="%(prog)s " + __version__)
+    parser.add_argument("--url", default=None, env_var="SUBREGSIM_BENCH_URL", help="API URL of a running simulator (by default a simulator is started in-process on a free port)")
+    parser.add_argument("--dns-host", dest="dns_host", default="127.0.0.1", env_var="SUBREGSIM_BENCH_DNS_HOST", help="DNS server host of the running simulator (defaults to 127.0.0.1)")
+    parser.add_argument("--dns-port", dest="dns_port", type=int, default=None, metavar="PORT", env_var="SUBREGSIM_BENCH_DNS_PORT", help="DNS server port of the running simulator (DNS queries are skipped with --url without --dns-port)")
+    parser.add_argument("--username", env_var="SUBREGSIM_BENCH_USERNAME", default="username", help="login user name (defaults to username)")
+    parser.add_argument("--password", env_var="SUBREGSIM_BENCH_PASSWORD", default="password", help="login password (defaults to password)")
+    parser.add_argument("--domain", default="example.com", env_var="SUBREGSIM_BENCH_DOMAIN", help="domain the records are added to (defaults to example.com)")
+    parser.add_argument("--concurrency", type=int, default=4, metavar="COUNT", env_var="SUBREGSIM_BENCH_CONCURRENCY", help="number of concurrent clients (defaults to 4)")
+    parser.add_argument("--iterations", type=int, default=50, metavar="COUNT", env_var="SUBREGSIM_BENCH_ITERATIONS", help="number of workload iterations of every client (defaults to 50)")
+    parser.add_argument("--zone-size", dest="zone_size", type=int, default=0, metavar="COUNT", env_var="SUBREGSIM_BENCH_ZONE_SIZE", help="number of records added to the domain before the run (defaults to 0)")
+    parser.add_argument("--fast-soap", dest="fast_soap", action="store_true", default=False, env_var="SUBREGSIM_BENCH_FAST_SOAP", help="starts the in-process simulator with --fast-soap")
+    parser.add_argument("--output", default="-", metavar="FILE", env_var="SUBREGSIM_BENCH_OUTPUT", help="file to write the JSON report to (defaults to - for standard output)")
+
+    parsed = parser.parse_args()
+
+    if parsed.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+
+    if parsed.iterations < 1:
+        parser.error("--iterations must be at least 1")
+
+    if parsed.zone_size < 0:
+        parser.error("--zone-size must not be negative")
+
+    if parsed.url is not None and parsed.fast_soap:
+        parser.error("--fast-soap applies to the in-process simulator only")
+
+    return parsed
+
+def current_rss():
+    """Returns the resident memory of this process in bytes (the peak where the current one is unknown)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+class SoapClient(object):
+    """Minimal SOAP client keeping its HTTP connection open, like lexicon does."""
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.path = parts.path or "/"
+        self.connection = None
+        self.context = None
+        if self.https:
+            # Simulators mostly run with self-signed certificates
+            self.context = ssl.create_default_context()
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+
+    def connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, context=self.context)
+        return http.client.HTTPConnection(self.host, self.port)
+
+    def call(self, operation, arguments):
+        body = SOAP_ENVELOPE.format("<typ:{0}>{1}</typ:{0}>".format(operation, arguments)).encode("utf-8")
+        for attempt in (1, 2):
+            if self.connection is None:
+                self.connection = self.connect()
+            try:
+                self.connection.request("POST", self.path, body, {"Content-Type": "text/xml; charset=utf-8", "SOAPAction": '""'})
+                response = self.connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server may close an idle or exhausted connection
+                self.close()
+                if attempt == 2:
+                    raise
+        if response.will_close:
+            self.close()
+
+        root = etree.fromstring(data)
+        result = root.find(".//{}response".format(TYPES_NS))
+        if result is None or result.findtext(TYPES_NS + "status") != "ok":
+            raise BenchmarkError("{} failed: {}".format(operation, result.findtext(".//{}errormsg".format(TYPES_NS)) if result is not None else data[:200]))
+        return result
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+def record_arguments(ssid, domain, name, type, content, ttl=600):
+    return ("<typ:ssid>{}</typ:ssid><typ:domain>{}</typ:domain><typ:record><typ:name>{}</typ:name>"
+            "<typ:type>{}</typ:type><typ:content>{}</typ:content><typ:ttl>{}</typ:ttl></typ:record>").format(
+            escape(ssid), escape(domain), escape(name), type, escape(content), ttl)
+
+class Client(object):
+    """One simulated lexicon user running the workload iterations."""
+
+    def __init__(self, number, arguments, url, dns_address):
+        self.number = number
+        self.arguments = arguments
+        self.soap = SoapClient(url)
+        self.dns_address = dns_address
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.errors = {operation: 0 for operation in OPERATIONS}
+        self.failures = []
+
+    def timed(self, operation, function, *args):
+        start = time.perf_counter()
+        try:
+            result = function(*args)
+        except Exception as e:
+            self.errors[operation] += 1
+            if len(self.failures) < 5:
+                self.failures.append(str(e))
+            raise
+        self.latencies[operation].append(time.perf_counter() - start)
+        return result
+
+    def query_dns(self, name, content):
+        request = dnslib.DNSRecord.question(name, "TXT")
+        reply = dnslib.DNSRecord.parse(request.send(self.dns_address[0], self.dns_address[1], timeout=5))
+        if not any(str(rr.rdata).strip('"') == content for rr in reply.rr):
+            raise BenchmarkError("TXT record {} not served by DNS".format(name))
+
+    def login(self):
+        result = self.soap.call("Login", "<typ:login>{}</typ:login><typ:password>{}</typ:password>".format(
+            escape(self.arguments.username), escape(self.arguments.password)))
+        ssid = result.findtext(".//{}ssid".format(TYPES_NS))
+        if ssid is None:
+            raise BenchmarkError("Login response without ssid")
+        return ssid
+
+    def find_record(self, ssid, name):
+        zone = self.soap.call("Get_DNS_Zone", "<typ:ssid>{}</typ:ssid><typ:domain>{}</typ:domain>".format(escape(ssid), escape(self.arguments.domain)))
+        for record in zone.iter(TYPES_NS + "records"):
+            if record.findtext(TYPES_NS + "name") == name and record.findtext(TYPES_NS + "type") == "TXT":
+                return record.findtext(TYPES_NS + "id")
+        raise BenchmarkError("Added record {} not found in the zone".format(name))
+
+    def iteration(self, index):
+        domain = self.arguments.domain
+        name = "_acme-challenge.bench-{}-{}.{}".format(self.number, index, domain)
+        content = "token-{}-{}".format(self.number, index)
+
+        ssid = self.timed("Login", self.login)
+        self.timed("Domains_List", self.soap.call, "Domains_List", "<typ:ssid>{}</typ:ssid>".format(escape(ssid)))
+        self.timed("Add_DNS_Record", self.soap.call, "Add_DNS_Record", record_arguments(ssid, domain, name, "TXT", content))
+        if self.dns_address is not None:
+            self.timed("DNS_Query", self.query_dns, name, content)
+        record_id = self.timed("Get_DNS_Zone", self.find_record, ssid, name)
+        self.timed("Delete_DNS_Record", self.soap.call, "Delete_DNS_Record",
+                   "<typ:ssid>{}</typ:ssid><typ:domain>{}</typ:domain><typ:record><typ:id>{}</typ:id></typ:record>".format(
+                   escape(ssid), escape(domain), record_id))
+
+    def run(self, iterations):
+        try:
+            for index in range(iterations):
+                try:
+                    self.iteration(index)
+                except Exception:
+                    # Every step of the iteration runs in timed(), which
+                    # counted the error; continue with the next iteration
+                    pass
+        finally:
+            self.soap.close()
+
+class InProcessSimulator(object):
+    """Simulator with the SOAP API and DNS server on free local ports."""
+
+    def __init__(self, arguments):
+        from .api import Api
+        from . import dns
+        from .subreg import ApiHttpServer, ApiHttpRequestHandler
+
+        class QuietRequestHandler(ApiHttpRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+        self.api = Api(arguments.username, arguments.password, [arguments.domain])
+        self.httpd = ApiHttpServer(("127.0.0.1", 0), "http://127.0.0.1/", self.api, False, arguments.fast_soap)
+        self.httpd.RequestHandlerClass = QuietRequestHandler
+        self.url = "http://127.0.0.1:{}/".format(self.httpd.server_address[1])
+
+        self.dns = dns.ApiDns(dns.DnsResponder(dns.ApiDnsResolver(self.api)), "127.0.0.1", 0)
+        self.dns_address = self.dns.address
+
+    def start(self):
+        self.http_thread = threading.Thread(target=self.httpd.serve_forever, name="bench-http", daemon=True)
+        self.http_thread.start()
+        self.dns.start_thread()
+
+    def record_count(self):
+        return sum(self.api.statistics()["records"].values())
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.dns.stop()
+        self.api.close()
+
+def preload(arguments, url, simulator):
+    """Fills the domain with --zone-size records, which are not part of the measurements."""
+    if not arguments.zone_size:
+        return
+    names = ("fill-{}.{}".format(index, arguments.domain) for index in range(arguments.zone_size))
+    if simulator is not None:
+        simulator.api.import_records({"name": name, "type": "TXT", "content": "fill"} for name in names)
+        return
+
+    soap = SoapClient(url)
+    try:
+        ssid = soap.call("Login", "<typ:login>{}</typ:login><typ:password>{}</typ:password>".format(
+            escape(arguments.username), escape(arguments.password))).findtext(".//{}ssid".format(TYPES_NS))
+        for name in names:
+            soap.call("Add_DNS_Record", record_arguments(ssid, arguments.domain, name, "TXT", "fill"))
+    finally:
+        soap.close()
+
+def summarize(latencies, errors, duration):
+    operations = {}
+    for operation in OPERATIONS:
+        values = sorted(latencies[operation])
+        if not values and not errors[operation]:
+            continue
+        operations[operation] = {
+            "count": len(values),
+            "errors": errors[operation],
+            "throughput": round(len(values) / duration, 2) if duration else None,
+            "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else None,
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3) if values else None,
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3) if values else None,
+            "max_ms": round(values[-1] * 1000, 3) if values else None,
+            }
+    return operations
+
+def benchmark(arguments):
+    simulator = None
+    rss = {"start": current_rss()}
+    if arguments.url is None:
+        simulator = InProcessSimulator(arguments)
+        simulator.start()
+        url = simulator.url
+        dns_address = simulator.dns_address
+    else:
+        url = arguments.url
+        dns_address = (arguments.dns_host, arguments.dns_port) if arguments.dns_port else None
+
+    try:
+        preload(arguments, url, simulator)
+        rss["loaded"] = current_rss()
+        records_before = simulator.record_count() if simulator is not None else None
+
+        clients = [Client(number + 1, arguments, url, dns_address) for number in range(arguments.concurrency)]
+        threads = [threading.Thread(target=client.run, args=(arguments.iterations,), name="bench-client-{}".format(client.number))
+                   for client in clients]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+
+        rss["end"] = current_rss()
+        records_after = simulator.record_count() if simulator is not None else None
+    finally:
+        if simulator is not None:
+            simulator.stop()
+
+    latencies = {operation: [value for client in clients for value in client.latencies[operation]] for operation in OPERATIONS}
+    errors = {operation: sum(client.errors[operation] for client in clients) for operation in OPERATIONS}
+    completed = len(latencies["Delete_DNS_Record"])
+    requests = sum(len(values) for operation, values in latencies.items() if operation != "DNS_Query")
+
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "config": {
+            "target": "in-process" if simulator is not None else url,
+            "fast_soap": arguments.fast_soap,
+            "dns": dns_address is not None,
+            "concurrency": arguments.concurrency,
+            "iterations": arguments.iterations,
+            "zone_size": arguments.zone_size,
+            },
+        "duration_s": round(duration, 3),
+        "workloads": completed,
+        "workloads_per_second": round(completed / duration, 2) if duration else None,
+        "requests_per_second": round(requests / duration, 2) if duration else None,
+        "errors": sum(errors.values()),
+        "failures": [failure for client in clients for failure in client.failures][:5],
+        "operations": summarize(latencies, errors, duration),
+        # The memory of the in-process simulator (and the clients); unknown for
+        # a simulator running elsewhere
+        "memory": {
+            "rss_start_bytes": rss["start"],
+            "rss_loaded_bytes": rss["loaded"],
+            "rss_end_bytes": rss["end"],
+            "growth_bytes": rss["end"] - rss["loaded"],
+            "records_before": records_before,
+            "records_after": records_after,
+            } if simulator is not None else None,
+        }
+
+def main():
+    arguments = parse_command_line()
+    report = benchmark(arguments)
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if arguments.output == "-":
+        sys.stdout.write(text)
+    else:
+        with open(arguments.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    return 1 if report["errors"] else 0
+
+def run():
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        sys.exit(main())
+    except (OSError, BenchmarkError) as e:
+        log.error("Benchmark failed: {}".format(e))
+        sys.exit(2)
+
+if __name__ == '__main__':
+    run()
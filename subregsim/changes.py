@@ -0,0 +1,222 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+import collections
+import json
+import logging
+import threading
+import time
+import urllib.parse
+
+log = logging.getLogger(__name__)
+
+# Limits of the long-poll requests
+DEFAULT_TIMEOUT = 30
+MAX_TIMEOUT = 300
+DEFAULT_LIMIT = 1000
+# Seconds between the comments keeping idle event streams open
+HEARTBEAT_INTERVAL = 15
+
+def as_event(change):
+    """Returns the change feed event of the Api change, or None for changes without serial."""
+    if "sn" not in change:
+        return None
+
+    event = {"sn": change["sn"], "op": change["op"], "domain": change["domain"]}
+    if change["op"] in ("add", "modify"):
+        event["record"] = change["record"].as_dict()
+        if change["op"] == "modify":
+            event["previous"] = change["previous"].as_dict()
+    elif change["op"] == "delete":
+        event["record"] = change["previous"].as_dict()
+    else:
+        # All records of the domain replaced, watchers read the zone again
+        event["records"] = len(change["records"])
+    return event
+
+class ChangeFeed(object):
+    """
+    Bounded log of the record changes of the Api, tagged with the serial
+    (Api.sn) of every change. Watchers ask for the changes after the last
+    serial they have seen and wait until there are some, instead of polling
+    the whole zone.
+
+    The Api publishes the changes in the order of their serials, so the log
+    is ordered. Watchers behind the oldest change kept (or ahead of the Api,
+    e.g. after a restart) are told that they missed changes.
+    """
+
+    def __init__(self, api, size=10000):
+        self.events = collections.deque(maxlen=size)
+        self.condition = threading.Condition()
+        # Serial of the last change, and the serial after which all changes
+        # are kept
+        self.sn = api.sn
+        self.start_sn = api.sn
+        self.closed = False
+        api.listeners.append(self.api_changed)
+
+    def api_changed(self, change):
+        event = as_event(change)
+        if event is None:
+            return
+
+        with self.condition:
+            if len(self.events) == self.events.maxlen:
+                self.start_sn = self.events[0]["sn"]
+            self.events.append(event)
+            self.sn = event["sn"]
+            self.condition.notify_all()
+
+    def collect(self, since, domain, limit):
+        # Changes are ordered, so only the new ones are visited
+        events = []
+        for event in reversed(self.events):
+            if event["sn"] <= since:
+                break
+            if domain is None or event["domain"] == domain:
+                events.append(event)
+        events.reverse()
+
+        if len(events) > limit:
+            # Changes sharing the serial of the last one are never split
+            last_sn = events[limit - 1]["sn"]
+            while limit < len(events) and events[limit]["sn"] == last_sn:
+                limit += 1
+            if limit < len(events):
+                return events[:limit], last_sn
+        return events, self.sn
+
+    def changes(self, since=None, timeout=0, domain=None, limit=DEFAULT_LIMIT):
+        """
+        Returns {"sn": ..., "truncated": ..., "changes": [...]} with the
+        changes after the serial since (of the domain only, if given), waiting
+        up to timeout seconds for the first one. The returned serial is the
+        one to ask the next changes after. When truncated, changes were
+        missed: the watcher should read the zones again and continue after the
+        returned serial. Returns None once the feed is closed.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            if since is None:
+                since = self.sn
+            while not self.closed:
+                if since < self.start_sn or since > self.sn:
+                    return {"sn": self.sn, "truncated": True, "changes": []}
+
+                events, sn = self.collect(since, domain, limit)
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return {"sn": sn, "truncated": False, "changes": events}
+
+                self.condition.wait(remaining)
+                # Changes of other domains are skipped the next time
+                since = sn
+            return None
+
+    def close(self):
+        """Releases all watchers, so that the servers can stop."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class BlockingResponse(object):
+    """
+    Response iterable which blocks while waiting for changes. The asyncio
+    server iterates responses with the blocking attribute in a thread.
+    """
+
+    blocking = True
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        try:
+            self.chunks.close()
+        except ValueError:
+            # Still waiting in another thread, it stops with the feed
+            pass
+
+class ChangeFeedApplication(object):
+    """
+    WSGI middleware answering GET /changes from the change feed, and passing
+    anything else to the wrapped application. Query parameters:
+
+    since     serial after which the changes are returned (defaults to the
+              current serial, waiting for the next change)
+    timeout   seconds to wait for a change (defaults to 30, 0 returns at once)
+    domain    returns the changes of the domain only
+    limit     maximum number of changes returned at once (defaults to 1000)
+
+    The changes are returned as one JSON document, or as a stream of
+    Server-Sent Events when the client accepts text/event-stream. Event
+    streams continue after the Last-Event-ID header, if given.
+    """
+
+    def __init__(self, app, feed, path="/changes"):
+        self.app = app
+        self.feed = feed
+        self.path = path
+
+    def __call__(self, req_env, start_response):
+        if req_env["PATH_INFO"] != self.path or req_env["REQUEST_METHOD"].upper() != "GET":
+            return self.app(req_env, start_response)
+
+        query = urllib.parse.parse_qs(req_env.get("QUERY_STRING", ""))
+        try:
+            since = req_env.get("HTTP_LAST_EVENT_ID") or query.get("since", [None])[0]
+            since = int(since) if since is not None else None
+            timeout = min(max(float(query.get("timeout", [DEFAULT_TIMEOUT])[0]), 0), MAX_TIMEOUT)
+            limit = max(int(query.get("limit", [DEFAULT_LIMIT])[0]), 1)
+        except ValueError:
+            return self.respond(start_response, "400 Bad Request", {"status": "error", "error": "Invalid query parameter"})
+        domain = query.get("domain", [None])[0]
+
+        if "text/event-stream" in req_env.get("HTTP_ACCEPT", ""):
+            return BlockingResponse(self.stream(start_response, since, domain, limit))
+        return BlockingResponse(self.poll(start_response, since, timeout, domain, limit))
+
+    @staticmethod
+    def respond(start_response, status, result):
+        body = json.dumps(result).encode("utf-8")
+        start_response(status, [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+            ("Cache-Control", "no-cache"),
+            ])
+        return [body]
+
+    def poll(self, start_response, since, timeout, domain, limit):
+        result = self.feed.changes(since, timeout, domain, limit)
+        if result is None:
+            yield from self.respond(start_response, "503 Service Unavailable", {"status": "error", "error": "Server is stopping"})
+            return
+        result["status"] = "ok"
+        yield from self.respond(start_response, "200 OK", result)
+
+    def stream(self, start_response, since, domain, limit):
+        start_response("200 OK", [
+            ("Content-Type", "text/event-stream; charset=utf-8"),
+            ("Cache-Control", "no-cache"),
+            ])
+        # Sent at once, so that the client knows the stream is open
+        yield b": subregsim change feed\n\n"
+
+        while True:
+            result = self.feed.changes(since, HEARTBEAT_INTERVAL, domain, limit)
+            if result is None:
+                break
+            since = result["sn"]
+            if result["truncated"]:
+                yield "id: {}\nevent: truncated\ndata: {}\n\n".format(since, json.dumps({"sn": since})).encode("utf-8")
+            elif result["changes"]:
+                yield "".join("id: {}\nevent: {}\ndata: {}\n\n".format(event["sn"], event["op"], json.dumps(event))
+                              for event in result["changes"]).encode("utf-8")
+            else:
+                yield b": keep-alive\n\n"
@@ -0,0 +1,71 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+# Patches of the runtime needed by Spyne, imported before Spyne itself (see
+# service)
+
+from __future__ import (absolute_import, print_function)
+from email.message import Message
+import importlib.util
+import pathlib
+import re
+import sys
+import warnings
+from importlib import metadata
+
+
+if sys.version_info >= (3, 13):
+    import collections
+    import types
+    from collections import abc
+
+    # Spyne 2.14 still expects stdlib aliases and helper modules removed in
+    # newer Python releases, so patch them for Python 3.13+ runtimes.
+    if sys.version_info[:2] <= (3, 14):
+        original_showwarning = warnings.showwarning
+
+
+        def showwarning(message, category, filename, lineno, file=None, line=None):
+            if (
+                category is SyntaxWarning
+                and "invalid escape sequence" in str(message)
+                and re.search(r"spyne[\\/]+protocol[\\/]http\.py$", filename)
+            ):
+                return
+            return original_showwarning(message, category, filename, lineno, file=file, line=line)
+
+
+        warnings.showwarning = showwarning
+
+    def parse_header(value):
+        message = Message()
+        message["content-type"] = value
+        return message.get_content_type(), dict(message.get_params()[1:])
+
+
+    collections.Iterable = abc.Iterable
+    collections.Mapping = abc.Mapping
+    collections.MutableMapping = abc.MutableMapping
+    collections.MutableSet = abc.MutableSet
+    cgi_module = types.ModuleType("cgi")
+    cgi_module.parse_header = parse_header
+    sys.modules.setdefault("cgi", cgi_module)
+
+    if "spyne.util.six" not in sys.modules:
+        # Resolve the installed Spyne package location from distribution
+        # metadata so this works in both local uv environments and containers.
+        spyne_dist = metadata.distribution("spyne")
+        spyne_six_path = pathlib.Path(spyne_dist.locate_file("spyne/util/six.py"))
+        spec = importlib.util.spec_from_file_location("spyne.util.six", spyne_six_path)
+        spyne_six = importlib.util.module_from_spec(spec)
+        sys.modules["spyne.util.six"] = spyne_six
+        spec.loader.exec_module(spyne_six)
+    else:
+        spyne_six = sys.modules["spyne.util.six"]
+
+    spyne_six._importer.load_module("spyne.util.six.moves")
+    spyne_six._importer.load_module("spyne.util.six.moves.collections_abc")
+    spyne_six._importer.load_module("spyne.util.six.moves.http_cookies")
+    spyne_six._importer.load_module("spyne.util.six.moves.urllib")
+    spyne_six._importer.load_module("spyne.util.six.moves.urllib.parse")
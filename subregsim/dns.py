@@ -3,21 +3,624 @@ Subreg.cz API simulator suitable for Python lexicon module.
 '''
 
 from __future__ import (absolute_import, print_function)
+import collections
+import itertools
 import logging
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+import dnslib
 import dnslib.server
-import dnslib.zoneresolver
 
 log = logging.getLogger(__name__)
 
+def address_family(host, port):
+    """
+    Returns the socket family for the host: IPv4 if the host has an IPv4
+    address (e.g. localhost), IPv6 otherwise (e.g. ::1).
+    """
+    try:
+        families = [info[0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM, flags=socket.AI_PASSIVE)]
+    except socket.gaierror:
+        families = []
+    if socket.AF_INET in families or not (families or ":" in host):
+        return socket.AF_INET
+    return socket.AF_INET6
+
 class ApiDnsResolver(dnslib.server.BaseResolver):
+    """
+    Answers queries directly from the Api record index, so the cost of a query
+    does not depend on the number of simulated domains or records.
+
+    Records are parsed to dnslib records once, the parsed records are kept by
+    record ID until the Api changes replace the records.
+    """
+
     def __init__(self, api):
         dnslib.server.BaseResolver.__init__(self)
         self.api = api
+        # Record ID -> (record, parsed record). The record is kept to check
+        # that the entry is still current, as records are replaced on change.
+        self.parsed = {}
+        self.api.listeners.append(self.api_changed)
+
+    def api_changed(self, change):
+        if "previous" in change:
+            self.parsed.pop(change["previous"].id, None)
+        elif change["op"] == "reset":
+            # Records of the domain are unknown here, the zone is replaced
+            # rarely
+            self.parsed.clear()
+
+    def to_rr(self, rr, rname=None):
+        entry = self.parsed.get(rr.id)
+        if entry is not None and entry[0] is rr:
+            parsed = entry[1]
+        else:
+            try:
+                parsed = dnslib.RR.fromZone(self.api.zone_record(rr), ttl=1800)[0]
+            except Exception:
+                log.warning("Unable to serve record {} {} {}".format(rr.name, rr.type, rr.content))
+                return None
+            self.parsed[rr.id] = (rr, parsed)
+        if rname is not None:
+            # The parsed record is shared, answers of other names get a copy
+            parsed = dnslib.RR(rname, parsed.rtype, parsed.rclass, parsed.ttl, parsed.rdata)
+        return parsed
+
+    def find_records(self, domain, name, qtype):
+        records = self.api.lookup(domain, name, qtype)
+        if records or self.api.has_name(domain, name):
+            return records
+
+        # Wildcard match, closest enclosing name first
+        labels = name.split(".")
+        for i in range(1, len(labels) - self.api.index_name(domain).count(".")):
+            records = self.api.lookup(domain, "*." + ".".join(labels[i:]), qtype)
+            if records:
+                return records
+
+        return []
+
+    def add_additional(self, reply, answer):
+        target = str(answer.rdata.label)
+        domain = self.api.find_domain(target)
+        if domain is None:
+            return
+
+        for rr in self.api.lookup(domain, target, "ANY"):
+            if rr.type in ("A", "AAAA"):
+                additional = self.to_rr(rr)
+                if additional is not None:
+                    reply.add_ar(additional)
 
     def resolve(self, request, handler):
-        resolver = dnslib.zoneresolver.ZoneResolver(self.api.toZone(), True)
-        return resolver.resolve(request, handler)
+        reply = request.reply()
+        qname = request.q.qname
+        qtype = dnslib.QTYPE[request.q.qtype]
+
+        domain = self.api.find_domain(str(qname))
+        if domain is not None:
+            name = self.api.index_name(str(qname))
+
+            if name == self.api.index_name(domain) and qtype in ("SOA", "ANY"):
+                soa = dnslib.RR.fromZone(self.api.zone_soa(domain, self.api.sn), ttl=1800)[0]
+                soa.rname = qname
+                reply.add_answer(soa)
+
+            for rr in self.find_records(domain, name, qtype):
+                answer = self.to_rr(rr, qname)
+                if answer is None:
+                    continue
+                reply.add_answer(answer)
+                if rr.type in ("CNAME", "NS", "MX", "PTR"):
+                    self.add_additional(reply, answer)
+
+        if not reply.rr:
+            reply.header.rcode = dnslib.RCODE.NXDOMAIN
+        return reply
+
+ZONE_TRANSFER_QTYPES = (b"\x00\xfb", b"\x00\xfc")
+
+class DnsResponder(object):
+    """
+    Answers DNS request packets with packets. Answers of plain queries are
+    cached in wire format, keyed by the request flags and question bytes, so a
+    repeated query costs a dictionary lookup and copying its transaction ID.
+    Other requests, and queries not answered yet, are parsed and resolved by
+    the resolver.
+
+    The cache is invalidated by the Api changes: a change drops the answers
+    depending on the changed domain (including additional records taken from
+    it) and all answers with the SOA record, whose serial number is shared by
+    all domains. Adding or removing domains drops all answers.
+    """
+
+    MAX_ANSWERS = 100000
+
+    def __init__(self, resolver, metrics=None, journal_size=1000):
+        self.resolver = resolver
+        self.api = resolver.api
+        self.metrics = metrics
+        self.transfer = ZoneTransfer(resolver, journal_size)
+        # Answers by maximum packet length, as request flags and question ->
+        # reply packet
+        self.answers = {}
+        # Cached answers depending on the domain, and on the serial number,
+        # as (answers, key) pairs
+        self.domain_keys = {}
+        self.serial_keys = []
+        self.count = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.api.listeners.append(self.api_changed)
+
+    def api_changed(self, change):
+        with self.lock:
+            self.generation += 1
+            if change["op"] in ("add_domain", "remove_domain"):
+                self.clear()
+                return
+            for answers, key in self.domain_keys.pop(change["domain"], ()):
+                answers.pop(key, None)
+            for answers, key in self.serial_keys:
+                answers.pop(key, None)
+            self.serial_keys = []
+
+    def clear(self):
+        for answers in self.answers.values():
+            answers.clear()
+        self.domain_keys = {}
+        self.serial_keys = []
+        self.count = 0
+
+    @staticmethod
+    def cache_key(data):
+        """Returns the cache key of a plain query with one question, or None."""
+        # Standard query with one question and no answer or authority records,
+        # additional records (EDNS) do not change the answer
+        if len(data) < 17 or data[2] & 0xf8 or data[4:10] != b"\x00\x01\x00\x00\x00\x00":
+            return None
+        position = 12
+        length = data[position]
+        while length:
+            if length > 63:
+                return None
+            position += length + 1
+            if position >= len(data):
+                return None
+            length = data[position]
+        end = position + 5
+        if end > len(data) or data[end - 4:end - 2] in ZONE_TRANSFER_QTYPES:
+            return None
+        return data[2:4] + data[12:end]
+
+    def respond(self, data, max_length=None):
+        """Returns the reply packet to the request packet, or None."""
+        if self.metrics is None:
+            return self.answer(data, max_length)
+
+        start = time.perf_counter()
+        try:
+            return self.answer(data, max_length)
+        finally:
+            self.metrics.dns_duration.observe(time.perf_counter() - start)
+
+    def respond_cached(self, data, max_length=None):
+        """
+        Returns the cached reply packet to the request packet, or None when
+        the request needs respond(). Never waits for the Api locks.
+        """
+        if self.metrics is None:
+            return self.cached(data, max_length)
+
+        start = time.perf_counter()
+        packet = self.cached(data, max_length)
+        if packet is not None:
+            self.metrics.dns_duration.observe(time.perf_counter() - start)
+        return packet
+
+    def cached(self, data, max_length):
+        key = self.cache_key(data)
+        answers = self.answers.get(max_length)
+        if key is not None and answers is not None:
+            packet = answers.get(key)
+            if packet is not None:
+                return data[:2] + packet[2:]
+        return None
+
+    def answer(self, data, max_length):
+        packet = self.cached(data, max_length)
+        if packet is not None:
+            return packet
+
+        key = self.cache_key(data)
+        generation = self.generation
+        try:
+            request = dnslib.DNSRecord.parse(data)
+        except dnslib.DNSError as e:
+            log.warning("Invalid DNS request: {}".format(e))
+            return None
+
+        try:
+            if request.q.qtype in (dnslib.QTYPE.AXFR, dnslib.QTYPE.IXFR):
+                # Transfers do not fit into one datagram
+                reply = self.transfer.datagram_reply(request)
+                key = None
+            else:
+                reply = self.resolver.resolve(request, None)
+        except Exception:
+            log.exception("DNS request handling failed")
+            reply = request.reply()
+            reply.header.rcode = dnslib.RCODE.SERVFAIL
+            key = None
+
+        packet = bytes(reply.pack())
+        if max_length is not None and len(packet) > max_length:
+            packet = bytes(reply.truncate().pack())
+
+        if key is not None:
+            self.store(key, max_length, packet, reply, generation)
+        return packet
+
+    def respond_stream(self, data):
+        """Yields the reply packets to the request packet received over a stream (TCP), zone transfers take several."""
+        if self.cache_key(data) is None and len(data) >= 12 and not data[2] & 0xf8:
+            try:
+                request = dnslib.DNSRecord.parse(data)
+            except dnslib.DNSError:
+                request = None
+            if request is not None and len(request.questions) == 1 and request.q.qtype in (dnslib.QTYPE.AXFR, dnslib.QTYPE.IXFR):
+                for reply in self.transfer.replies(request):
+                    yield bytes(reply.pack())
+                return
+
+        packet = self.respond(data)
+        if packet is not None:
+            yield packet
+
+    def store(self, key, max_length, packet, reply, generation):
+        domains = {self.api.find_domain(str(reply.q.qname))}
+        domains.update(self.api.find_domain(str(rr.rname)) for rr in reply.ar)
+        serial = any(rr.rtype == dnslib.QTYPE.SOA for rr in reply.rr)
+
+        with self.lock:
+            # The Api changed while resolving, the reply may be outdated
+            if generation != self.generation:
+                return
+            if self.count >= self.MAX_ANSWERS:
+                self.clear()
+            answers = self.answers.setdefault(max_length, {})
+            if key in answers:
+                return
+            answers[key] = packet
+            self.count += 1
+            for domain in domains:
+                self.domain_keys.setdefault(domain, []).append((answers, key))
+            if serial:
+                self.serial_keys.append((answers, key))
+
+class ZoneTransfer(object):
+    """
+    Answers zone transfer (AXFR and IXFR) requests of the simulated zones.
+
+    The zones are versioned by the Api serial number, which is shared by all
+    domains. The changes of every domain are kept in a bounded journal (an Api
+    listener), so that IXFR sends just the differences since the serial
+    number of the secondary server. Secondaries older than the journal, and
+    zones replaced as a whole, get the full zone.
+    """
+
+    # Records per message of the transfer
+    MESSAGE_RECORDS = 100
+
+    def __init__(self, resolver, journal_size=1000):
+        self.resolver = resolver
+        self.api = resolver.api
+        self.journal_size = journal_size
+        # Changes of every domain as (sn, deleted records, added records),
+        # complete for serial numbers from the base serial number of the
+        # domain on. Changed only with the domain lock held.
+        self.journals = {}
+        self.bases = {}
+        self.start_sn = self.api.sn
+        self.api.listeners.append(self.api_changed)
+
+    def api_changed(self, change):
+        domain = change["domain"]
+        op = change["op"]
+        if op in ("add", "modify", "delete") and self.journal_size > 0:
+            journal = self.journals.get(domain)
+            if journal is None:
+                journal = self.journals[domain] = collections.deque()
+            deleted = [change["previous"]] if "previous" in change else []
+            added = [change["record"]] if op != "delete" else []
+            journal.append((change["sn"], deleted, added))
+            if len(journal) > self.journal_size:
+                # Changes of the dropped serial number may be incomplete now
+                self.bases[domain] = journal.popleft()[0]
+        else:
+            # Zone replaced, added or removed; secondaries need the full zone
+            self.journals.pop(domain, None)
+            self.bases[domain] = change.get("sn", self.api.sn)
+
+    def soa(self, domain, sn):
+        return dnslib.RR.fromZone(self.api.zone_soa(domain, sn), ttl=1800)[0]
+
+    def to_rrs(self, records):
+        for rr in records:
+            parsed = self.resolver.to_rr(rr)
+            if parsed is not None:
+                yield parsed
+
+    def find_zone(self, request):
+        """Returns the simulated domain the request asks for, or None."""
+        domain = self.api.find_domain(str(request.q.qname))
+        if domain is None or self.api.index_name(str(request.q.qname)) != self.api.index_name(domain):
+            return None
+        return domain
+
+    def client_serial(self, request):
+        for rr in request.auth:
+            if rr.rtype == dnslib.QTYPE.SOA:
+                return rr.rdata.times[0]
+        return None
+
+    def datagram_reply(self, request):
+        """Answers a transfer over UDP: the current SOA record tells IXFR clients to use TCP."""
+        reply = request.reply()
+        domain = self.find_zone(request)
+        if domain is None:
+            reply.header.rcode = dnslib.RCODE.NOTAUTH
+        elif request.q.qtype == dnslib.QTYPE.AXFR:
+            reply.header.rcode = dnslib.RCODE.REFUSED
+        else:
+            reply.add_answer(self.soa(domain, self.api.sn))
+        return reply
+
+    def replies(self, request):
+        """Yields the reply messages of the transfer request."""
+        domain = self.find_zone(request)
+        if domain is None:
+            reply = request.reply()
+            reply.header.rcode = dnslib.RCODE.NOTAUTH
+            yield reply
+            return
+
+        client_serial = self.client_serial(request) if request.q.qtype == dnslib.QTYPE.IXFR else None
+        # The domain lock makes sure that no change of the domain is half-way,
+        # so the zone (or journal) matches the serial number
+        with self.api.domain_locks[domain]:
+            sn = self.api.sn
+            if client_serial is not None and client_serial >= sn:
+                changes = ()
+            elif client_serial is not None and client_serial >= self.bases.get(domain, self.start_sn):
+                changes = [change for change in self.journals.get(domain, ()) if change[0] > client_serial]
+            else:
+                client_serial = None
+                records = list(self.api.db[domain].values())
+
+        soa = self.soa(domain, sn)
+        if client_serial is None:
+            log.info("Zone transfer of {} (serial {})".format(domain, sn))
+            rrs = itertools.chain((soa,), self.to_rrs(records), (soa,))
+        elif not changes:
+            rrs = iter((soa,))
+        else:
+            log.info("Incremental zone transfer of {} from serial {} to {}".format(domain, client_serial, sn))
+            rrs = itertools.chain((soa,), self.difference_rrs(domain, client_serial, changes), (soa,))
+
+        yield from self.messages(request, rrs)
+
+    def difference_rrs(self, domain, client_serial, changes):
+        """Yields the IXFR difference sequences, one per serial number."""
+        old_serial = client_serial
+        index = 0
+        while index < len(changes):
+            serial = changes[index][0]
+            deleted = []
+            added = []
+            while index < len(changes) and changes[index][0] == serial:
+                deleted.extend(changes[index][1])
+                added.extend(changes[index][2])
+                index += 1
+            yield self.soa(domain, old_serial)
+            yield from self.to_rrs(deleted)
+            yield self.soa(domain, serial)
+            yield from self.to_rrs(added)
+            old_serial = serial
+
+    def messages(self, request, rrs):
+        while True:
+            reply = request.reply()
+            for rr in itertools.islice(rrs, self.MESSAGE_RECORDS):
+                reply.add_answer(rr)
+            if not reply.rr:
+                return
+            yield reply
+
+class DnsNotifier(object):
+    """
+    Sends DNS NOTIFY messages to the secondary servers when zones change.
+    Changes are collected for a short delay, so that a burst of changes
+    results in a single NOTIFY of every changed zone.
+    """
+
+    DELAY = 1.0
+    TIMEOUT = 2.0
+    ATTEMPTS = 3
+
+    def __init__(self, api, targets):
+        self.api = api
+        self.targets = targets
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+        self.api.listeners.append(self.api_changed)
+
+    def api_changed(self, change):
+        if change["op"] == "remove_domain":
+            return
+        with self.lock:
+            self.pending.add(change["domain"])
+        self.wakeup.set()
+
+    def start_thread(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="dns-notify", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            # Does not wait for a NOTIFY being retried
+            self.thread.join(self.TIMEOUT)
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait()
+            if not self.running:
+                break
+            time.sleep(self.DELAY)
+            with self.lock:
+                self.wakeup.clear()
+                domains = self.pending
+                self.pending = set()
+            for domain in sorted(domains):
+                if domain in self.api.domains:
+                    for target in self.targets:
+                        self.notify(domain, target)
+
+    def notify(self, domain, target):
+        request = dnslib.DNSRecord(dnslib.DNSHeader(id=random.randint(0, 65535), opcode=dnslib.OPCODE.NOTIFY, aa=1),
+                                   q=dnslib.DNSQuestion(domain, dnslib.QTYPE.SOA))
+        request.add_answer(dnslib.RR.fromZone(self.api.zone_soa(domain, self.api.sn), ttl=1800)[0])
+        packet = request.pack()
+
+        with socket.socket(address_family(*target), socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.TIMEOUT)
+            for attempt in range(self.ATTEMPTS):
+                try:
+                    sock.sendto(packet, target)
+                    while True:
+                        data, _ = sock.recvfrom(65535)
+                        if data[:2] == packet[:2]:
+                            log.info("NOTIFY of {} acknowledged by {}:{}".format(domain, target[0], target[1]))
+                            return
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    log.warning("Unable to send NOTIFY of {} to {}:{}: {}".format(domain, target[0], target[1], e))
+                    return
+        log.warning("NOTIFY of {} not acknowledged by {}:{}".format(domain, target[0], target[1]))
+
+class DnsTcpHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.settimeout(self.server.idle_timeout)
+        rfile = self.request.makefile("rb")
+        try:
+            while True:
+                header = rfile.read(2)
+                if len(header) < 2:
+                    break
+                length = struct.unpack("!H", header)[0]
+                data = rfile.read(length)
+                if len(data) < length:
+                    break
+
+                replied = False
+                for packet in self.server.responder.respond_stream(data):
+                    self.request.sendall(struct.pack("!H", len(packet)) + packet)
+                    replied = True
+                if not replied:
+                    break
+        except (socket.timeout, ConnectionError):
+            pass
+        finally:
+            rfile.close()
+
+class DnsTcpServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    idle_timeout = 10
+
+    def __init__(self, address, responder):
+        self.address_family = address_family(*address)
+        socketserver.ThreadingTCPServer.__init__(self, address, DnsTcpHandler)
+        self.responder = responder
+
+class ApiDns(object):
+    """
+    DNS server answering UDP or TCP requests by the DnsResponder from a
+    background thread. UDP requests are answered directly by the receiving
+    thread, TCP connections get a thread each and may carry several requests.
+    """
+
+    def __init__(self, responder, address, port, tcp=False):
+        self.responder = responder
+        self.tcp = tcp
+        self.thread = None
+        self.running = False
+        if tcp:
+            self.server = DnsTcpServer((address, port), responder)
+            self.socket = self.server.socket
+        else:
+            self.server = None
+            self.socket = socket.socket(address_family(address, port), socket.SOCK_DGRAM)
+            try:
+                self.socket.bind((address, port))
+            except OSError:
+                self.socket.close()
+                raise
+        self.address = self.socket.getsockname()
+
+    def serve_udp(self):
+        sock = self.socket
+        respond = self.responder.respond
+        while self.running:
+            try:
+                data, client = sock.recvfrom(65535)
+            except OSError:
+                if not self.running:
+                    break
+                continue
+            if not self.running:
+                break
+            try:
+                packet = respond(data)
+            except Exception:
+                log.exception("DNS request handling from {} failed".format(client[0]))
+                continue
+            if packet is not None:
+                try:
+                    sock.sendto(packet, client)
+                except OSError as e:
+                    log.warning("Unable to send DNS reply to {}: {}".format(client[0], e))
+
+    def start_thread(self):
+        self.running = True
+        target = self.server.serve_forever if self.tcp else self.serve_udp
+        self.thread = threading.Thread(target=target, name="dns-tcp" if self.tcp else "dns-udp", daemon=True)
+        self.thread.start()
 
-class ApiDns(dnslib.server.DNSServer):
-    def __init__(self, resolver, address, port, tcp=False):
-        dnslib.server.DNSServer.__init__(self, resolver, address, port, tcp)
+    def stop(self):
+        self.running = False
+        if self.tcp:
+            self.server.shutdown()
+            self.server.server_close()
+        else:
+            # Wakes the receiving thread up
+            with socket.socket(self.socket.family, socket.SOCK_DGRAM) as waker:
+                try:
+                    waker.sendto(b"", self.address)
+                except OSError:
+                    pass
+            if self.thread is not None:
+                self.thread.join()
+            self.socket.close()
@@ -0,0 +1,252 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+import bisect
+import logging
+import multiprocessing
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# SOAP operations measured separately, anything else is counted as "other"
+OPERATIONS = ("Login", "Domains_List", "Get_DNS_Zone", "Add_DNS_Record", "Modify_DNS_Record", "Delete_DNS_Record", "other")
+OPERATION_KEY = "subregsim.operation"
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOCK_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                             for name, value in labels)
+
+def format_value(value):
+    return repr(int(value)) if value == int(value) else repr(value)
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets and an optional label with a fixed set of
+    values. Counts are kept in shared memory, one slot per server process, so
+    that forked processes update their own slot without locking each other,
+    and any process can report the sum of all slots.
+    """
+
+    def __init__(self, name, help, buckets, slots, label=None, label_values=(None,)):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.slots = slots
+        self.label = label
+        self.label_values = tuple(label_values)
+        self.label_index = {value: index for index, value in enumerate(self.label_values)}
+        # Per slot and label value: counts of the buckets, +Inf bucket and sum
+        self.width = len(self.buckets) + 2
+        self.values = multiprocessing.RawArray("d", slots * len(self.label_values) * self.width)
+        self.lock = threading.Lock()
+        self.offset = 0
+
+    def select_slot(self, slot):
+        self.offset = slot * len(self.label_values) * self.width
+
+    def observe(self, value, label_value=None):
+        base = self.offset + self.label_index[label_value] * self.width
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.values[base + bucket] += 1
+            self.values[base + self.width - 1] += value
+
+    def collect(self):
+        """Returns (label value, cumulative bucket counts, sum) summed over all slots."""
+        values = self.values[:]
+        for index, label_value in enumerate(self.label_values):
+            totals = [0.0] * self.width
+            for slot in range(self.slots):
+                base = (slot * len(self.label_values) + index) * self.width
+                for i in range(self.width):
+                    totals[i] += values[base + i]
+            cumulative = []
+            count = 0
+            for bucket_count in totals[:-1]:
+                count += bucket_count
+                cumulative.append(count)
+            yield label_value, cumulative, totals[-1]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        for label_value, cumulative, total in self.collect():
+            labels = [(self.label, label_value)] if self.label else []
+            for bound, count in zip(self.buckets + ("+Inf",), cumulative):
+                lines.append("{}_bucket{} {}".format(self.name, format_labels(labels + [("le", bound)]), format_value(count)))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(labels), format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, format_labels(labels), format_value(cumulative[-1])))
+        return lines
+
+class Gauge(object):
+    """Gauge kept in shared memory, one slot per server process, reported as the sum of all slots."""
+
+    def __init__(self, name, help, slots):
+        self.name = name
+        self.help = help
+        self.values = multiprocessing.RawArray("d", slots)
+        self.lock = threading.Lock()
+        self.slot = 0
+
+    def select_slot(self, slot):
+        self.slot = slot
+
+    def add(self, value):
+        with self.lock:
+            self.values[self.slot] += value
+
+    def render(self):
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} gauge".format(self.name),
+                "{} {}".format(self.name, format_value(sum(self.values[:])))]
+
+class TimedLock(object):
+    """Lock recording how long it is waited for and held."""
+
+    def __init__(self, lock, wait, hold, name):
+        self.lock = lock
+        self.wait = wait
+        self.hold = hold
+        self.name = name
+        # Written and read only by the holder of the lock
+        self.waited = 0
+        self.acquired = 0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+        self.waited = self.acquired - start
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        held = time.perf_counter() - self.acquired
+        waited = self.waited
+        self.lock.release()
+        self.wait.observe(waited, self.name)
+        self.hold.observe(held, self.name)
+
+class Metrics(object):
+    """
+    Metrics of the simulator in the Prometheus text format. Recording is
+    limited to a few counter updates; record counts, sessions and threads are
+    read from the Api only when the metrics are reported.
+
+    All processes of a prefork server share the metrics: they are created
+    before the processes are forked, and every process calls select_slot()
+    with its own slot number (0 being the process holding the Api).
+    """
+
+    LOCKS = ("db",)
+
+    def __init__(self, slots=1):
+        self.slots = slots
+        self.request_duration = Histogram(
+            "subregsim_request_duration_seconds", "Time spent answering HTTP requests by SOAP operation.",
+            LATENCY_BUCKETS, slots, "operation", OPERATIONS)
+        self.requests_in_progress = Gauge(
+            "subregsim_requests_in_progress", "HTTP requests being answered.", slots)
+        self.dns_duration = Histogram(
+            "subregsim_dns_resolve_duration_seconds", "Time spent resolving DNS queries.",
+            LATENCY_BUCKETS, slots)
+        self.lock_wait = Histogram(
+            "subregsim_lock_wait_seconds", "Time spent waiting for Api locks.",
+            LOCK_BUCKETS, slots, "lock", self.LOCKS)
+        self.lock_hold = Histogram(
+            "subregsim_lock_hold_seconds", "Time Api locks were held.",
+            LOCK_BUCKETS, slots, "lock", self.LOCKS)
+        self.collectors = (self.request_duration, self.requests_in_progress, self.dns_duration, self.lock_wait, self.lock_hold)
+
+    def select_slot(self, slot):
+        for collector in self.collectors:
+            collector.select_slot(slot)
+
+    def timed_lock(self, name, lock):
+        return TimedLock(lock, self.lock_wait, self.lock_hold, name)
+
+    def render(self, api):
+        lines = []
+        for collector in self.collectors:
+            lines.extend(collector.render())
+
+        statistics = api.statistics()
+        lines.extend([
+            "# HELP subregsim_threads Threads of the process holding the Api.",
+            "# TYPE subregsim_threads gauge",
+            "subregsim_threads {}".format(statistics["threads"]),
+            "# HELP subregsim_sessions Logged-in sessions.",
+            "# TYPE subregsim_sessions gauge",
+            "subregsim_sessions {}".format(statistics["sessions"]),
+            "# HELP subregsim_serial Serial number of the zones.",
+            "# TYPE subregsim_serial gauge",
+            "subregsim_serial {}".format(statistics["serial"]),
+            "# HELP subregsim_records Records of the simulated domain.",
+            "# TYPE subregsim_records gauge",
+            ])
+        lines.extend("subregsim_records{} {}".format(format_labels([("domain", domain)]), count)
+                     for domain, count in statistics["records"].items())
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+class TimedResponse(object):
+    """Response iterable recording the request duration once the response is sent."""
+
+    def __init__(self, result, metrics, req_env, start):
+        self.result = result
+        self.metrics = metrics
+        self.req_env = req_env
+        self.start = start
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def __len__(self):
+        # Lets the server count the blocks of list responses
+        return len(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            self.metrics.requests_in_progress.add(-1)
+            self.metrics.request_duration.observe(time.perf_counter() - self.start,
+                                                  self.req_env.get(OPERATION_KEY, "other"))
+
+class MetricsApplication(object):
+    """
+    WSGI middleware measuring the requests of the wrapped application and
+    answering GET /metrics. The wrapped application names the SOAP operation
+    in the OPERATION_KEY environ item.
+    """
+
+    def __init__(self, app, api, metrics, path="/metrics"):
+        self.app = app
+        self.api = api
+        self.metrics = metrics
+        self.path = path
+
+    def __call__(self, req_env, start_response):
+        if req_env["PATH_INFO"] == self.path and req_env["REQUEST_METHOD"].upper() in ("GET", "HEAD"):
+            body = self.metrics.render(self.api)
+            start_response("200 OK", [
+                ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+                ("Content-Length", str(len(body))),
+                ])
+            return [body] if req_env["REQUEST_METHOD"].upper() == "GET" else []
+
+        start = time.perf_counter()
+        self.metrics.requests_in_progress.add(1)
+        try:
+            result = self.app(req_env, start_response)
+        except BaseException:
+            self.metrics.requests_in_progress.add(-1)
+            self.metrics.request_duration.observe(time.perf_counter() - start, req_env.get(OPERATION_KEY, "other"))
+            raise
+        return TimedResponse(result, self.metrics, req_env, start)
@@ -0,0 +1,109 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+import logging
+import os
+import signal
+import sys
+import threading
+from multiprocessing.managers import BaseManager
+
+log = logging.getLogger(__name__)
+
+API_METHODS = ("login", "domains_list", "get_dns_zone", "add_dns_record", "modify_dns_record", "delete_dns_record", "statistics")
+
+class ApiManager(BaseManager):
+    pass
+
+class ApiPreforkServer(object):
+    """
+    Serves the API by several forked processes, so that the SOAP processing is
+    not limited to a single core. Every process listens on the same port
+    (SO_REUSEPORT) and the kernel spreads the connections among them.
+
+    The Api stays in the parent process, which serves it to the children over
+    a local socket, so all processes share the records, serial numbers, record
+    identifiers and sessions. The parent process also keeps serving DNS from
+    the same Api.
+
+    The processes are forked from the constructor, before the caller starts
+    any thread. create_server is called in every process with the Api proxy,
+    the process number (starting with 1) and the proxy of the optional
+    changes.ChangeFeed. Requires a platform with fork().
+    """
+
+    def __init__(self, api, processes, create_server, change_feed=None):
+        self.api = api
+        self.change_feed = change_feed
+        self.processes = processes
+        self.create_server = create_server
+        self.children = []
+        self.authkey = os.urandom(32)
+
+        ApiManager.register("Api", callable=lambda: self.api, exposed=API_METHODS)
+        ApiManager.register("ChangeFeed", callable=lambda: self.change_feed, exposed=("changes",))
+        self.manager_server = ApiManager(authkey=self.authkey).get_server()
+
+        for index in range(processes):
+            pid = os.fork()
+            if pid == 0:
+                self.run_child(index + 1)
+            self.children.append(pid)
+
+    def run_child(self, index):
+        # Stopped by the parent with SIGTERM, which closes the server like
+        # Ctrl-C does
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        status = 1
+        try:
+            manager = ApiManager(address=self.manager_server.address, authkey=self.authkey)
+            manager.connect()
+            change_feed = manager.ChangeFeed() if self.change_feed is not None else None
+            httpd = self.create_server(manager.Api(), index, change_feed)
+            log.info("Server process {} (pid {}) started".format(index, os.getpid()))
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                httpd.server_close()
+            status = 0
+        except Exception:
+            log.exception("Server process {} failed".format(index))
+        finally:
+            # Skip the clean-up inherited from the parent process, it would
+            # remove the parent's Api socket
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def serve_forever(self):
+        thread = threading.Thread(target=self.manager_server.serve_forever, name="api-manager", daemon=True)
+        thread.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            pid, status = os.wait()
+            self.children.remove(pid)
+            log.error("Server process (pid {}) terminated with status {}, stopping".format(pid, os.waitstatus_to_exitcode(status)))
+        finally:
+            self.stop_children()
+
+    def stop_children(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.children = []
+
+    def server_close(self):
+        self.stop_children()
+        self.manager_server.stop_event.set()
@@ -0,0 +1,141 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+
+# The real subreg.cz WSDL splits the namespaces: the service lives in
+# WSDL_NS, request and response elements in TYPES_NS
+WSDL_NS = "http://subreg.cz/wsdl"
+TYPES_NS = "http://subreg.cz/types"
+
+INTEGER = "integer"
+STRING = "string"
+UNBOUNDED = "unbounded"
+
+class ComplexType(object):
+    """
+    Complex type of the SOAP messages, described without Spyne so that the
+    fast SOAP path does not need to import it. The Spyne models are built
+    from the same description (see service.model()).
+
+    Members are (name, type, min_occurs, max_occurs) tuples, the type being
+    INTEGER, STRING or another ComplexType, max_occurs being 1 or UNBOUNDED.
+    """
+
+    def __init__(self, name, members=()):
+        self.name = name
+        self.members = list(members)
+
+def required(name, type):
+    return (name, type, 1, 1)
+
+def optional(name, type):
+    return (name, type, 0, 1)
+
+def repeated(name, type):
+    return (name, type, 0, UNBOUNDED)
+
+def response(operation, data):
+    """Returns the <operation>_Container type of the response with the given data type."""
+    return ComplexType(operation + "_Container", [
+        required("response", ComplexType(operation + "_Response", [
+            required("status", STRING),
+            optional("data", data),
+            optional("error", ERROR_INFO),
+            ])),
+        ])
+
+ERROR_CODE = ComplexType("Error_Code", [
+    required("major", INTEGER),
+    required("minor", INTEGER),
+    ])
+
+ERROR_INFO = ComplexType("Error_Info", [
+    required("errormsg", STRING),
+    required("errorcode", ERROR_CODE),
+    ])
+
+LOGIN_CONTAINER = response("Login", ComplexType("Login_Data", [
+    required("ssid", STRING),
+    ]))
+
+GET_DNS_ZONE_RECORD = ComplexType("Get_DNS_Zone_Record", [
+    required("id", INTEGER),
+    required("name", STRING),
+    required("type", STRING),
+    optional("content", STRING),
+    optional("prio", INTEGER),
+    optional("ttl", INTEGER),
+    ])
+
+GET_DNS_ZONE_CONTAINER = response("Get_DNS_Zone", ComplexType("Get_DNS_Zone_Data", [
+    required("domain", STRING),
+    repeated("records", GET_DNS_ZONE_RECORD),
+    ]))
+
+ADD_DNS_RECORD_RECORD = ComplexType("Add_DNS_Record_Record", [
+    required("name", STRING),
+    required("type", STRING),
+    optional("content", STRING),
+    optional("prio", INTEGER),
+    optional("ttl", INTEGER),
+    ])
+
+ADD_DNS_RECORD_CONTAINER = response("Add_DNS_Record", ComplexType("Add_DNS_Record_Data"))
+
+MODIFY_DNS_RECORD_RECORD = ComplexType("Modify_DNS_Record_Record", [
+    required("id", INTEGER),
+    required("type", STRING),
+    optional("content", STRING),
+    optional("prio", INTEGER),
+    optional("ttl", INTEGER),
+    ])
+
+MODIFY_DNS_RECORD_CONTAINER = response("Modify_DNS_Record", ComplexType("Modify_DNS_Record_Data"))
+
+DELETE_DNS_RECORD_RECORD = ComplexType("Delete_DNS_Record_Record", [
+    required("id", INTEGER),
+    ])
+
+DELETE_DNS_RECORD_CONTAINER = response("Delete_DNS_Record", ComplexType("Delete_DNS_Record_Data"))
+
+DOMAINS_LIST_CONTAINER = response("Domains_List", ComplexType("Domains_List_Data", [
+    required("count", INTEGER),
+    repeated("domains", ComplexType("Domains_List_Domain", [
+        required("name", STRING),
+        required("expire", STRING),
+        required("autorenew", INTEGER),
+        ])),
+    ]))
+
+# Operations of the service as name -> (request type, response type), the
+# request members are the operation arguments
+OPERATIONS = {
+    "Login": (ComplexType("Login", [
+        required("login", STRING),
+        required("password", STRING),
+        ]), LOGIN_CONTAINER),
+    "Domains_List": (ComplexType("Domains_List", [
+        required("ssid", STRING),
+        ]), DOMAINS_LIST_CONTAINER),
+    "Get_DNS_Zone": (ComplexType("Get_DNS_Zone", [
+        required("ssid", STRING),
+        required("domain", STRING),
+        ]), GET_DNS_ZONE_CONTAINER),
+    "Add_DNS_Record": (ComplexType("Add_DNS_Record", [
+        required("ssid", STRING),
+        required("domain", STRING),
+        required("record", ADD_DNS_RECORD_RECORD),
+        ]), ADD_DNS_RECORD_CONTAINER),
+    "Modify_DNS_Record": (ComplexType("Modify_DNS_Record", [
+        required("ssid", STRING),
+        required("domain", STRING),
+        required("record", MODIFY_DNS_RECORD_RECORD),
+        ]), MODIFY_DNS_RECORD_CONTAINER),
+    "Delete_DNS_Record": (ComplexType("Delete_DNS_Record", [
+        required("ssid", STRING),
+        required("domain", STRING),
+        required("record", DELETE_DNS_RECORD_RECORD),
+        ]), DELETE_DNS_RECORD_CONTAINER),
+    }
@@ -0,0 +1,208 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+# Patches the runtime, so it comes before the Spyne imports
+from . import compat
+import hashlib
+import logging
+import threading
+from spyne import Application, rpc, ServiceBase, \
+    Integer, Unicode
+from spyne.model.complex import ComplexModel
+from spyne.protocol.soap import Soap11
+from spyne.server.wsgi import WsgiApplication
+
+from . import schema
+from .metrics import OPERATION_KEY
+
+log = logging.getLogger(__name__)
+
+RequiredInteger = Integer.customize(nillable=False, min_occurs=1)
+RequiredUnicode = Unicode.customize(nillable=False, min_occurs=1)
+OptionalInteger = Integer.customize(nillable=False, min_occurs=0)
+OptionalUnicode = Unicode.customize(nillable=False, min_occurs=0)
+
+PRIMITIVES = {
+    (schema.INTEGER, 1): RequiredInteger,
+    (schema.STRING, 1): RequiredUnicode,
+    (schema.INTEGER, 0): OptionalInteger,
+    (schema.STRING, 0): OptionalUnicode,
+    }
+
+# Spyne models by type name, every type is built once
+MODELS = {}
+
+def model(complex_type):
+    """Returns the Spyne model of the schema.ComplexType."""
+    cls = MODELS.get(complex_type.name)
+    if cls is not None:
+        return cls
+
+    type_info = []
+    for name, member_type, min_occurs, max_occurs in complex_type.members:
+        if isinstance(member_type, schema.ComplexType):
+            attributes = {"nillable": False, "min_occurs": min_occurs}
+            if max_occurs != 1:
+                attributes["max_occurs"] = max_occurs
+            type_info.append((name, model(member_type).customize(**attributes)))
+        else:
+            type_info.append((name, PRIMITIVES[member_type, min_occurs]))
+
+    # The WSDL lists the types ordered by their module too
+    cls = type(complex_type.name, (ComplexModel,), {
+        "__module__": __name__,
+        "__namespace__": schema.TYPES_NS,
+        "_type_info": type_info,
+        })
+    MODELS[complex_type.name] = cls
+    return cls
+
+def record_argument(complex_type):
+    return model(complex_type).customize(nillable=False, min_occurs=1)
+
+class SubregCzService(ServiceBase):
+    __port_types__ = ("SubregCz",)
+
+    # Method names use the real subreg.cz operation casing (Login, Get_DNS_Zone…)
+    # so that spyne picks them up as the wsdl:operation name. _in_message_name /
+    # _out_message_name carry an explicit namespace so the request/response body
+    # elements live in http://subreg.cz/types while the wsdl-level service,
+    # portType, binding, and message definitions stay under the Application's
+    # tns http://subreg.cz/wsdl, matching the real subreg.cz WSDL.
+    @rpc(RequiredUnicode, RequiredUnicode, _returns=model(schema.LOGIN_CONTAINER),
+         _body_style='out_bare',
+         _in_message_name="{http://subreg.cz/types}Login",
+         _out_message_name="{http://subreg.cz/types}Login_Container",
+         _port_type="SubregCz"
+         )
+    def Login(ctx, login, password):
+        return ctx.app.config["api"].login(login, password)
+
+    @rpc(RequiredUnicode, _returns=model(schema.DOMAINS_LIST_CONTAINER),
+         _body_style='out_bare',
+         _in_message_name="{http://subreg.cz/types}Domains_List",
+         _out_message_name="{http://subreg.cz/types}Domains_List_Container",
+         _port_type="SubregCz"
+         )
+    def Domains_List(ctx, ssid):
+        return ctx.app.config["api"].domains_list(ssid)
+
+    @rpc(RequiredUnicode, RequiredUnicode, _returns=model(schema.GET_DNS_ZONE_CONTAINER),
+         _body_style='out_bare',
+         _in_message_name="{http://subreg.cz/types}Get_DNS_Zone",
+         _out_message_name="{http://subreg.cz/types}Get_DNS_Zone_Container",
+         _port_type="SubregCz"
+         )
+    def Get_DNS_Zone(ctx, ssid, domain):
+        return ctx.app.config["api"].get_dns_zone(ssid, domain)
+
+    @rpc(RequiredUnicode, RequiredUnicode, record_argument(schema.ADD_DNS_RECORD_RECORD),
+         _returns=model(schema.ADD_DNS_RECORD_CONTAINER),
+         _body_style='out_bare',
+         _in_message_name="{http://subreg.cz/types}Add_DNS_Record",
+         _out_message_name="{http://subreg.cz/types}Add_DNS_Record_Container",
+         _port_type="SubregCz"
+         )
+    def Add_DNS_Record(ctx, ssid, domain, record):
+        return ctx.app.config["api"].add_dns_record(ssid, domain, record.as_dict())
+
+    @rpc(RequiredUnicode, RequiredUnicode, record_argument(schema.MODIFY_DNS_RECORD_RECORD),
+         _returns=model(schema.MODIFY_DNS_RECORD_CONTAINER),
+         _body_style='out_bare',
+         _in_message_name="{http://subreg.cz/types}Modify_DNS_Record",
+         _out_message_name="{http://subreg.cz/types}Modify_DNS_Record_Container",
+         _port_type="SubregCz"
+         )
+    def Modify_DNS_Record(ctx, ssid, domain, record):
+        return ctx.app.config["api"].modify_dns_record(ssid, domain, record.as_dict())
+
+    @rpc(RequiredUnicode, RequiredUnicode, record_argument(schema.DELETE_DNS_RECORD_RECORD),
+         _returns=model(schema.DELETE_DNS_RECORD_CONTAINER),
+         _body_style='out_bare',
+         _in_message_name="{http://subreg.cz/types}Delete_DNS_Record",
+         _out_message_name="{http://subreg.cz/types}Delete_DNS_Record_Container",
+         _port_type="SubregCz"
+         )
+    def Delete_DNS_Record(ctx, ssid, domain, record):
+        return ctx.app.config["api"].delete_dns_record(ssid, domain, record.as_dict())
+
+class ApiApplication(WsgiApplication):
+    def __init__(self, app, service_url):
+        super().__init__(app)
+        self.service_url = service_url
+        # Rendered WSDL documents as service URL -> (document, ETag)
+        self.wsdl_documents = {}
+        self.wsdl_lock = threading.Lock()
+
+    def is_wsdl_request(self, req_env):
+        # Check the wsdl for the service.
+        return (
+            req_env['REQUEST_METHOD'].upper() == 'GET'
+            and req_env['PATH_INFO'] == '/wsdl'
+            )
+
+    def get_wsdl_document(self, url):
+        document = self.wsdl_documents.get(url)
+        if document is not None:
+            return document
+
+        with self.wsdl_lock:
+            document = self.wsdl_documents.get(url)
+            if document is None:
+                self.doc.wsdl11.build_interface_document(url)
+                wsdl = self.doc.wsdl11.get_interface_document()
+                document = (wsdl, '"%s"' % hashlib.sha1(wsdl).hexdigest())
+                self.wsdl_documents[url] = document
+        return document
+
+    def handle_wsdl_request(self, req_env, start_response, url):
+        try:
+            wsdl, etag = self.get_wsdl_document(self.service_url)
+        except Exception:
+            log.exception("WSDL generation failed")
+            return super().handle_wsdl_request(req_env, start_response, self.service_url)
+
+        if_none_match = req_env.get("HTTP_IF_NONE_MATCH", "")
+        if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+            start_response("304 Not Modified", [("ETag", etag)])
+            return []
+
+        start_response("200 OK", [
+            ("Content-Type", "text/xml; charset=utf-8"),
+            ("Content-Length", str(len(wsdl))),
+            ("ETag", etag),
+            ])
+        return [wsdl]
+
+def name_operation(ctx):
+    # Names the operation handled by Spyne for MetricsApplication
+    ctx.transport.req_env[OPERATION_KEY] = ctx.descriptor.name
+
+def create_spyne_application(url, api, metrics=None):
+    """Creates the WSGI application serving the simulated API by Spyne."""
+    spyne_app = Application([SubregCzService], schema.WSDL_NS,
+                            'SubregCzService',
+                            in_protocol=Soap11(),
+                            out_protocol=Soap11(),
+                            config={"api":api})
+
+    # Spyne keys service_method_map by {Application.tns}method.name, so it
+    # only matches incoming requests whose body element lives in the same
+    # namespace as the WSDL service. The real subreg.cz WSDL splits the
+    # namespaces (service in http://subreg.cz/wsdl, request elements in
+    # http://subreg.cz/types). Register each method under the body
+    # element's namespace as an alias so the dispatcher resolves both.
+    for method_list in list(spyne_app.interface.service_method_map.values()):
+        for method in method_list:
+            in_ns = method.in_message.get_namespace()
+            if in_ns and in_ns != spyne_app.tns:
+                alias_key = "{%s}%s" % (in_ns, method.name)
+                aliases = spyne_app.interface.service_method_map.setdefault(alias_key, [])
+                if method not in aliases:
+                    aliases.append(method)
+
+    if metrics is not None:
+        spyne_app.event_manager.add_listener("method_call", name_operation)
+    return ApiApplication(spyne_app, url)
@@ -0,0 +1,261 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+import json
+import logging
+import os
+import re
+import threading
+
+log = logging.getLogger(__name__)
+
+def as_dict(value):
+    # Records are stored in the form of API record dicts
+    return value.as_dict()
+
+class Storage(object):
+    """
+    Persistence interface of the Api. The Api passes every change to
+    append() in the order of the change serials, holding the lock of the
+    changed domain and the global lock, so append() must not wait for the
+    disk. Then it calls sync() with just the domain lock held, which returns
+    once the appended changes are as durable as configured. The default
+    implementation keeps nothing.
+    """
+
+    def load(self):
+        """Returns the stored state as a dictionary with "sn", "next_id" and "db" (records by domain), or None."""
+        return None
+
+    def append(self, entry):
+        pass
+
+    def sync(self):
+        pass
+
+    def snapshot_due(self):
+        return False
+
+    def rotate(self):
+        """Starts a new journal, returns a token for write_snapshot() or None when there is nothing to snapshot."""
+        return None
+
+    def write_snapshot(self, token, state):
+        pass
+
+    def close(self):
+        pass
+
+class JournalStorage(Storage):
+    """
+    Stores the records in a directory as an append-only journal of changes
+    (one JSON document per line) and periodic snapshots of the whole state.
+
+    Files are numbered by generation: snapshot-N.json holds the state at the
+    start of journal-N.jsonl. A snapshot is taken by starting the journal of
+    the next generation (quickly, while the Api is locked) and then writing
+    the captured state after the Api is unlocked, so that writers are not
+    blocked by the snapshot. Older generations are removed once the newer
+    snapshot is safely on disk. On start, the newest snapshot is loaded and
+    the journals from its generation on are replayed.
+
+    The fsync mode selects durability: "always" syncs every change to disk
+    before the change is answered, "batch" syncs at most once per batch
+    interval from a background thread, "never" leaves it to the operating
+    system. Journal entries are written under the lock, the syncs wait for
+    the disk under the sync lock only, and one sync covers all entries
+    written before it.
+    """
+
+    FILE_PATTERN = re.compile(r"^(snapshot|journal)-(\d+)\.(json|jsonl)$")
+
+    def __init__(self, directory, fsync="batch", snapshot_interval=10000, batch_interval=1.0):
+        self.directory = directory
+        self.fsync = fsync
+        self.snapshot_interval = snapshot_interval
+        self.batch_interval = batch_interval
+        self.lock = threading.Lock()
+        # Held while syncing, taken before the lock
+        self.sync_lock = threading.Lock()
+        self.journal = None
+        self.generation = 0
+        self.entries = 0
+        # Entries written to the journal and synced to disk
+        self.written = 0
+        self.synced = 0
+        self.snapshotting = False
+        self.closed = threading.Event()
+        self.sync_thread = None
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, kind, generation):
+        return os.path.join(self.directory, "{}-{}.{}".format(kind, generation, "json" if kind == "snapshot" else "jsonl"))
+
+    def list_generations(self, kind):
+        generations = []
+        for name in os.listdir(self.directory):
+            match = self.FILE_PATTERN.match(name)
+            if match and match.group(1) == kind:
+                generations.append(int(match.group(2)))
+        return sorted(generations)
+
+    def load(self):
+        state = None
+        snapshots = self.list_generations("snapshot")
+        while snapshots:
+            generation = snapshots.pop()
+            try:
+                with open(self.path("snapshot", generation), "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                self.generation = generation
+                break
+            except (OSError, ValueError) as e:
+                log.warning("Ignoring unreadable snapshot {}: {}".format(self.path("snapshot", generation), e))
+
+        if state is None:
+            state = {"sn": 1, "next_id": 1, "db": {}}
+        db = {domain: {record["id"]: record for record in records} for domain, records in state["db"].items()}
+
+        replayed = 0
+        journals = [generation for generation in self.list_generations("journal") if generation >= self.generation]
+        for generation in journals:
+            replayed += self.replay(self.path("journal", generation), state, db)
+            self.generation = generation
+
+        log.info("Loaded {} records from {} (generation {}, {} journal entries replayed)".format(
+            sum(len(records) for records in db.values()), self.directory, self.generation, replayed))
+
+        # Continue with the last journal, the replayed ones are kept until the
+        # next snapshot
+        self.open_journal()
+        self.entries = replayed
+
+        state["db"] = {domain: list(records.values()) for domain, records in db.items()}
+        return state
+
+    def replay(self, path, state, db):
+        count = 0
+        with open(path, "r+b") as f:
+            offset = 0
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("unterminated entry")
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn write at the end of the journal, cut it off so that
+                    # new entries can be appended
+                    log.warning("Dropping incomplete journal entry in {}".format(path))
+                    f.truncate(offset)
+                    break
+                offset += len(line)
+
+                if entry["op"] == "reset":
+                    # All records of the domain replaced at once
+                    db[entry["domain"]] = {record["id"]: record for record in entry["records"]}
+                    for record in entry["records"]:
+                        state["next_id"] = max(state["next_id"], record["id"] + 1)
+                elif entry["op"] == "delete":
+                    db.setdefault(entry["domain"], {}).pop(entry["id"], None)
+                else:
+                    record = entry["record"]
+                    db.setdefault(entry["domain"], {})[record["id"]] = record
+                    state["next_id"] = max(state["next_id"], record["id"] + 1)
+                state["sn"] = max(state["sn"], entry["sn"])
+                count += 1
+        return count
+
+    def open_journal(self):
+        self.journal = open(self.path("journal", self.generation), "a", encoding="utf-8")
+
+    def sync_batches(self):
+        while not self.closed.wait(self.batch_interval):
+            self.sync_journal()
+
+    def sync_journal(self):
+        with self.sync_lock:
+            with self.lock:
+                written = self.written
+                if self.synced >= written or self.journal.closed:
+                    return
+            # Entries are appended while the disk syncs, they are synced next
+            # time. The journal is not switched meanwhile, rotate() takes the
+            # sync lock.
+            os.fsync(self.journal.fileno())
+            self.synced = written
+
+    def append(self, entry):
+        line = json.dumps(entry, separators=(",", ":"), default=as_dict) + "\n"
+        with self.lock:
+            # Started with the first change, so that the server can still fork
+            # after the storage is loaded
+            if self.fsync == "batch" and self.sync_thread is None:
+                self.sync_thread = threading.Thread(target=self.sync_batches, name="storage-sync", daemon=True)
+                self.sync_thread.start()
+            self.journal.write(line)
+            self.journal.flush()
+            self.entries += 1
+            self.written += 1
+
+    def sync(self):
+        if self.fsync == "always":
+            self.sync_journal()
+
+    def snapshot_due(self):
+        return (self.snapshot_interval > 0
+                and not self.snapshotting
+                and self.entries >= self.snapshot_interval)
+
+    def rotate(self):
+        with self.sync_lock, self.lock:
+            if not self.entries or self.snapshotting:
+                return None
+            self.snapshotting = True
+            self.journal.flush()
+            if self.fsync != "never":
+                os.fsync(self.journal.fileno())
+            self.journal.close()
+            self.generation += 1
+            self.entries = 0
+            self.synced = self.written
+            self.open_journal()
+            return self.generation
+
+    def write_snapshot(self, generation, state):
+        try:
+            path = self.path("snapshot", generation)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(state, f, separators=(",", ":"), default=as_dict)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+            self.sync_directory()
+
+            for kind in ("snapshot", "journal"):
+                for old in self.list_generations(kind):
+                    if old < generation:
+                        os.remove(self.path(kind, old))
+            log.info("Snapshot {} written".format(path))
+        finally:
+            self.snapshotting = False
+
+    def sync_directory(self):
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.closed.set()
+        with self.sync_lock, self.lock:
+            if self.journal is not None and not self.journal.closed:
+                self.journal.flush()
+                if self.fsync != "never":
+                    os.fsync(self.journal.fileno())
+                self.journal.close()
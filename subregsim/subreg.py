@@ -3,360 +3,765 @@ Subreg.cz API simulator suitable for Python lexicon module.
 '''
 
 from __future__ import (absolute_import, print_function)
-from email.message import Message
-import importlib.util
+import io
+import itertools
 import logging
-import pathlib
-import re
-import sys
-import warnings
-from importlib import metadata
-
-
-if sys.version_info >= (3, 13):
-    import collections
-    import types
-    from collections import abc
-
-    # Spyne 2.14 still expects stdlib aliases and helper modules removed in
-    # newer Python releases, so patch them for Python 3.13+ runtimes.
-    if sys.version_info[:2] <= (3, 14):
-        original_showwarning = warnings.showwarning
-
-
-        def showwarning(message, category, filename, lineno, file=None, line=None):
-            if (
-                category is SyntaxWarning
-                and "invalid escape sequence" in str(message)
-                and re.search(r"spyne[\\/]+protocol[\\/]http\.py$", filename)
-            ):
-                return
-            return original_showwarning(message, category, filename, lineno, file=file, line=line)
-
-
-        warnings.showwarning = showwarning
-
-    def parse_header(value):
-        message = Message()
-        message["content-type"] = value
-        return message.get_content_type(), dict(message.get_params()[1:])
-
-
-    collections.Iterable = abc.Iterable
-    collections.Mapping = abc.Mapping
-    collections.MutableMapping = abc.MutableMapping
-    collections.MutableSet = abc.MutableSet
-    cgi_module = types.ModuleType("cgi")
-    cgi_module.parse_header = parse_header
-    sys.modules.setdefault("cgi", cgi_module)
-
-    if "spyne.util.six" not in sys.modules:
-        # Resolve the installed Spyne package location from distribution
-        # metadata so this works in both local uv environments and containers.
-        spyne_dist = metadata.distribution("spyne")
-        spyne_six_path = pathlib.Path(spyne_dist.locate_file("spyne/util/six.py"))
-        spec = importlib.util.spec_from_file_location("spyne.util.six", spyne_six_path)
-        spyne_six = importlib.util.module_from_spec(spec)
-        sys.modules["spyne.util.six"] = spyne_six
-        spec.loader.exec_module(spyne_six)
-    else:
-        spyne_six = sys.modules["spyne.util.six"]
-
-    spyne_six._importer.load_module("spyne.util.six.moves")
-    spyne_six._importer.load_module("spyne.util.six.moves.collections_abc")
-    spyne_six._importer.load_module("spyne.util.six.moves.http_cookies")
-    spyne_six._importer.load_module("spyne.util.six.moves.urllib")
-    spyne_six._importer.load_module("spyne.util.six.moves.urllib.parse")
-
+import queue
+import socket
+import ssl
+import threading
+import time
+from lxml import etree
 from socketserver import ThreadingMixIn
-from spyne import Application, rpc, ServiceBase, \
-    Integer, Unicode
-from spyne.model.complex import ComplexModel
-from spyne.protocol.soap import Soap11
-from spyne.server.wsgi import WsgiApplication
-from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from wsgiref.simple_server import ServerHandler, WSGIServer, WSGIRequestHandler
+
+from . import schema
+from .api import STATIC_RESPONSES
+from .changes import ChangeFeedApplication
+from .metrics import MetricsApplication, OPERATION_KEY
 
 log = logging.getLogger(__name__)
 
-RequiredInteger = Integer.customize(nillable=False, min_occurs=1)
-RequiredUnicode = Unicode.customize(nillable=False, min_occurs=1)
-OptionalInteger = Integer.customize(nillable=False, min_occurs=0)
-OptionalUnicode = Unicode.customize(nillable=False, min_occurs=0)
-
-class Error_Code(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('major', RequiredInteger),
-        ('minor', RequiredInteger)
-        ]
-
-class Error_Info(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('errormsg', RequiredUnicode),
-        ('errorcode', Error_Code.customize(nillable=False, min_occurs=1))
-        ]
-
-class Login_Data(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    ssid = RequiredUnicode
-
-class Login_Response(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('status', RequiredUnicode),
-        ('data', Login_Data.customize(nillable=False, min_occurs=0)),
-        ('error', Error_Info.customize(nillable=False, min_occurs=0))
-        ]
-
-class Login_Container(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    response = Login_Response.customize(nillable=False, min_occurs=1)
-
-class Get_DNS_Zone_Record(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('id', RequiredInteger),
-        ('name', RequiredUnicode),
-        ('type', RequiredUnicode),
-        ('content', OptionalUnicode),
-        ('prio', OptionalInteger),
-        ('ttl', OptionalInteger),
-        ]
-
-class Get_DNS_Zone_Data(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('domain', RequiredUnicode),
-        ('records', Get_DNS_Zone_Record.customize(nillable=False, min_occurs=0, max_occurs='unbounded'))
-        ]
-
-class Get_DNS_Zone_Response(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('status', RequiredUnicode),
-        ('data', Get_DNS_Zone_Data.customize(nillable=False, min_occurs=0)),
-        ('error', Error_Info.customize(nillable=False, min_occurs=0))
-        ]
-
-class Get_DNS_Zone_Container(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    response = Get_DNS_Zone_Response.customize(nillable=False, min_occurs=1)
-
-class Add_DNS_Record_Record(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('name', RequiredUnicode),
-        ('type', RequiredUnicode),
-        ('content', OptionalUnicode),
-        ('prio', OptionalInteger),
-        ('ttl', OptionalInteger),
-        ]
-
-class Add_DNS_Record_Data(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    pass
-
-class Add_DNS_Record_Response(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('status', RequiredUnicode),
-        ('data', Add_DNS_Record_Data.customize(nillable=False, min_occurs=0)),
-        ('error', Error_Info.customize(nillable=False, min_occurs=0))
-        ]
-
-class Add_DNS_Record_Container(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    response = Add_DNS_Record_Response.customize(nillable=False, min_occurs=1)
-
-class Modify_DNS_Record_Record(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('id', RequiredInteger),
-        ('type', RequiredUnicode),
-        ('content', OptionalUnicode),
-        ('prio', OptionalInteger),
-        ('ttl', OptionalInteger),
-        ]
-
-class Modify_DNS_Record_Data(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    pass
-
-class Modify_DNS_Record_Response(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('status', RequiredUnicode),
-        ('data', Modify_DNS_Record_Data.customize(nillable=False, min_occurs=0)),
-        ('error', Error_Info.customize(nillable=False, min_occurs=0))
-        ]
-
-class Modify_DNS_Record_Container(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    response = Modify_DNS_Record_Response.customize(nillable=False, min_occurs=1)
-
-class Delete_DNS_Record_Record(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    id = RequiredInteger
-
-class Delete_DNS_Record_Data(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    pass
-
-class Delete_DNS_Record_Response(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('status', RequiredUnicode),
-        ('data', Delete_DNS_Record_Data.customize(nillable=False, min_occurs=0)),
-        ('error', Error_Info.customize(nillable=False, min_occurs=0))
-        ]
-
-class Delete_DNS_Record_Container(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    response = Delete_DNS_Record_Response.customize(nillable=False, min_occurs=1)
-
-class Domains_List_Domain(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('name', RequiredUnicode),
-        ('expire', RequiredUnicode),
-        ('autorenew', RequiredInteger)
-        ]
-
-class Domains_List_Data(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('count', RequiredInteger),
-        ('domains', Domains_List_Domain.customize(nillable=False, min_occurs=0, max_occurs='unbounded'))
-        ]
-
-class Domains_List_Response(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    _type_info = [
-        ('status', RequiredUnicode),
-        ('data', Domains_List_Data.customize(nillable=False, min_occurs=0)),
-        ('error', Error_Info.customize(nillable=False, min_occurs=0))
-        ]
-
-class Domains_List_Container(ComplexModel):
-    __namespace__ = "http://subreg.cz/types"
-    response = Domains_List_Response.customize(nillable=False, min_occurs=1)
-
-class SubregCzService(ServiceBase):
-    __port_types__ = ("SubregCz",)
-
-    # Method names use the real subreg.cz operation casing (Login, Get_DNS_Zone…)
-    # so that spyne picks them up as the wsdl:operation name. _in_message_name /
-    # _out_message_name carry an explicit namespace so the request/response body
-    # elements live in http://subreg.cz/types while the wsdl-level service,
-    # portType, binding, and message definitions stay under the Application's
-    # tns http://subreg.cz/wsdl, matching the real subreg.cz WSDL.
-    @rpc(RequiredUnicode, RequiredUnicode, _returns=Login_Container,
-         _body_style='out_bare',
-         _in_message_name="{http://subreg.cz/types}Login",
-         _out_message_name="{http://subreg.cz/types}Login_Container",
-         _port_type="SubregCz"
-         )
-    def Login(ctx, login, password):
-        return ctx.app.config["api"].login(login, password)
-
-    @rpc(RequiredUnicode, _returns=Domains_List_Container,
-         _body_style='out_bare',
-         _in_message_name="{http://subreg.cz/types}Domains_List",
-         _out_message_name="{http://subreg.cz/types}Domains_List_Container",
-         _port_type="SubregCz"
-         )
-    def Domains_List(ctx, ssid):
-        return ctx.app.config["api"].domains_list(ssid)
-
-    @rpc(RequiredUnicode, RequiredUnicode, _returns=Get_DNS_Zone_Container,
-         _body_style='out_bare',
-         _in_message_name="{http://subreg.cz/types}Get_DNS_Zone",
-         _out_message_name="{http://subreg.cz/types}Get_DNS_Zone_Container",
-         _port_type="SubregCz"
-         )
-    def Get_DNS_Zone(ctx, ssid, domain):
-        return ctx.app.config["api"].get_dns_zone(ssid, domain)
-
-    @rpc(RequiredUnicode, RequiredUnicode, Add_DNS_Record_Record.customize(nillable=False, min_occurs=1),
-         _returns=Add_DNS_Record_Container,
-         _body_style='out_bare',
-         _in_message_name="{http://subreg.cz/types}Add_DNS_Record",
-         _out_message_name="{http://subreg.cz/types}Add_DNS_Record_Container",
-         _port_type="SubregCz"
-         )
-    def Add_DNS_Record(ctx, ssid, domain, record):
-        return ctx.app.config["api"].add_dns_record(ssid, domain, record.as_dict())
-
-    @rpc(RequiredUnicode, RequiredUnicode, Modify_DNS_Record_Record.customize(nillable=False, min_occurs=1),
-         _returns=Modify_DNS_Record_Container,
-         _body_style='out_bare',
-         _in_message_name="{http://subreg.cz/types}Modify_DNS_Record",
-         _out_message_name="{http://subreg.cz/types}Modify_DNS_Record_Container",
-         _port_type="SubregCz"
-         )
-    def Modify_DNS_Record(ctx, ssid, domain, record):
-        return ctx.app.config["api"].modify_dns_record(ssid, domain, record.as_dict())
-
-    @rpc(RequiredUnicode, RequiredUnicode, Delete_DNS_Record_Record.customize(nillable=False, min_occurs=1),
-         _returns=Delete_DNS_Record_Container,
-         _body_style='out_bare',
-         _in_message_name="{http://subreg.cz/types}Delete_DNS_Record",
-         _out_message_name="{http://subreg.cz/types}Delete_DNS_Record_Container",
-         _port_type="SubregCz"
-         )
-    def Delete_DNS_Record(ctx, ssid, domain, record):
-        return ctx.app.config["api"].delete_dns_record(ssid, domain, record.as_dict())
-
-class ApiApplication(WsgiApplication):
-    def __init__(self, app, service_url):
-        super().__init__(app)
-        self.service_url = service_url
-
-    def is_wsdl_request(self, req_env):
-        # Check the wsdl for the service.
-        return (
-            req_env['REQUEST_METHOD'].upper() == 'GET'
-            and req_env['PATH_INFO'] == '/wsdl'
-            )
-
-    def handle_wsdl_request(self, req_env, start_response, url):
-        return super().handle_wsdl_request(req_env, start_response, self.service_url)
-
-class ApiHttpServer(ThreadingMixIn, WSGIServer):
+SOAP11_ENV_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+# Largest request body accepted
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+class FastSoapFallback(Exception):
+    """Raised when a request cannot be handled by the fast SOAP path."""
+
+class RequestBodyTooLarge(Exception):
+    """Raised when the request body is larger than MAX_BODY_SIZE."""
+
+def _escape_text(value):
+    # Matches the escaping of text nodes by lxml, which Spyne uses
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\r", "&#13;")
+
+def _compile_parser(complex_type):
+    """
+    Compiles a parser of the element content of the given schema.ComplexType
+    into a dict of the present members, equivalent to the Spyne model's
+    as_dict(). Anything beyond plain values raises FastSoapFallback.
+    """
+    members = {}
+    for key, member_type, _, _ in complex_type.members:
+        if isinstance(member_type, schema.ComplexType):
+            members[key] = _compile_parser(member_type)
+        elif member_type == schema.INTEGER:
+            members[key] = int
+        else:
+            members[key] = str
+
+    def parse(element):
+        result = {}
+        for child in element:
+            if not isinstance(child.tag, str):
+                continue
+            key = child.tag.rpartition("}")[2]
+            member = members.get(key)
+            if member is None or key in result or child.get("{%s}nil" % XSI_NS) is not None:
+                raise FastSoapFallback()
+            if member is int or member is str:
+                if len(child):
+                    raise FastSoapFallback()
+                text = child.text or ""
+                if member is int:
+                    # int() rejects other Unicode digits, e.g. superscripts
+                    if not (text.isascii() and text.isdigit()):
+                        raise FastSoapFallback()
+                    result[key] = int(text)
+                else:
+                    result[key] = text
+            else:
+                result[key] = member(child)
+        return result
+
+    return parse
+
+def _compile_members(complex_type):
+    members = []
+    for key, member_type, _, max_occurs in complex_type.members:
+        open_tag = "<ns1:%s>" % key
+        close_tag = "</ns1:%s>" % key
+        if isinstance(member_type, schema.ComplexType):
+            render = _compile_renderer(member_type)
+            # Elements without content are serialized as empty elements
+            empty_tag = "<ns1:%s/>" % key
+        else:
+            if member_type == schema.INTEGER:
+                render = lambda value: str(int(value))
+            else:
+                render = lambda value: _escape_text(str(value))
+            empty_tag = open_tag + close_tag
+        members.append((key, open_tag, close_tag, empty_tag, render,
+                        max_occurs != 1, member_type))
+    return members
+
+def _get_member(value, key):
+    if isinstance(value, dict):
+        return value.get(key)
+    return getattr(value, key, None)
+
+def _compile_renderer(complex_type):
+    """
+    Compiles a renderer of a dict (or an object with attributes) into the
+    element content Spyne generates for the given schema.ComplexType.
+    """
+    members = [(key, open_tag, close_tag, empty_tag, render, many, isinstance(member_type, schema.ComplexType))
+               for key, open_tag, close_tag, empty_tag, render, many, member_type in _compile_members(complex_type)]
+
+    def render(value, memo=None):
+        """
+        The optional memo is a pair of (previous, current) dicts, which cache
+        renderings of repeated complex items by their identity; renderings
+        used by this call are moved from the previous to the current one.
+        Items must not change while they are cached.
+        """
+        parts = []
+        for key, open_tag, close_tag, empty_tag, render_member, many, complex_member in members:
+            member = _get_member(value, key)
+            if member is None:
+                continue
+            for item in (member if many else (member,)):
+                if not complex_member:
+                    text = render_member(item)
+                elif memo is None:
+                    text = render_member(item)
+                elif many:
+                    cached = memo[0].get(id(item))
+                    if cached is None or cached[0] is not item:
+                        cached = (item, render_member(item, memo))
+                    memo[1][id(item)] = cached
+                    text = cached[1]
+                else:
+                    text = render_member(item, memo)
+                if text:
+                    parts.append(open_tag)
+                    parts.append(text)
+                    parts.append(close_tag)
+                else:
+                    parts.append(empty_tag)
+        return "".join(parts)
+
+    return render
+
+def _compile_streamer(complex_type):
+    """
+    Compiles a generator of the same content as _compile_renderer(), which
+    yields repeated members item by item, so that long lists (like zone
+    records) are sent out as they are rendered. Never yields empty strings.
+    """
+    members = []
+    for key, open_tag, close_tag, empty_tag, render, many, member_type in _compile_members(complex_type):
+        stream = None
+        if not many and isinstance(member_type, schema.ComplexType):
+            stream = _compile_streamer(member_type)
+        members.append((key, open_tag, close_tag, empty_tag, render, many, stream))
+
+    def stream(value):
+        for key, open_tag, close_tag, empty_tag, render_member, many, stream_member in members:
+            member = _get_member(value, key)
+            if member is None:
+                continue
+            if stream_member is not None:
+                pieces = stream_member(member)
+                first = next(pieces, None)
+                if first is None:
+                    yield empty_tag
+                else:
+                    yield open_tag
+                    yield first
+                    yield from pieces
+                    yield close_tag
+                continue
+            for item in (member if many else (member,)):
+                text = render_member(item)
+                yield open_tag + text + close_tag if text else empty_tag
+
+    return stream
+
+class FastSoapApplication(object):
+    """
+    WSGI application answering the known SubregCzService operations directly
+    from the Api, bypassing the Spyne protocol pipeline. Request parsers and
+    response templates are compiled from the schema the Spyne models are
+    built from, so the wire format stays identical. Anything else is passed to
+    the Spyne application.
+    """
+
+    API_METHODS = {
+        "Login": "login",
+        "Domains_List": "domains_list",
+        "Get_DNS_Zone": "get_dns_zone",
+        "Add_DNS_Record": "add_dns_record",
+        "Modify_DNS_Record": "modify_dns_record",
+        "Delete_DNS_Record": "delete_dns_record",
+        }
+
+    # Operations with possibly long responses, which are streamed
+    STREAMED_METHODS = ("Get_DNS_Zone",)
+    # Operations whose responses are shared between calls until the data
+    # change, their last rendering is reused
+    CACHED_METHODS = ("Domains_List",)
+    STREAM_CHUNK_SIZE = 65536
+
+    def __init__(self, api, fallback, tns, methods=None):
+        self.api = api
+        self.fallback = fallback
+        self.parsers = threading.local()
+        self.operations = {}
+        for name, api_method in self.API_METHODS.items():
+            if methods is not None and name not in methods:
+                continue
+            in_message, out_message = schema.OPERATIONS[name]
+            envelope = (
+                "<?xml version='1.0' encoding='UTF-8'?>\n"
+                '<soap11env:Envelope xmlns:soap11env="%s"><soap11env:Body>'
+                '<ns1:%s xmlns:ns1="%s">' % (SOAP11_ENV_NS, out_message.name, schema.TYPES_NS),
+                "</ns1:%s></soap11env:Body></soap11env:Envelope>" % out_message.name)
+            render = _compile_renderer(out_message)
+            # Fixed responses are rendered just once, they are found by
+            # identity, or by value for copies returned by the Api of another
+            # process (see prefork)
+            static = {}
+            for response in STATIC_RESPONSES:
+                static[id(response)] = static[repr(response)] = "".join(
+                    (envelope[0], render(response), envelope[1])).encode("utf-8")
+            stream = _compile_streamer(out_message) if name in self.STREAMED_METHODS else None
+            cache = {} if name in self.CACHED_METHODS else None
+            operation = (name, getattr(api, api_method), [member[0] for member in in_message.members],
+                         _compile_parser(in_message), render, envelope, static, stream, cache)
+            for namespace in (schema.TYPES_NS, tns):
+                self.operations["{%s}%s" % (namespace, name)] = operation
+
+    def get_parser(self):
+        parser = getattr(self.parsers, "parser", None)
+        if parser is None:
+            parser = etree.XMLParser(resolve_entities=False, no_network=True)
+            self.parsers.parser = parser
+        return parser
+
+    def dispatch(self, body, req_env=None):
+        try:
+            root = etree.fromstring(body, self.get_parser())
+        except etree.XMLSyntaxError:
+            raise FastSoapFallback()
+
+        if root.tag != "{%s}Envelope" % SOAP11_ENV_NS or root.getroottree().docinfo.doctype:
+            raise FastSoapFallback()
+
+        request = None
+        for child in root:
+            if not isinstance(child.tag, str):
+                continue
+            if child.tag == "{%s}Header" % SOAP11_ENV_NS:
+                if any(isinstance(header.tag, str) for header in child):
+                    raise FastSoapFallback()
+            elif child.tag == "{%s}Body" % SOAP11_ENV_NS and request is None:
+                elements = [element for element in child if isinstance(element.tag, str)]
+                if len(elements) != 1:
+                    raise FastSoapFallback()
+                request = elements[0]
+            else:
+                raise FastSoapFallback()
+
+        operation = self.operations.get(request.tag) if request is not None else None
+        if operation is None:
+            raise FastSoapFallback()
+
+        name, api_method, arg_names, parse, render, envelope, static, stream, cache = operation
+        if req_env is not None:
+            req_env[OPERATION_KEY] = name
+        args = parse(request)
+        if len(args) != len(arg_names):
+            raise FastSoapFallback()
+
+        response = api_method(*[args[name] for name in arg_names])
+        rendered = static.get(id(response))
+        if rendered is None and "data" not in response["response"]:
+            rendered = static.get(repr(response))
+        if rendered is not None:
+            return rendered
+        if stream is not None:
+            return self.stream_response(stream(response), envelope)
+        if cache is None:
+            return "".join((envelope[0], render(response), envelope[1])).encode("utf-8")
+
+        # The cache keeps the response (and the memoized items) alive, so
+        # their identities are not reused
+        last = cache.get("last")
+        # Compared by value, as the Api of another process returns copies;
+        # the same response compares fast, as its items are identical
+        if last is not None and last[0] == response:
+            return last[1]
+        memo = (cache.get("memo", {}), {})
+        rendered = "".join((envelope[0], render(response, memo), envelope[1])).encode("utf-8")
+        cache["last"] = (response, rendered)
+        cache["memo"] = memo[1]
+        return rendered
+
+    def stream_response(self, pieces, envelope):
+        """Yields the response in chunks of about STREAM_CHUNK_SIZE characters."""
+        buffered = [envelope[0]]
+        size = len(envelope[0])
+        for piece in pieces:
+            buffered.append(piece)
+            size += len(piece)
+            if size >= self.STREAM_CHUNK_SIZE:
+                yield "".join(buffered).encode("utf-8")
+                buffered = []
+                size = 0
+        buffered.append(envelope[1])
+        yield "".join(buffered).encode("utf-8")
+
+    def __call__(self, req_env, start_response):
+        if req_env["REQUEST_METHOD"].upper() != "POST" or req_env.get("HTTP_CONTENT_ENCODING"):
+            return self.fallback(req_env, start_response)
+
+        content_type = req_env.get("CONTENT_TYPE", "").lower()
+        if "charset" in content_type and "utf-8" not in content_type:
+            return self.fallback(req_env, start_response)
+
+        try:
+            length = int(req_env.get("CONTENT_LENGTH") or "")
+        except ValueError:
+            return self.fallback(req_env, start_response)
+
+        body = req_env["wsgi.input"].read(length)
+        try:
+            response = self.dispatch(body, req_env)
+        except FastSoapFallback:
+            req_env["wsgi.input"] = io.BytesIO(body)
+            return self.fallback(req_env, start_response)
+
+        if isinstance(response, bytes):
+            chunks = [response]
+        else:
+            # Short streamed responses still get Content-Length
+            first = next(response)
+            second = next(response, None)
+            if second is not None:
+                start_response("200 OK", [("Content-Type", "text/xml; charset=utf-8")])
+                return itertools.chain((first, second), response)
+            chunks = [first]
+
+        start_response("200 OK", [
+            ("Content-Type", "text/xml; charset=utf-8"),
+            ("Content-Length", str(len(chunks[0]))),
+            ])
+        return chunks
+
+class SpyneApplication(object):
+    """
+    WSGI application of the Spyne service (see service), loaded on first
+    use. Importing Spyne and building the service takes most of the start-up
+    time, while the fast path answers many requests without it.
+    """
+
+    def __init__(self, url, api, metrics=None):
+        self.url = url
+        self.api = api
+        self.metrics = metrics
+        self.app = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.app is None:
+            with self.lock:
+                if self.app is None:
+                    start = time.perf_counter()
+                    from .service import create_spyne_application
+                    self.app = create_spyne_application(self.url, self.api, self.metrics)
+                    log.info("Spyne SOAP application loaded in {:.0f} ms".format((time.perf_counter() - start) * 1000))
+        return self.app
+
+    def __call__(self, req_env, start_response):
+        return self.load()(req_env, start_response)
+
+def create_application(url, api, fast_soap=False, metrics=None, change_feed=None, stream_responses=False):
+    """
+    Creates the WSGI application serving the simulated API, measured by the
+    optional metrics.Metrics, and the optional changes.ChangeFeed at /changes.
+    With stream_responses (implied by fast_soap), just the long and cacheable
+    responses are answered by the fast path, as Spyne builds whole responses
+    in memory on every call.
+    """
+    app = SpyneApplication(url, api, metrics)
+    if fast_soap:
+        app = FastSoapApplication(api, app, schema.WSDL_NS)
+    elif stream_responses:
+        app = FastSoapApplication(api, app, schema.WSDL_NS,
+                                  FastSoapApplication.STREAMED_METHODS + FastSoapApplication.CACHED_METHODS)
+    if metrics is not None:
+        app = MetricsApplication(app, api, metrics)
+    if change_feed is not None:
+        # Outermost, long-polls would distort the request durations
+        app = ChangeFeedApplication(app, change_feed)
+    return app
+
+class RequestBody(object):
+    """
+    Request body stream limited to the request's Content-Length, so that the
+    application can never read into the next request on the connection.
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b""
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b""
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b""))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def drain(self):
+        while self.read(65536):
+            pass
+
+def read_chunked_body(rfile):
+    """
+    Returns the chunked request body. Raises ValueError for invalid or
+    truncated bodies, RequestBodyTooLarge for bodies over MAX_BODY_SIZE.
+    """
+    chunks = []
+    body_size = 0
+    while True:
+        size_line = rfile.readline(65537)
+        if not size_line:
+            raise ValueError("Truncated chunked request body")
+        try:
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise ValueError("Invalid chunk size")
+        if size < 0:
+            raise ValueError("Invalid chunk size")
+        if size == 0:
+            break
+        body_size += size
+        if body_size > MAX_BODY_SIZE:
+            raise RequestBodyTooLarge()
+        chunk = rfile.read(size)
+        if len(chunk) < size:
+            raise ValueError("Truncated chunked request body")
+        chunks.append(chunk)
+        rfile.readline(65537)
+
+    # Skip trailer headers up to the final empty line
+    while rfile.readline(65537) not in (b"\r\n", b"\n", b""):
+        pass
+
+    return b"".join(chunks)
+
+class ApiServerHandler(ServerHandler):
+    """
+    HTTP/1.1 WSGI response handler keeping the connection open when the
+    response can be framed, using chunked encoding for responses without
+    Content-Length.
+    """
+
+    http_version = "1.1"
+
+    def __init__(self, *args, keep_alive=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keep_alive = keep_alive
+        self.chunked = False
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+
+        is_http11 = self.environ.get("SERVER_PROTOCOL") == "HTTP/1.1"
+        if "Content-Length" not in self.headers:
+            if self.keep_alive and is_http11:
+                self.headers["Transfer-Encoding"] = "chunked"
+                self.chunked = True
+            else:
+                self.keep_alive = False
+
+        if not self.keep_alive:
+            self.headers["Connection"] = "close"
+        elif not is_http11:
+            self.headers["Connection"] = "keep-alive"
+
+    def write(self, data):
+        if not self.status:
+            raise AssertionError("write() before start_response()")
+
+        if not self.headers_sent:
+            # Content-Length of single-block responses is set from bytes_sent
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent += len(data)
+
+        if self.chunked:
+            if data:
+                self._write(b"%X\r\n%s\r\n" % (len(data), data))
+        else:
+            self._write(data)
+        self._flush()
+
+    def finish_content(self):
+        if not self.headers_sent:
+            self.headers.setdefault("Content-Length", "0")
+            self.send_headers()
+        elif self.chunked:
+            self._write(b"0\r\n\r\n")
+            self._flush()
+
+    def handle_error(self):
+        # The response framing cannot be trusted anymore
+        self.keep_alive = False
+        super().handle_error()
+
+class ApiHttpRequestHandler(WSGIRequestHandler):
+    """
+    Request handler serving any number of requests over one persistent
+    connection, up to the server's idle timeout and request limit.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent separately, which would otherwise wait for
+    # the delayed acknowledgement of the client on persistent connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.timeout = self.server.keep_alive_timeout or None
+        self.requests_handled = 0
+        super().setup()
+
+    def handle(self):
+        self.close_connection = True
+        tls = self.server.tls
+        if tls is not None:
+            try:
+                self.connection.do_handshake()
+            except OSError:
+                return
+            tls.handshake_done(self.connection)
+
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+
+        if not self.parse_request(): # An error code has been sent, just exit
+            self.close_connection = True
+            return
+
+        self.requests_handled += 1
+        max_requests = self.server.keep_alive_max_requests
+        keep_alive = (not self.close_connection
+                      and self.server.keep_alive_timeout > 0
+                      and (not max_requests or self.requests_handled < max_requests))
+
+        environ = self.get_environ()
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            try:
+                body = read_chunked_body(self.rfile)
+            except ValueError:
+                self.send_error(400, "Invalid chunked request body")
+                self.close_connection = True
+                return
+            except RequestBodyTooLarge:
+                self.send_error(413)
+                self.close_connection = True
+                return
+            environ["CONTENT_LENGTH"] = str(len(body))
+            environ.pop("HTTP_TRANSFER_ENCODING", None)
+            request_body = RequestBody(io.BytesIO(body), len(body))
+        else:
+            try:
+                length = int(environ.get("CONTENT_LENGTH") or "0")
+            except ValueError:
+                self.send_error(400, "Invalid Content-Length")
+                self.close_connection = True
+                return
+            if length > MAX_BODY_SIZE:
+                self.send_error(413)
+                self.close_connection = True
+                return
+            request_body = RequestBody(self.rfile, length)
+
+        handler = ApiServerHandler(
+            request_body, self.wfile, self.get_stderr(), environ,
+            multithread=False, keep_alive=keep_alive,
+        )
+        handler.request_handler = self      # backpointer for logging
+        handler.run(self.server.get_app())
+
+        if handler.keep_alive:
+            # Skip any request body left unread by the application, so that
+            # the next request starts at the right place
+            request_body.drain()
+        else:
+            self.close_connection = True
+
+class WorkerPoolMixIn(ThreadingMixIn):
+    """
+    Serves connections by a fixed number of worker threads fed from a bounded
+    queue of accepted connections. When the queue is full, the accepting
+    thread either waits for a free slot ("block") or answers the connection
+    with 503 Service Unavailable ("reject"), TLS connections are just closed.
+    Without workers, every connection gets its own thread as with
+    ThreadingMixIn.
+    """
+
+    workers = 0
+    queue_size = 64
+    queue_full = "block"
+
+    def start_workers(self):
+        self.request_queue = queue.Queue(max(1, self.queue_size))
+        self.worker_threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.process_queue, name="worker-{}".format(i + 1), daemon=True)
+            thread.start()
+            self.worker_threads.append(thread)
+
+    def process_queue(self):
+        while True:
+            item = self.request_queue.get()
+            if item is None:
+                # Passed on to the next worker, there is room for it now
+                self.stop_next_worker()
+                break
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.workers:
+            return ThreadingMixIn.process_request(self, request, client_address)
+
+        if self.queue_full == "reject":
+            try:
+                self.request_queue.put_nowait((request, client_address))
+            except queue.Full:
+                self.reject_request(request, client_address)
+        else:
+            self.request_queue.put((request, client_address))
+
+    def reject_request(self, request, client_address):
+        log.warning("Request queue full, rejecting connection from {}".format(client_address[0]))
+        if isinstance(request, ssl.SSLSocket):
+            # The handshake is left to the workers, the client would not
+            # understand a plain-text response
+            self.shutdown_request(request)
+            return
+        try:
+            request.settimeout(1)
+            request.sendall(b"HTTP/1.1 503 Service Unavailable\r\n"
+                            b"Content-Length: 0\r\n"
+                            b"Retry-After: 1\r\n"
+                            b"Connection: close\r\n\r\n")
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def stop_next_worker(self):
+        try:
+            self.request_queue.put_nowait(None)
+        except queue.Full:
+            # Not after server_close() drained the queue, nothing is accepted
+            # anymore
+            pass
+
+    def server_close(self):
+        super().server_close()
+        if self.workers:
+            # Waiting connections are dropped, so that the queue never blocks
+            # the shutdown, then the workers stop one after the other
+            while True:
+                try:
+                    item = self.request_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self.shutdown_request(item[0])
+            self.stop_next_worker()
+
+class ApiHttpServer(WorkerPoolMixIn, WSGIServer):
     daemon_threads = True
 
-    def __init__(self, server_address, url, api, is_ssl):
-        WSGIServer.__init__(self, server_address, WSGIRequestHandler)
+    def __init__(self, server_address, url, api, is_ssl, fast_soap=False,
+                 keep_alive_timeout=15, keep_alive_max_requests=1000,
+                 workers=0, queue_size=64, queue_full="block", reuse_port=False, metrics=None, change_feed=None,
+                 tls=None, stream_responses=False):
+        self.allow_reuse_port = reuse_port
+        # tls.ServerTls wrapping the accepted connections, if is_ssl. Set
+        # first, server_close() reports it when binding the socket fails.
+        self.tls = tls
+        WSGIServer.__init__(self, server_address, ApiHttpRequestHandler)
         self.is_ssl = is_ssl
+        self.keep_alive_timeout = keep_alive_timeout
+        self.keep_alive_max_requests = keep_alive_max_requests
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue_full = queue_full
+        self.start_workers()
 
         if self.is_ssl:
             self.base_environ["HTTPS"] = "yes"
 
-        spyne_app = Application([SubregCzService], 'http://subreg.cz/wsdl',
-                                'SubregCzService',
-                                in_protocol=Soap11(),
-                                out_protocol=Soap11(),
-                                config={"api":api})
-
-        # Spyne keys service_method_map by {Application.tns}method.name, so it
-        # only matches incoming requests whose body element lives in the same
-        # namespace as the WSDL service. The real subreg.cz WSDL splits the
-        # namespaces (service in http://subreg.cz/wsdl, request elements in
-        # http://subreg.cz/types). Register each method under the body
-        # element's namespace as an alias so the dispatcher resolves both.
-        for method_list in list(spyne_app.interface.service_method_map.values()):
-            for method in method_list:
-                in_ns = method.in_message.get_namespace()
-                if in_ns and in_ns != spyne_app.tns:
-                    alias_key = "{%s}%s" % (in_ns, method.name)
-                    aliases = spyne_app.interface.service_method_map.setdefault(alias_key, [])
-                    if method not in aliases:
-                        aliases.append(method)
-
-        app = ApiApplication(spyne_app, url)
-
-        self.set_app(app)
+        self.set_app(create_application(url, api, fast_soap, metrics, change_feed, stream_responses))
+
+    def get_request(self):
+        request, client_address = self.socket.accept()
+        if self.tls is not None:
+            request = self.tls.wrap_socket(request)
+        return request, client_address
+
+    def server_close(self):
+        super().server_close()
+        if self.tls is not None:
+            self.tls.report()
 
     def handle_error(self, _request, client_address):
         if self.is_ssl:
@@ -0,0 +1,128 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+import collections
+import logging
+import os
+import ssl
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# The servers speak HTTP/1.1 only
+ALPN_PROTOCOLS = ["http/1.1"]
+
+def create_context(certificate, private_key=None, ecdsa_certificate=None, ecdsa_private_key=None,
+                   ciphers=None, ecdh_curve=None, session_tickets=2):
+    """
+    Returns the server SSLContext. With both an RSA and an ECDSA certificate,
+    clients supporting ECDSA get the ECDSA one. session_tickets is the number
+    of TLS 1.3 session tickets sent after a full handshake, 0 disables session
+    resumption.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate, private_key)
+    if ecdsa_certificate:
+        context.load_cert_chain(ecdsa_certificate, ecdsa_private_key)
+    if ciphers:
+        context.set_ciphers(ciphers)
+    if ecdh_curve:
+        context.set_ecdh_curve(ecdh_curve)
+    context.set_alpn_protocols(ALPN_PROTOCOLS)
+
+    context.num_tickets = session_tickets
+    if not session_tickets:
+        context.options |= ssl.OP_NO_TICKET
+    return context
+
+class ServerTls(object):
+    """
+    TLS of the HTTPS server, wrapping the accepted connections with the
+    current SSLContext.
+
+    OpenSSL encrypts the session tickets with keys of the context, which
+    Python cannot set. The keys are rotated by replacing the context every
+    key_lifetime seconds, reading the certificates again: tickets issued
+    before are not accepted anymore, so their clients make one full
+    handshake and get new tickets. There is no grace period, all tickets
+    expire at once. Forked server processes would rotate to different keys,
+    so they must not rotate.
+
+    The servers count the completed handshakes, which are logged on
+    rotation, on close, and every stats_interval seconds (when a connection
+    comes).
+    """
+
+    def __init__(self, create_context, key_lifetime=0, stats_interval=0):
+        self.create_context = create_context
+        self.key_lifetime = key_lifetime
+        self.stats_interval = stats_interval
+        self.context = create_context()
+        self.lock = threading.Lock()
+        # Statistics of the replaced contexts
+        self.retired_stats = collections.Counter()
+        # OpenSSL counts resumptions twice after a HelloRetryRequest, so
+        # they are counted here
+        self.handshakes = 0
+        self.resumed = 0
+
+        now = time.monotonic()
+        self.rotate_at = now + key_lifetime if key_lifetime else None
+        self.report_at = now + stats_interval if stats_interval else None
+
+    def current_context(self):
+        if self.rotate_at is None and self.report_at is None:
+            return self.context
+
+        now = time.monotonic()
+        with self.lock:
+            rotate = self.rotate_at is not None and now >= self.rotate_at
+            if rotate:
+                self.rotate_at = now + self.key_lifetime
+                self.rotate()
+            if rotate or (self.report_at is not None and now >= self.report_at):
+                if self.report_at is not None:
+                    self.report_at = now + self.stats_interval
+                self.report(rotate)
+            return self.context
+
+    def rotate(self):
+        try:
+            context = self.create_context()
+        except (OSError, ValueError):
+            log.exception("Rotating TLS session ticket keys failed, keeping the current ones")
+            return
+
+        self.retired_stats.update(self.context.session_stats())
+        self.context = context
+        log.info("TLS session ticket keys rotated")
+
+    def wrap_socket(self, sock):
+        # The handshake is left to the thread serving the connection
+        return self.current_context().wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+
+    def handshake_done(self, ssl_object):
+        with self.lock:
+            self.handshakes += 1
+            if ssl_object.session_reused:
+                self.resumed += 1
+
+    def statistics(self):
+        stats = collections.Counter(self.retired_stats)
+        stats.update(self.context.session_stats())
+        return stats
+
+    def report(self, always=True):
+        stats = self.statistics()
+        if not (always or stats["accept"]):
+            return
+
+        handshakes = self.handshakes
+        resumed = self.resumed
+        # Every server process reports its own handshakes
+        log.info("TLS handshakes of pid {}: {} completed, {} full, {} resumed ({:.1%}), {} failed or in progress".format(
+            os.getpid(), handshakes, handshakes - resumed, resumed, resumed / handshakes if handshakes else 0,
+            stats["accept"] - stats["accept_good"]))
@@ -0,0 +1,237 @@
+'''
+Subreg.cz API simulator suitable for Python lexicon module.
+'''
+
+from __future__ import (absolute_import, print_function)
+import json
+import logging
+import os
+import re
+import sys
+
+log = logging.getLogger(__name__)
+
+ZONE_EXTENSIONS = (".zone", ".db")
+JSON_EXTENSIONS = (".json", ".jsonl")
+
+TOKEN = re.compile(r'(?P<quoted>"(?:[^"\\]|\\.)*")|(?P<comment>;.*)|(?P<paren>[()])|(?P<atom>[^\s"();]+)')
+ESCAPE = re.compile(r'\\([0-9]{3}|.)')
+CLASSES = ("IN", "CH", "HS")
+TTL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+# Types whose content is a domain name, which may be relative to the origin
+NAME_CONTENT_TYPES = ("CNAME", "NS", "MX")
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+def is_number(value):
+    # str.isdigit() accepts digits int() cannot convert, e.g. superscripts
+    return value.isascii() and value.isdigit()
+
+def parse_ttl(value):
+    if is_number(value):
+        return int(value)
+    ttl = 0
+    for number, unit in re.findall(r"([0-9]+)([smhdw])", value.lower()):
+        ttl += int(number) * TTL_UNITS[unit]
+    return ttl
+
+def unquote(value):
+    return ESCAPE.sub(lambda m: chr(int(m.group(1))) if len(m.group(1)) == 3 else m.group(1), value[1:-1])
+
+def absolute_name(name, origin):
+    if name == "@":
+        return origin
+    if name.endswith("."):
+        return name.rstrip(".")
+    return "{}.{}".format(name, origin) if origin else name
+
+def iter_entries(f):
+    """Yields (line number, owner given, tokens) of the master file entries, joining parenthesized lines."""
+    tokens = []
+    depth = 0
+    owner = True
+    start = 0
+    for number, line in enumerate(f, 1):
+        if depth == 0:
+            owner = not line[:1].isspace()
+            start = number
+        for match in TOKEN.finditer(line):
+            if match.group("paren"):
+                depth += 1 if match.group("paren") == "(" else -1
+            elif not match.group("comment"):
+                tokens.append(match.group(0))
+        if depth == 0 and tokens:
+            yield start, owner, tokens
+            tokens = []
+    if tokens:
+        raise ValueError("line {}: unbalanced parentheses".format(start))
+
+def iter_zone_file(f, origin=""):
+    """
+    Yields records of the RFC 1035 master file as seen by the API. The file is
+    parsed line by line, so large zones are not read to memory at once. Record
+    data are kept as text, as the API does.
+    """
+    origin = origin.rstrip(".")
+    ttl = 1800
+    name = origin
+    for number, owner, tokens in iter_entries(f):
+        if tokens[0] == "$ORIGIN":
+            origin = absolute_name(tokens[1], origin)
+            continue
+        if tokens[0] == "$TTL":
+            ttl = parse_ttl(tokens[1])
+            continue
+        if tokens[0].startswith("$"):
+            raise ValueError("line {}: unsupported directive {}".format(number, tokens[0]))
+
+        if owner:
+            name = absolute_name(tokens.pop(0), origin)
+
+        record_ttl = ttl
+        while tokens and (is_number(tokens[0][:1]) or tokens[0].upper() in CLASSES):
+            token = tokens.pop(0)
+            if is_number(token[:1]):
+                record_ttl = parse_ttl(token)
+        if not tokens:
+            raise ValueError("line {}: missing record type".format(number))
+
+        type = tokens.pop(0).upper()
+        if type == "SOA":
+            # The simulator has its own SOA record
+            continue
+        if not tokens:
+            raise ValueError("line {}: missing {} record data".format(number, type))
+
+        record = {"name": name, "type": type, "ttl": record_ttl}
+        if type == "MX":
+            record["prio"] = int(tokens.pop(0))
+        if type in NAME_CONTENT_TYPES:
+            record["content"] = absolute_name(tokens[0], origin)
+        elif type in ("TXT", "SPF"):
+            record["content"] = "".join(unquote(token) if token.startswith('"') else token for token in tokens)
+        else:
+            record["content"] = " ".join(tokens)
+        yield record
+
+def iter_json_file(f):
+    """
+    Yields records of the JSON file, which is either a list of records, or
+    one record per line (JSON Lines, parsed as a stream). Records have the
+    same fields as in the API (name, type, content, ttl and prio).
+    """
+    first = f.read(1)
+    while first.isspace():
+        first = f.read(1)
+
+    if first == "[":
+        yield from iter_json_array(f)
+        return
+
+    line = first + f.readline()
+    while line:
+        if line.strip():
+            yield json.loads(line)
+        line = f.readline()
+
+def iter_json_array(f, read_size=65536):
+    """
+    Yields values of the JSON array whose opening bracket was read from the
+    file already. The file is parsed value by value in buffered reads, so
+    large arrays are not held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+    first = True
+    after_value = False
+    while True:
+        position = JSON_WHITESPACE.match(buffer, position).end()
+        if position < len(buffer):
+            char = buffer[position]
+            if after_value:
+                if char == "]":
+                    return
+                if char != ",":
+                    raise ValueError("Expected , or ] in the JSON array, found {!r}".format(char))
+                position += 1
+                after_value = False
+                continue
+            if char == "]" and first:
+                return
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # A value ending with the buffer (e.g. a number) may continue
+                # in the next read
+                if end < len(buffer) or eof:
+                    yield value
+                    position = end
+                    first = False
+                    after_value = True
+                    continue
+        elif eof:
+            raise ValueError("Truncated JSON array")
+
+        chunk = f.read(read_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+        eof = not chunk
+
+def iter_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(JSON_EXTENSIONS):
+            yield from iter_json_file(f)
+        else:
+            # Zone files without $ORIGIN are relative to the domain in the file
+            # name (e.g. example.com.zone)
+            origin = os.path.basename(path)
+            for extension in ZONE_EXTENSIONS:
+                if origin.endswith(extension):
+                    origin = origin[:-len(extension)]
+            yield from iter_zone_file(f, origin + "." if origin.count(".") else "")
+
+def seed_paths(seed_dir):
+    return sorted(os.path.join(seed_dir, name) for name in os.listdir(seed_dir)
+                  if name.endswith(ZONE_EXTENSIONS + JSON_EXTENSIONS))
+
+def seed(api, paths):
+    """
+    Imports records of the zone or JSON files into the Api. Domains which
+    already have records (e.g. loaded from the storage) are not seeded again.
+    """
+    seeded = {domain for domain in api.domains if api.db[domain]}
+    if seeded:
+        log.info("Not seeding domains with existing records: {}".format(", ".join(sorted(seeded))))
+
+    for path in paths:
+        records = iter_file(path)
+        try:
+            count = api.import_records(records, skip_domains=seeded)
+        except (ValueError, KeyError, IndexError) as e:
+            log.error("Import of {} stopped on invalid record: {}".format(path, e))
+        else:
+            log.info("Imported {} records from {}".format(count, path))
+
+def export(api, path):
+    """Writes all records to the zone file ("-" for standard output) line by line."""
+    if path == "-":
+        f = sys.stdout
+    else:
+        f = open(path + ".tmp", "w", encoding="utf-8")
+
+    try:
+        for line in api.zone_lines():
+            f.write(line)
+            f.write("\n")
+        f.flush()
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    if path != "-":
+        os.replace(path + ".tmp", path)
+        log.info("Records exported to {}".format(path))
@@ -0,0 +1,66 @@
+import io
+import re
+
+import pytest
+
+from subregsim.api import Api
+from subregsim.subreg import create_application
+
+SOAP_NS = 'xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:typ="http://subreg.cz/types"'
+
+
+def envelope(body):
+    return ('<soapenv:Envelope %s><soapenv:Body>%s</soapenv:Body></soapenv:Envelope>' % (SOAP_NS, body)).encode("utf-8")
+
+
+def call(app, method="GET", path="/", body=b"", headers=None):
+    """Calls the WSGI application, returns (status, headers, body)."""
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path.partition("?")[0],
+        "QUERY_STRING": path.partition("?")[2],
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "CONTENT_TYPE": (headers or {}).get("Content-Type", "text/xml; charset=utf-8"),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": io.StringIO(),
+        }
+    for name, value in (headers or {}).items():
+        if name != "Content-Type":
+            environ["HTTP_" + name.upper().replace("-", "_")] = value
+
+    response = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        response["status"] = status
+        response["headers"] = dict(response_headers)
+
+    result = app(environ, start_response)
+    try:
+        data = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], data
+
+
+def soap(app, body):
+    return call(app, "POST", "/", envelope(body))
+
+
+def login(app):
+    _, _, data = soap(app, "<typ:Login><typ:login>username</typ:login><typ:password>password</typ:password></typ:Login>")
+    return re.search(rb"<ns1:ssid>(\w+)</ns1:ssid>", data).group(1).decode()
+
+
+@pytest.fixture
+def api():
+    return Api("username", "password", ["example.com"])
+
+
+@pytest.fixture(params=[False, True], ids=["spyne", "fast"])
+def app(request, api):
+    return create_application("http://localhost/", api, fast_soap=request.param)
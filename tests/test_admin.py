@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from subregsim.admin import AdminApplication
+
+from conftest import call
+
+
+def test_zone_round_trip(api):
+    app = AdminApplication(api)
+    records = [
+        {"name": "example.com", "type": "MX", "content": "mail.example.com", "prio": 10, "ttl": 600},
+        {"name": "www.example.com", "type": "A", "content": "192.0.2.1", "ttl": 1800},
+        {"name": "txt.example.com", "type": "TXT", "content": 'quoted "text" with \\ and ; ( )', "ttl": 60},
+        {"name": "empty.example.com", "type": "TXT", "content": "", "ttl": 600},
+        {"name": "spf.example.com", "type": "SPF", "content": "v=spf1 -all", "ttl": 600},
+        {"name": "_sip._tcp.example.com", "type": "SRV", "content": "0 5 5060 sip.example.com", "ttl": 600},
+        ]
+    assert api.reset_domain("example.com", records + [{"name": "none.example.com", "type": "A", "ttl": 600}]) == 7
+
+    status, headers, zone = call(app, "GET", "/domains/example.com/zone")
+    assert status.startswith("200")
+    assert headers["Content-Type"].startswith("text/dns")
+    # The A record without content cannot be read back
+    assert b"; none.example.com" in zone
+
+    status, _, body = call(app, "PUT", "/domains/example.com/records", zone, {"Content-Type": "text/dns"})
+    assert status.startswith("200"), body
+    assert json.loads(body)["records"] == 6
+
+    _, _, body = call(app, "GET", "/domains/example.com/records")
+    imported = [{key: record[key] for key in ("name", "type", "content", "ttl")} for record in json.loads(body)["records"]]
+    assert sorted(imported, key=lambda record: record["name"]) == sorted(
+        ({key: record[key] for key in ("name", "type", "content", "ttl")} for record in records),
+        key=lambda record: record["name"])
+
+
+def test_zone_of_unknown_domain(api):
+    status, _, _ = call(AdminApplication(api), "GET", "/domains/example.org/zone")
+    assert status.startswith("404")
+
+
+@pytest.mark.parametrize("records", [
+    {"name": "www.example.com"},
+    [{"name": 5, "type": "A", "content": "192.0.2.1"}],
+    [{"type": "A", "content": "192.0.2.1"}],
+    [{"name": "www.example.com", "type": "A", "content": 1}],
+    [{"name": "www.example.com", "type": ["A"], "content": "192.0.2.1"}],
+    [{"name": "www.example.com", "type": "A", "content": "192.0.2.1", "ttl": "600"}],
+    [{"name": "www.example.com", "type": "MX", "content": "mail.example.com", "prio": True}],
+    ])
+def test_put_invalid_records(api, records):
+    status, _, _ = call(AdminApplication(api), "PUT", "/domains/example.com/records", json.dumps(records).encode())
+    assert status.startswith("400")
+    assert api.domain_records("example.com") == []
+
+
+def test_put_records(api):
+    records = [
+        {"name": "www.example.com", "type": "A", "content": "192.0.2.1", "ttl": 600},
+        {"name": "empty.example.com", "type": "A", "content": None},
+        ]
+    status, _, _ = call(AdminApplication(api), "PUT", "/domains/example.com/records", json.dumps(records).encode())
+    assert status.startswith("200")
+    assert len(api.domain_records("example.com")) == 2
+
+
+@pytest.mark.parametrize("request_body, expected", [
+    ({"name": 5}, "400"),
+    ({"name": "example.org", "expire": 2030}, "400"),
+    ({"name": "example.org", "expire": "soon"}, "400"),
+    ({"name": "example.org", "expire": "2030-01-31"}, "201"),
+    ({"name": "example.com"}, "409"),
+    ])
+def test_post_domains(api, request_body, expected):
+    status, _, _ = call(AdminApplication(api), "POST", "/domains", json.dumps(request_body).encode())
+    assert status.startswith(expected)
+
+
+def test_records_of_removed_domain(api):
+    app = AdminApplication(api)
+    assert call(app, "GET", "/domains/example.com/records")[0].startswith("200")
+    assert call(app, "DELETE", "/domains/example.com")[0].startswith("200")
+    assert call(app, "GET", "/domains/example.com/records")[0].startswith("404")
+    assert call(app, "GET", "/domains/example.net/records")[0].startswith("404")
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+
+import dnslib
+import pytest
+
+from subregsim.aio import AsyncDnsServer, AsyncHttpServer
+from subregsim.changes import BlockingResponse
+from subregsim.dns import ApiDnsResolver, DnsResponder
+
+
+def app(released):
+    def wait():
+        released.wait()
+        yield b"changed"
+
+    def application(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        if environ["PATH_INFO"] == "/changes":
+            return BlockingResponse(wait())
+        return [b"ok"]
+
+    return application
+
+
+async def get(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".format(path).encode())
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+def test_waiting_responses_do_not_hold_up_requests():
+    released = threading.Event()
+
+    async def run():
+        server = AsyncHttpServer(app(released), "127.0.0.1", 0, app_threads=1, blocking_threads=2)
+        await server.start()
+        port = server.server.sockets[0].getsockname()[1]
+        try:
+            watchers = [asyncio.create_task(get(port, "/changes")) for _ in range(2)]
+            while server.blocking_responses < 2:
+                await asyncio.sleep(0.01)
+            # More waiting responses than threads are rejected
+            assert (await get(port, "/changes")).startswith(b"HTTP/1.1 503 ")
+            assert (await asyncio.wait_for(get(port, "/"), 5)).endswith(b"\r\n\r\nok")
+            released.set()
+            for response in await asyncio.gather(*watchers):
+                assert response.startswith(b"HTTP/1.1 200 ") and response.endswith(b"changed")
+        finally:
+            released.set()
+            server.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("tcp", [False, True])
+def test_dns_waits_for_locks_off_the_loop(api, tcp):
+    async def query(port, name):
+        request = dnslib.DNSRecord.question(name, "SOA" if name == "example.com" else "A")
+        reply = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: request.send("127.0.0.1", port, tcp=tcp, timeout=5))
+        return dnslib.DNSRecord.parse(reply)
+
+    async def run():
+        server = AsyncDnsServer(DnsResponder(ApiDnsResolver(api)), "127.0.0.1", 0)
+        await server.start()
+        # With port 0, UDP and TCP get different ports
+        if tcp:
+            port = server.tcp_server.sockets[0].getsockname()[1]
+        else:
+            port = server.udp_transport.get_extra_info("sockname")[1]
+        try:
+            await query(port, "example.com")
+            with api.domain_locks["example.com"]:
+                waiting = asyncio.create_task(query(port, "www.example.com"))
+                # Cached answers are sent while the other query waits
+                assert (await asyncio.wait_for(query(port, "example.com"), 5)).rr
+                assert not waiting.done()
+            assert (await asyncio.wait_for(waiting, 5)).header.rcode == dnslib.RCODE.NXDOMAIN
+        finally:
+            server.close()
+
+    asyncio.run(run())
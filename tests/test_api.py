@@ -0,0 +1,125 @@
+import threading
+
+import pytest
+
+from subregsim.api import ERROR_CNAME_CONFLICT, ERROR_INVALID_DOMAIN, ERROR_RECORD_CONFLICT, RESPONSE_OK
+
+
+def login(api):
+    return api.login("username", "password")["response"]["data"]["ssid"]
+
+
+def zone(api, ssid, domain="example.com"):
+    return api.get_dns_zone(ssid, domain)["response"]["data"]["records"]
+
+
+def test_modify_checks_cname_conflicts(api):
+    ssid = login(api)
+    api.add_dns_record(ssid, "example.com", {"name": "www.example.com", "type": "A", "content": "192.0.2.1"})
+    api.add_dns_record(ssid, "example.com", {"name": "alias.example.com", "type": "CNAME", "content": "www.example.com"})
+    api.add_dns_record(ssid, "example.com", {"name": "mail.example.com", "type": "A", "content": "192.0.2.2"})
+    www, alias, mail = zone(api, ssid)
+
+    assert api.modify_dns_record(ssid, "example.com", {"id": alias.id, "name": "www.example.com"}) == ERROR_CNAME_CONFLICT
+    assert api.modify_dns_record(ssid, "example.com", {"id": mail.id, "name": "alias.example.com"}) == ERROR_RECORD_CONFLICT
+    assert api.modify_dns_record(ssid, "example.com", {"id": mail.id, "type": "CNAME", "content": "www.example.com"}) == RESPONSE_OK
+    assert api.modify_dns_record(ssid, "example.com", {"id": alias.id, "content": "mail.example.com"}) == RESPONSE_OK
+    assert api.modify_dns_record(ssid, "example.com", {"id": alias.id, "type": "A", "content": "192.0.2.3"}) == RESPONSE_OK
+    assert [(rr.name, rr.type) for rr in zone(api, ssid)] == [
+        ("www.example.com", "A"), ("alias.example.com", "A"), ("mail.example.com", "CNAME")]
+
+
+def test_index_follows_changes(api):
+    ssid = login(api)
+    for number in range(5):
+        api.add_dns_record(ssid, "example.com", {"name": "www.example.com", "type": "A", "content": "192.0.2.{}".format(number)})
+    records = zone(api, ssid)
+    api.delete_dns_record(ssid, "example.com", {"id": records[1].id})
+    api.modify_dns_record(ssid, "example.com", {"id": records[3].id, "content": "198.51.100.1"})
+
+    found = api.lookup("example.com", "WWW.example.com", "A")
+    assert [rr.content for rr in found] == ["192.0.2.0", "192.0.2.2", "192.0.2.4", "198.51.100.1"]
+
+    for record in records:
+        api.delete_dns_record(ssid, "example.com", {"id": record.id})
+    assert api.lookup("example.com", "www.example.com", "ANY") == []
+    assert not api.has_name("example.com", "www.example.com")
+
+
+class SignallingLock(object):
+    """Sets the event when the thread is about to wait for the lock."""
+
+    def __init__(self, lock, thread, waiting):
+        self.lock = lock
+        self.thread = thread
+        self.waiting = waiting
+
+    def __enter__(self):
+        if threading.current_thread() is self.thread:
+            self.waiting.set()
+        self.lock.__enter__()
+
+    def __exit__(self, *exc_info):
+        self.lock.__exit__(*exc_info)
+
+
+@pytest.mark.parametrize("method, record", [
+    ("add_dns_record", {"name": "www.example.com", "type": "A", "content": "192.0.2.1"}),
+    ("modify_dns_record", {"id": 1, "content": "192.0.2.2"}),
+    ("delete_dns_record", {"id": 1}),
+    ])
+def test_change_of_domain_removed_meanwhile(api, method, record):
+    ssid = login(api)
+    api.add_dns_record(ssid, "example.com", {"name": "www.example.com", "type": "A", "content": "192.0.2.1"})
+
+    results = []
+    change = threading.Thread(target=lambda: results.append(getattr(api, method)(ssid, "example.com", record)))
+    removal = threading.Thread(target=api.remove_domain, args=("example.com",))
+    change_waiting = threading.Event()
+    removal_waiting = threading.Event()
+    lock = api.domain_locks["example.com"]
+    api.domain_locks["example.com"] = SignallingLock(SignallingLock(lock, change, change_waiting), removal, removal_waiting)
+    # The change checks the domain and waits for its lock, while the domain
+    # is removed
+    with lock:
+        change.start()
+        change_waiting.wait()
+        removal.start()
+        removal_waiting.wait()
+        assert "example.com" not in api.domains
+    change.join()
+    removal.join()
+
+    assert results == [ERROR_INVALID_DOMAIN]
+    assert api.db["example.com"] == {}
+
+
+class Domains(dict):
+    """Adds a domain from another thread while the Domains_List response is built."""
+
+    def __init__(self, api, *args):
+        super().__init__(*args)
+        self.api = api
+        self.adder = None
+
+    def values(self):
+        values = list(super().values())
+        if self.adder is None:
+            self.adder = threading.Thread(target=self.api.add_domain, args=("example.org",))
+            waiting = threading.Event()
+            self.api.domains_lock = SignallingLock(self.api.domains_lock, self.adder, waiting)
+            self.adder.start()
+            waiting.wait()
+            # The domain is added now, unless it waits for the lock
+            self.adder.join(0.1)
+        return values
+
+
+def test_domains_list_changed_while_built(api):
+    ssid = login(api)
+    api.domains = Domains(api, api.domains)
+    api.domains_list(ssid)
+    api.domains.adder.join()
+
+    domains = api.domains_list(ssid)["response"]["data"]["domains"]
+    assert [domain["name"] for domain in domains] == ["example.com", "example.org"]
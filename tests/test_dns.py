@@ -0,0 +1,130 @@
+import socket
+import threading
+
+import dnslib
+import pytest
+
+from subregsim.dns import ApiDns, ApiDnsResolver, DnsNotifier, DnsResponder, ZoneTransfer
+
+
+@pytest.fixture
+def ssid(api):
+    return api.login("username", "password")["response"]["data"]["ssid"]
+
+
+def add(api, ssid, name):
+    api.add_dns_record(ssid, "example.com", {"name": name, "type": "A", "content": "192.0.2.1"})
+
+
+def transfer(zone_transfer, serial=None):
+    request = dnslib.DNSRecord(q=dnslib.DNSQuestion("example.com", dnslib.QTYPE.AXFR if serial is None else dnslib.QTYPE.IXFR))
+    if serial is not None:
+        request.add_auth(zone_transfer.soa("example.com", serial))
+    return [rr for reply in zone_transfer.replies(request) for rr in reply.rr]
+
+
+def serials(rrs):
+    return [rr.rdata.times[0] for rr in rrs if rr.rtype == dnslib.QTYPE.SOA]
+
+
+def names(rrs):
+    return sorted(str(rr.rname) for rr in rrs if rr.rtype == dnslib.QTYPE.A)
+
+
+def test_incremental_transfer(api, ssid):
+    zone_transfer = ZoneTransfer(ApiDnsResolver(api))
+    add(api, ssid, "a.example.com")
+    serial = api.sn
+    add(api, ssid, "b.example.com")
+    add(api, ssid, "c.example.com")
+
+    rrs = transfer(zone_transfer, serial)
+    assert serials(rrs) == [api.sn, serial, serial + 1, serial + 1, serial + 2, api.sn]
+    assert names(rrs) == ["b.example.com.", "c.example.com."]
+
+    assert serials(transfer(zone_transfer, api.sn)) == [api.sn]
+
+
+def test_full_transfer_when_journal_is_too_short(api, ssid):
+    zone_transfer = ZoneTransfer(ApiDnsResolver(api), journal_size=2)
+    add(api, ssid, "a.example.com")
+    serial = api.sn
+    for name in ("b", "c", "d"):
+        add(api, ssid, name + ".example.com")
+
+    # The change following the serial was dropped from the journal
+    rrs = transfer(zone_transfer, serial)
+    assert serials(rrs) == [api.sn, api.sn]
+    assert names(rrs) == ["a.example.com.", "b.example.com.", "c.example.com.", "d.example.com."]
+
+    # Still incremental for serials the journal reaches
+    assert names(transfer(zone_transfer, api.sn - 2)) == ["c.example.com.", "d.example.com."]
+
+
+def test_full_transfer_after_zone_reset(api, ssid):
+    zone_transfer = ZoneTransfer(ApiDnsResolver(api))
+    add(api, ssid, "a.example.com")
+    serial = api.sn
+    api.reset_domain("example.com", [{"name": "b.example.com", "type": "A", "content": "192.0.2.2"}])
+
+    rrs = transfer(zone_transfer, serial)
+    assert serials(rrs) == [api.sn, api.sn]
+    assert names(rrs) == ["b.example.com."]
+    assert names(transfer(zone_transfer)) == ["b.example.com."]
+
+
+def test_parsed_records_follow_changes(api, ssid):
+    resolver = ApiDnsResolver(api)
+    add(api, ssid, "a.example.com")
+    record_id = api.get_dns_zone(ssid, "example.com")["response"]["data"]["records"][0].id
+
+    def resolve(name):
+        reply = resolver.resolve(dnslib.DNSRecord.question(name), None)
+        return [(str(rr.rname), str(rr.rdata)) for rr in reply.rr]
+
+    assert resolve("a.example.com") == [("a.example.com.", "192.0.2.1")]
+    # Answers of other names do not change the shared parsed record
+    api.modify_dns_record(ssid, "example.com", {"id": record_id, "name": "*.example.com"})
+    assert resolve("b.example.com") == [("b.example.com.", "192.0.2.1")]
+    assert resolve("c.example.com") == [("c.example.com.", "192.0.2.1")]
+
+    api.modify_dns_record(ssid, "example.com", {"id": record_id, "content": "192.0.2.2"})
+    assert resolve("b.example.com") == [("b.example.com.", "192.0.2.2")]
+
+
+def has_ipv6():
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as sock:
+            sock.bind(("::1", 0))
+    except OSError:
+        return False
+    return True
+
+
+@pytest.mark.parametrize("host", ["127.0.0.1", pytest.param("::1", marks=pytest.mark.skipif(not has_ipv6(), reason="no IPv6"))])
+@pytest.mark.parametrize("tcp", [False, True])
+def test_server_address_family(api, host, tcp):
+    server = ApiDns(DnsResponder(ApiDnsResolver(api)), host, 0, tcp)
+    server.start_thread()
+    try:
+        request = dnslib.DNSRecord.question("example.com", "SOA")
+        reply = dnslib.DNSRecord.parse(request.send(host, server.address[1], tcp=tcp, timeout=5, ipv6=":" in host))
+        assert reply.rr[0].rtype == dnslib.QTYPE.SOA
+    finally:
+        server.stop()
+
+
+@pytest.mark.skipif(not has_ipv6(), reason="no IPv6")
+def test_notify_ipv6_secondary(api):
+    with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as secondary:
+        secondary.bind(("::1", 0))
+        secondary.settimeout(5)
+        notifier = DnsNotifier(api, [("::1", secondary.getsockname()[1])])
+        sender = threading.Thread(target=notifier.notify, args=("example.com", ("::1", secondary.getsockname()[1])))
+        sender.start()
+        data, address = secondary.recvfrom(65535)
+        request = dnslib.DNSRecord.parse(data)
+        assert request.header.opcode == dnslib.OPCODE.NOTIFY
+        assert str(request.q.qname) == "example.com."
+        secondary.sendto(request.reply().pack(), address)
+        sender.join()
@@ -0,0 +1,21 @@
+import pytest
+
+from subregsim.__main__ import parse_dns_target
+
+
+@pytest.mark.parametrize("target, address", [
+    ("192.0.2.53", ("192.0.2.53", 53)),
+    ("192.0.2.53:5353", ("192.0.2.53", 5353)),
+    ("ns.example.com:5353", ("ns.example.com", 5353)),
+    ("2001:db8::1", ("2001:db8::1", 53)),
+    ("[2001:db8::1]", ("2001:db8::1", 53)),
+    ("[2001:db8::1]:5353", ("2001:db8::1", 5353)),
+    ])
+def test_parse_dns_target(target, address):
+    assert parse_dns_target(target) == address
+
+
+@pytest.mark.parametrize("target", ["192.0.2.53:port", "[2001:db8::1", "[2001:db8::1]5353", "[]:53"])
+def test_parse_invalid_dns_target(target):
+    with pytest.raises(ValueError):
+        parse_dns_target(target)
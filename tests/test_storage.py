@@ -0,0 +1,104 @@
+import os
+import threading
+
+import pytest
+
+from subregsim.api import Api
+from subregsim.storage import JournalStorage
+
+
+def create_api(directory, **kwargs):
+    return Api("username", "password", ["example.com", "example.org"], storage=JournalStorage(str(directory), **kwargs))
+
+
+def add(api, ssid, domain, name, content="192.0.2.1"):
+    assert api.add_dns_record(ssid, domain, {"name": name, "type": "A", "content": content})["response"]["status"] == "ok"
+
+
+def records(api, domain="example.com"):
+    return sorted((rr.name, rr.content) for rr in api.db[domain].values())
+
+
+@pytest.mark.parametrize("fsync", ["always", "batch", "never"])
+def test_changes_are_recovered(tmp_path, fsync):
+    api = create_api(tmp_path, fsync=fsync)
+    ssid = api.login("username", "password")["response"]["data"]["ssid"]
+    add(api, ssid, "example.com", "a.example.com")
+    add(api, ssid, "example.com", "b.example.com")
+    add(api, ssid, "example.org", "c.example.org")
+    first = min(api.db["example.com"])
+    api.modify_dns_record(ssid, "example.com", {"id": first, "content": "192.0.2.2"})
+    api.delete_dns_record(ssid, "example.org", {"id": min(api.db["example.org"])})
+    sn = api.sn
+    api.storage.close()
+
+    loaded = create_api(tmp_path, fsync=fsync)
+    assert records(loaded) == [("a.example.com", "192.0.2.2"), ("b.example.com", "192.0.2.1")]
+    assert records(loaded, "example.org") == []
+    assert loaded.sn == sn
+    assert loaded.next_id == api.next_id
+
+
+def test_torn_journal_entry_is_dropped(tmp_path):
+    api = create_api(tmp_path)
+    ssid = api.login("username", "password")["response"]["data"]["ssid"]
+    add(api, ssid, "example.com", "a.example.com")
+    add(api, ssid, "example.com", "b.example.com")
+    api.storage.close()
+
+    # Cut the last entry in the middle, as by a crash during the write
+    path = os.path.join(str(tmp_path), "journal-0.jsonl")
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:-10])
+
+    loaded = create_api(tmp_path)
+    assert records(loaded) == [("a.example.com", "192.0.2.1")]
+    with open(path, "rb") as f:
+        assert f.read() == data[:data.index(b"\n") + 1]
+
+    # New entries are appended after the complete ones
+    ssid = loaded.login("username", "password")["response"]["data"]["ssid"]
+    add(loaded, ssid, "example.com", "c.example.com")
+    loaded.storage.close()
+    assert records(create_api(tmp_path)) == [("a.example.com", "192.0.2.1"), ("c.example.com", "192.0.2.1")]
+
+
+def test_snapshot_compacts_the_journal(tmp_path):
+    api = create_api(tmp_path, snapshot_interval=3)
+    ssid = api.login("username", "password")["response"]["data"]["ssid"]
+    for number in range(7):
+        add(api, ssid, "example.com", "host{}.example.com".format(number))
+    api.storage.close()
+
+    assert sorted(os.listdir(str(tmp_path))) == ["journal-2.jsonl", "snapshot-2.json"]
+    assert len(records(create_api(tmp_path))) == 7
+
+
+def test_concurrent_changes_are_synced(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or fsync(fd))
+
+    api = create_api(tmp_path, fsync="always", snapshot_interval=0)
+    ssid = api.login("username", "password")["response"]["data"]["ssid"]
+
+    def writer(domain):
+        for number in range(50):
+            add(api, ssid, domain, "host{}.{}".format(number, domain))
+
+    threads = [threading.Thread(target=writer, args=(domain,)) for domain in ("example.com", "example.org")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every change is synced before it is answered, possibly together with
+    # changes of the other domain
+    assert api.storage.synced == api.storage.written == 100
+    assert 0 < len(synced) <= 100
+    api.storage.close()
+
+    loaded = create_api(tmp_path)
+    assert len(records(loaded)) == len(records(loaded, "example.org")) == 50
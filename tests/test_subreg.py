@@ -0,0 +1,169 @@
+import copy
+import io
+import socket
+import ssl
+import threading
+
+import pytest
+from lxml import etree
+
+from subregsim import schema
+from subregsim.subreg import (MAX_BODY_SIZE, ApiHttpServer, FastSoapApplication, FastSoapFallback,
+                              RequestBodyTooLarge, create_application, read_chunked_body)
+
+from conftest import envelope, login, soap
+
+
+def modify_record(ssid, record_id):
+    return ("<typ:Modify_DNS_Record><typ:ssid>%s</typ:ssid><typ:domain>example.com</typ:domain>"
+            "<typ:record><typ:id>%s</typ:id><typ:type>TXT</typ:type><typ:content>x</typ:content></typ:record>"
+            "</typ:Modify_DNS_Record>" % (ssid, record_id))
+
+
+@pytest.mark.parametrize("record_id", ["²", "٣", "-1", "1.5", ""])
+def test_fast_parser_falls_back_on_non_ascii_integers(api, record_id):
+    app = FastSoapApplication(api, None, schema.WSDL_NS)
+    with pytest.raises(FastSoapFallback):
+        app.dispatch(envelope(modify_record("ssid", record_id)))
+
+
+@pytest.mark.parametrize("record_id", ["²", "12"])
+def test_fast_path_answers_like_spyne(api, record_id):
+    # The fast path answers, or leaves the request to Spyne, so that the
+    # response is the same either way
+    responses = []
+    for fast_soap in (False, True):
+        app = create_application("http://localhost/", api, fast_soap=fast_soap)
+        responses.append(soap(app, modify_record(login(app), record_id))[::2])
+    assert responses[0] == responses[1]
+    if record_id == "²":
+        assert responses[0][0].startswith("500")
+        assert "Could not cast" in responses[0][1].decode("utf-8")
+
+
+def test_get_dns_zone(app):
+    ssid = login(app)
+    soap(app, "<typ:Add_DNS_Record><typ:ssid>%s</typ:ssid><typ:domain>example.com</typ:domain>"
+              "<typ:record><typ:name>www</typ:name><typ:type>A</typ:type><typ:content>192.0.2.1</typ:content></typ:record>"
+              "</typ:Add_DNS_Record>" % ssid)
+    status, _, data = soap(app, "<typ:Get_DNS_Zone><typ:ssid>%s</typ:ssid><typ:domain>example.com</typ:domain></typ:Get_DNS_Zone>" % ssid)
+    assert status.startswith("200")
+    records = etree.fromstring(data).findall(".//{%s}records" % schema.TYPES_NS)
+    assert [record.findtext("{%s}content" % schema.TYPES_NS) for record in records] == ["192.0.2.1"]
+
+
+def test_fast_paths_are_opt_in(api):
+    assert not isinstance(create_application("http://localhost/", api), FastSoapApplication)
+
+    app = create_application("http://localhost/", api, stream_responses=True)
+    assert {operation[0] for operation in app.operations.values()} == {"Domains_List", "Get_DNS_Zone"}
+    app = create_application("http://localhost/", api, fast_soap=True)
+    assert len({operation[0] for operation in app.operations.values()}) == 6
+
+
+def test_server_close_with_full_queue(api):
+    server = ApiHttpServer(("127.0.0.1", 0), "http://127.0.0.1/", api, False, workers=1, queue_size=1)
+    # The worker waits for the request of the first connection, the second
+    # one waits in the queue
+    clients = [socket.create_connection(server.server_address) for _ in range(2)]
+    for _ in clients:
+        server._handle_request_noblock()
+    assert server.request_queue.full()
+
+    closing = threading.Thread(target=server.server_close)
+    closing.start()
+    closing.join(5)
+    assert not closing.is_alive()
+    # The waiting connection is closed unanswered
+    assert clients[1].recv(1) == b""
+    clients[0].close()
+    server.worker_threads[0].join(5)
+    assert not server.worker_threads[0].is_alive()
+    clients[1].close()
+
+
+def test_reject_tls_connection(api, monkeypatch):
+    server = ApiHttpServer(("127.0.0.1", 0), "http://127.0.0.1/", api, True, workers=1, queue_size=1, queue_full="reject")
+    try:
+        client = socket.create_connection(server.server_address)
+        request, _ = server.socket.accept()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        request = context.wrap_socket(request, server_side=True, do_handshake_on_connect=False)
+        monkeypatch.setattr(request, "sendall", lambda data: pytest.fail("data sent"))
+        server.reject_request(request, ("127.0.0.1", 0))
+        assert client.recv(1) == b""
+        client.close()
+    finally:
+        server.server_close()
+
+
+def test_bind_failure(api):
+    server = ApiHttpServer(("127.0.0.1", 0), "http://127.0.0.1/", api, False, workers=1, queue_size=1)
+    try:
+        with pytest.raises(OSError):
+            ApiHttpServer(server.server_address, "http://127.0.0.1/", api, False, workers=1, queue_size=1)
+    finally:
+        server.server_close()
+
+
+def test_read_chunked_body():
+    rfile = io.BytesIO(b"3;name=value\r\nabc\r\n2\r\nde\r\n0\r\nTrailer: x\r\n\r\n")
+    assert read_chunked_body(rfile) == b"abcde"
+
+
+@pytest.mark.parametrize("body", [b"x\r\nabc\r\n0\r\n\r\n", b"-3\r\nabc\r\n0\r\n\r\n",
+                                  b"5\r\nabc", b"3\r\nabc\r\n"])
+def test_read_invalid_chunked_body(body):
+    with pytest.raises(ValueError):
+        read_chunked_body(io.BytesIO(body))
+
+
+def test_read_too_large_chunked_body():
+    with pytest.raises(RequestBodyTooLarge):
+        read_chunked_body(io.BytesIO(b"%x\r\n" % (MAX_BODY_SIZE + 1)))
+
+
+@pytest.mark.parametrize("headers, status", [
+    (b"Transfer-Encoding: chunked\r\n\r\nx\r\n", b"400"),
+    (b"Transfer-Encoding: chunked\r\n\r\n%x\r\n" % (MAX_BODY_SIZE + 1), b"413"),
+    (b"Content-Length: %d\r\n\r\n" % (MAX_BODY_SIZE + 1), b"413"),
+])
+def test_invalid_request_body(api, headers, status):
+    server = ApiHttpServer(("127.0.0.1", 0), "http://127.0.0.1/", api, False, workers=1, queue_size=1)
+    serving = threading.Thread(target=server.serve_forever)
+    serving.start()
+    try:
+        client = socket.create_connection(server.server_address)
+        client.sendall(b"POST / HTTP/1.1\r\nHost: localhost\r\n" + headers)
+        assert client.makefile("rb").readline().split()[1] == status
+        client.close()
+    finally:
+        server.shutdown()
+        serving.join(5)
+        server.server_close()
+
+
+class CopyingApi(object):
+    """Returns copies of the responses, as the Api of another process does."""
+
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, name):
+        method = getattr(self.api, name)
+        return lambda *args: copy.deepcopy(method(*args))
+
+
+def test_copied_responses_are_cached(api):
+    app = FastSoapApplication(CopyingApi(api), None, schema.WSDL_NS)
+    ssid = api.login("username", "password")["response"]["data"]["ssid"]
+
+    domains_list = envelope("<typ:Domains_List><typ:ssid>%s</typ:ssid></typ:Domains_List>" % ssid)
+    rendered = app.dispatch(domains_list)
+    assert app.dispatch(domains_list) is rendered
+    api.add_domain("example.org")
+    changed = app.dispatch(domains_list)
+    assert changed is not rendered and b"example.org" in changed
+
+    not_logged = envelope("<typ:Domains_List><typ:ssid>none</typ:ssid></typ:Domains_List>")
+    assert app.dispatch(not_logged) is app.dispatch(not_logged)
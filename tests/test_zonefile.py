@@ -0,0 +1,56 @@
+import io
+
+import pytest
+
+from subregsim.zonefile import iter_json_array, iter_json_file, iter_zone_file, parse_ttl
+
+
+def records(text, origin="example.com."):
+    return list(iter_zone_file(io.StringIO(text), origin))
+
+
+@pytest.mark.parametrize("value, ttl", [("3600", 3600), ("1h30m", 5400), ("2d", 172800), ("1W", 604800)])
+def test_parse_ttl(value, ttl):
+    assert parse_ttl(value) == ttl
+
+
+def test_parse_ttl_ignores_non_ascii_digits():
+    assert parse_ttl("²") == 0
+    assert parse_ttl("٣h") == 0
+
+
+def test_non_ascii_digit_is_not_a_ttl():
+    # "²" is not taken for a TTL, so it is the (unknown) record type
+    assert records("www ² IN A 192.0.2.1\n") == [
+        {"name": "www.example.com", "type": "²", "ttl": 1800, "content": "IN A 192.0.2.1"}]
+
+
+def test_escapes():
+    assert records('txt TXT "a\\"b" "\\065\\1"\n')[0]["content"] == 'a"bA1'
+
+
+@pytest.mark.parametrize("text", [
+    ' [\n {"name": "a.example.com", "type": "A", "ttl": 600}, {"name": "b.example.com", "type": "TXT", "content": "x ] y"}\n]\n',
+    '{"name": "a.example.com", "type": "A", "ttl": 600}\n\n{"name": "b.example.com", "type": "TXT", "content": "x ] y"}\n',
+])
+def test_iter_json_file(text):
+    assert list(iter_json_file(io.StringIO(text))) == [
+        {"name": "a.example.com", "type": "A", "ttl": 600}, {"name": "b.example.com", "type": "TXT", "content": "x ] y"}]
+
+
+@pytest.mark.parametrize("read_size", [1, 2, 7, 65536])
+def test_json_array_read_in_parts(read_size):
+    f = io.StringIO(' [] ')
+    f.read(2)
+    assert list(iter_json_array(f, read_size)) == []
+    f = io.StringIO('[12345, "a,b]", {"c": [1, 2]} , null]')
+    f.read(1)
+    assert list(iter_json_array(f, read_size)) == [12345, "a,b]", {"c": [1, 2]}, None]
+
+
+@pytest.mark.parametrize("text", ['[1, 2', '[1 2]', '[1,]', '[{"a": ]'])
+def test_invalid_json_array(text):
+    f = io.StringIO(text)
+    f.read(1)
+    with pytest.raises(ValueError):
+        list(iter_json_array(f, 2))